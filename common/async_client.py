@@ -0,0 +1,105 @@
+"""\
+Purpose: Network connection facilities on an asyncio event loop
+"""
+import asyncio
+from common.tc_logging import wire
+from common.client import get_tls_client_context
+from common.framing import SipFramer
+import common.pcap as pcap
+
+
+class SipStreamProtocol(asyncio.BufferedProtocol):
+    """
+    SIP over TCP or TLS. The event loop receives directly into the SipFramer buffer.
+    Every complete message is given to on_message as bytes, and None when the connection is lost.
+    """
+
+    def __init__(self, on_message, link=None):
+        self.on_message = on_message
+        self.link = link
+        self.framer = SipFramer()
+
+    def get_buffer(self, sizehint):
+        return self.framer.receive_buffer(max(sizehint, 4096))
+
+    def buffer_updated(self, nbytes):
+        self.framer.received(nbytes)
+        for frame in self.framer.frames():
+            if pcap.writer is not None:
+                pcap.capture(frame, (self.link.rip, self.link.rport), (self.link.ip, self.link.port))
+            self.on_message(frame)
+
+    def connection_lost(self, exc):
+        self.on_message(None)
+
+
+class SipDatagramProtocol(asyncio.DatagramProtocol):
+    """ SIP over UDP. Every datagram is one message, keep alives are ignored """
+
+    def __init__(self, on_message, link=None):
+        self.on_message = on_message
+        self.link = link
+
+    def datagram_received(self, data, addr):
+        if data.strip():
+            pcap.capture(data, addr[:2], (self.link.ip, self.link.port), "udp")
+            self.on_message(data)
+
+    def connection_lost(self, exc):
+        self.on_message(None)
+
+
+class AsyncClient(object):
+    """
+    A SIP link on the running asyncio event loop.
+    It sends like common.client.TCPClient, received messages are given to the on_message callback of connect()
+    """
+
+    def __init__(self, ip, port, protocol="tcp", certificate=None, subject_name="localhost"):
+        self.ip = ip
+        self.port = port
+        self.rip, self.rport = None, None
+        self.protocol = protocol.upper()
+        self.certificate = certificate
+        self.server_name = subject_name
+        self.transport = None
+        self.dispatcher = None
+
+    async def connect(self, dest_ip, dest_port, on_message):
+        """
+        Connect to the remote address
+        :param on_message: Called with the bytes of every received message, and with None when disconnected
+        """
+        loop = asyncio.get_running_loop()
+        if self.protocol == "UDP":
+            self.transport, _ = await loop.create_datagram_endpoint(lambda: SipDatagramProtocol(on_message, self),
+                                                                    local_addr=(self.ip, self.port),
+                                                                    remote_addr=(dest_ip, dest_port))
+        elif self.protocol in ("TCP", "TLS"):
+            if self.protocol == "TLS":
+                tls = {"ssl": get_tls_client_context(self.certificate), "server_hostname": self.server_name}
+            else:
+                tls = {}
+            self.transport, _ = await loop.create_connection(lambda: SipStreamProtocol(on_message, self),
+                                                             dest_ip, dest_port,
+                                                             local_addr=(self.ip, self.port), **tls)
+        else:
+            raise NotImplementedError("{} client not implemented".format(self.protocol))
+        self.port = self.transport.get_extra_info("sockname")[1]
+        self.rip = dest_ip
+        self.rport = dest_port
+
+    def send(self, data, encoding="utf8"):
+        """ Queue data for sending. It never blocks, the event loop writes it when the socket is ready """
+        if type(data) != type(b''):
+            data = bytes(data, encoding)
+        if self.protocol == "UDP":
+            self.transport.sendto(data)
+        else:
+            self.transport.write(data)
+        pcap.capture(data, (self.ip, self.port), (self.rip, self.rport), "udp" if self.protocol == "UDP" else "tcp")
+        wire(data, "Sent from port {}:\n\n", self.port)
+
+    def shutdown(self):
+        if self.transport:
+            self.transport.close()
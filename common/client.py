@@ -2,19 +2,95 @@
 Purpose: Network connection facilities
 Initial Version: Costas Skarakis 11/11/2018
 """
+import select
 import selectors
 import socket
 import ssl
-import io
-from threading import Lock
-from time import sleep
-from common.tc_logging import debug
-from common.util import wait_for_sip_data, NoData, IncompleteData
+from collections import deque
+from threading import Lock, Condition
+from time import time
+from common.tc_logging import debug, warning, wire
+from common.framing import SipFramer, CstaFramer
+import common.pcap as pcap
+
+
+def tls_client_context(certificate=None):
+    """
+    :param certificate: The certificate to verify the server with, eg 'path/to/my_certificate.pem'.
+                        If None the server is not verified
+    :return: An ssl.SSLContext for TLS client connections
+    """
+    # PROTOCOL_TLS_CLIENT requires valid cert chain and hostname
+    if hasattr(ssl, "PROTOCOL_TLS_CLIENT"):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
+    elif hasattr(ssl, "PROTOCOL_TLSv1_1"):
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_1)
+    else:
+        context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+
+    if not certificate:
+        context.check_hostname = False
+        context.verify_mode = ssl.CERT_NONE
+    else:
+        context.load_verify_locations(certificate)
+    return context
+
+
+# One context per certificate shared by all TLSClients, so that they can also share TLS sessions
+tls_contexts = {}
+# The last TLS session with each (certificate, server name, remote address), to resume instead of a full handshake
+tls_sessions = {}
+tls_lock = Lock()
+handshake_statistics = {"TLS Handshakes": 0, "TLS Resumed": 0, "TLS Handshake Time": 0.0,
+                        "TLS Max Handshake Time": 0.0}
+
+
+def get_tls_client_context(certificate=None):
+    """ :return: The shared ssl.SSLContext of TLS client connections verified with certificate """
+    with tls_lock:
+        if certificate not in tls_contexts:
+            tls_contexts[certificate] = tls_client_context(certificate)
+        return tls_contexts[certificate]
+
+
+def tls_server_context(certificate, key=None):
+    """
+    :param certificate: The certificate chain of the server, eg 'path/to/certchain.pem'
+    :param key: The private key of the server. If None it must be included in certificate
+    :return: An ssl.SSLContext for TLS server connections
+    """
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certificate, key)
+    return context
+
+
+def record_handshake(seconds, resumed=False):
+    """ Add a completed TLS handshake to the handshake statistics """
+    with tls_lock:
+        handshake_statistics["TLS Handshakes"] += 1
+        handshake_statistics["TLS Resumed"] += resumed
+        handshake_statistics["TLS Handshake Time"] += seconds
+        handshake_statistics["TLS Max Handshake Time"] = max(handshake_statistics["TLS Max Handshake Time"], seconds)
+
+
+def get_handshake_statistics():
+    """ :return: A copy of the TLS handshake statistics, with the average handshake time in seconds """
+    with tls_lock:
+        statistics = dict(handshake_statistics)
+    if statistics["TLS Handshakes"]:
+        statistics["TLS Average Handshake Time"] = statistics["TLS Handshake Time"] / statistics["TLS Handshakes"]
+    return statistics
 
 
 class TCPClient(object):
     def __init__(self, ip, port):
-        self.sip_buffer = []
+        # Complete messages received but not consumed yet
+        self.sip_buffer = deque()
+        self.sip_framer = SipFramer()
+        self.csta_buffer = deque()
+        self.csta_framer = CstaFramer()
+        # Routes the received messages to the SipEndpoints sharing this link, see sip.SipDispatcher
+        self.dispatcher = None
         self.ip = ip
         self.port = port
         self.rip, self.rport = None, None
@@ -23,7 +99,7 @@ class TCPClient(object):
             self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM, 0)
         else:
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.send_lock = Lock()
+        self.init_send_queue()
         self.wait_lock = Lock()
         self.csta_wait_lock = Lock()
         self.sel = selectors.DefaultSelector()
@@ -40,19 +116,109 @@ class TCPClient(object):
         self.rip = dest_ip
         self.rport = dest_port
 
+    def init_send_queue(self):
+        """
+        Messages sent concurrently are queued and the thread that finds the link idle writes the whole queue with
+        one sendmsg. Every sender returns when its own message is written.
+        send_batch is the most messages written at once. flush_delay is the most seconds a writer waits for more
+        messages before writing fewer than send_batch, the extra latency a message can have. 0 never waits,
+        messages are batched only while another write is in progress.
+        """
+        self.send_lock = Lock()
+        self.send_condition = Condition(self.send_lock)
+        self.send_queue = deque()
+        self.sending = False
+        # Tickets of the messages queued and written so far
+        self.queued_count = 0
+        self.sent_count = 0
+        # Ticket to exception, for the messages that could not be written. Every sender removes its own
+        self.send_failures = {}
+        self.send_batch = 64
+        self.flush_delay = 0.0
+
     def send(self, data, encoding="utf8"):
         # self.socket.sendall(binascii.hexlify(bytes(data,"utf8")))
-        with self.send_lock:
-            if type(data) == type(b''):
-                self.socket.sendall(data)
-                debug("Sent from port {}:\n\n".format(self.port) + data.decode("utf8", "backslashreplace").replace("\r\n",
-                                                                                                                   "\n"))
-            else:
-                self.socket.sendall(bytes(data, encoding))
-                debug("Sent from port {}:\n\n".format(self.port) + data.replace("\r\n", "\n"))
+        if type(data) != type(b''):
+            data = bytes(data, encoding)
+        with self.send_condition:
+            self.send_queue.append(data)
+            self.queued_count += 1
+            ticket = self.queued_count
+            while self.sent_count < ticket and self.sending:
+                # Another thread is writing and will take this message too
+                self.send_condition.wait()
+            if self.sent_count < ticket:
+                self.sending = True
+        if self.sent_count < ticket:
+            self.flush_send_queue(ticket)
+        failure = self.send_failures.pop(ticket, None)
+        if failure is not None:
+            raise failure
+        pcap.capture(data, (self.ip, self.port), (self.rip, self.rport))
+        wire(data, "Sent from port {}:\n\n", self.port)
+
+    def flush_send_queue(self, ticket):
+        """ Write queued messages in batches until message number ticket is written. Only one thread at a time """
+        try:
+            while self.sent_count < ticket:
+                with self.send_condition:
+                    if self.flush_delay and len(self.send_queue) < self.send_batch:
+                        self.send_condition.wait(self.flush_delay)
+                    batch = [self.send_queue.popleft() for i in range(min(self.send_batch, len(self.send_queue)))]
+                first = self.sent_count + 1
+                try:
+                    self.write(batch)
+                except OSError as e:
+                    for failed in range(first, first + len(batch)):
+                        self.send_failures[failed] = e
+                with self.send_condition:
+                    self.sent_count += len(batch)
+                    self.send_condition.notify_all()
+        finally:
+            with self.send_condition:
+                # Queued messages of other senders are written by one of them
+                self.sending = False
+                self.send_condition.notify_all()
+
+    def write(self, buffers):
+        """ Write a list of buffers in as few system calls as possible """
+        if self.socket.gettimeout() == 0:
+            # Non blocking while a reactor receives on it, see common.reactor
+            self.write_nonblocking(b"".join(buffers))
+            return
+        if len(buffers) == 1 or not hasattr(self.socket, "sendmsg") or isinstance(self.socket, ssl.SSLSocket):
+            # No scatter/gather for TLS. One write still makes fewer and larger records
+            self.socket.sendall(b"".join(buffers))
+            return
+        buffers = [memoryview(b) for b in buffers]
+        while buffers:
+            sent = self.socket.sendmsg(buffers)
+            while buffers and sent >= len(buffers[0]):
+                sent -= len(buffers[0])
+                buffers.pop(0)
+            if sent:
+                buffers[0] = buffers[0][sent:]
+
+    def write_nonblocking(self, data, timeout=5.0):
+        """ Write all of data to a non blocking socket, waiting for it to become writable whenever it is full """
+        data = memoryview(data)
+        sel = None
+        try:
+            while data:
+                try:
+                    data = data[self.socket.send(data):]
+                except (BlockingIOError, ssl.SSLWantWriteError, ssl.SSLWantReadError):
+                    if sel is None:
+                        sel = selectors.DefaultSelector()
+                        sel.register(self.socket, selectors.EVENT_WRITE)
+                    if not sel.select(timeout):
+                        raise socket.timeout("Timeout writing to " + self.rip + ":" + str(self.rport))
+        finally:
+            if sel is not None:
+                sel.close()
 
     def waitForData(self, timeout=None, buffer=4096):
-        debug("Waiting on port {}".format(self.port))
+        debug("Waiting on port %s", self.port)
         bkp = self.socket.gettimeout()
         if timeout:
             self.socket.settimeout(timeout)
@@ -60,8 +226,8 @@ class TCPClient(object):
             data = self.socket.recv(buffer)
         finally:
             self.socket.settimeout(bkp)
-        debug("Received on port {}:\n\n".format(self.port) + data.decode("utf8", "backslashreplace").replace("\r\n",
-                                                                                                             "\n"))
+        self.captured([data])
+        wire(data, "Received on port {}:\n\n", self.port)
         return data
 
     def wait_select(self, timeout):
@@ -69,66 +235,50 @@ class TCPClient(object):
             raise socket.timeout("Timeout waiting for data in " + self.ip + ":" + str(self.port))
 
     def waitForSipData(self, timeout=None, client=None, bufsize=4096):
+        """
+        Wait for the next SIP message on a stream socket
+        :param timeout: Seconds to wait for data. None waits forever
+        :param client: The client whose socket and buffers will be used. Defaults to self
+        :param bufsize: The maximum number of bytes read from the socket at once
+        :return: The message bytes, or None if the other side closed the connection
+        """
         if not client:
             client = self
         with client.wait_lock:
-            debug("Waiting on port {}".format(client.port))
+            debug("Waiting on port %s", client.port)
             bkp = client.socket.gettimeout()
-            data = b""
             try:
-                if client.sip_buffer:
-                    data = client.sip_buffer.pop(0)
-                else:
+                # All complete messages of every read are buffered, the next one is returned immediately
+                while not client.sip_buffer:
                     client.wait_select(timeout)
-                    all_data = io.BytesIO(client.socket.recv(bufsize))
-                    while True:
-                        try:
-                            # There may be more than one sip messages in the socket
-                            # I think select will not trigger if we only read one of them
-                            # and then come back for the second one
-                            client.sip_buffer.append(wait_for_sip_data(all_data))
-                            # We will replace all_data with everything following the current
-                            # read location to discard the message that was already added to the
-                            # buffer.
-                            # In case all_data contained more than one message and the second one
-                            # was incomplete, we have to reread only the second message
-                            # not the first one again which is already in the sip_buffer
-                            all_data = io.BytesIO(all_data.read())
-                        except EOFError:
-                            if client.sip_buffer:
-                                data = client.sip_buffer.pop(0)
-                                break
-                            else:
-                                client.wait_select(timeout)
-                                all_data = io.BytesIO(client.socket.recv(bufsize))
-                                continue
-                        except IncompleteData:
-                            client.wait_select(timeout)
-                            all_data = io.BytesIO(all_data.getvalue() + client.socket.recv(bufsize))
-                            continue
-                        except NoData:
-                            if client.sip_buffer:
-                                data = client.sip_buffer.pop(0)
-                            else:
-                                data = all_data.getvalue()
-                                debug('Invalid SIP Data in socket: ' + data.decode())
-                                all_data = io.BytesIO(all_data.read())
-                                continue
-                                # raise ValueError
-                            break
-            except ValueError:
-                debug('Value Error: '+data.decode())
-                # debug(line.decode())
-                # raise
+                    try:
+                        frames = client.read_stream(client.sip_framer, bufsize)
+                    except (BlockingIOError, ssl.SSLWantReadError):
+                        # Eg only part of a TLS record has arrived on a non blocking socket
+                        continue
+                    if frames is None:
+                        debug("Connection closed by the other side on port {}".format(client.port))
+                        return None
+                    client.sip_buffer.extend(frames)
+                data = client.sip_buffer.popleft()
             except socket.timeout:
-                debug('Data received before timeout: "{}"'.format(data.decode()))
+                debug('Data received before timeout: "{}"'.format(
+                    bytes(client.sip_framer.buffer[client.sip_framer.start:client.sip_framer.end]).decode(
+                        "utf8", "backslashreplace")))
                 raise
             finally:
                 client.socket.settimeout(bkp)
-            debug("Received on port {}:\n\n".format(client.port) + data.decode("utf8").replace("\r\n", "\n"))
+            wire(data, "Received on port {}:\n\n", client.port)
             return data
 
-    def waitForCstaData(self, timeout=None):
+    def waitForCstaData(self, timeout=None, bufsize=4096):
+        """
+        Wait for the next CSTA message
+        :param timeout: Seconds to wait for data. None waits forever
+        :param bufsize: The minimum number of bytes read from the socket at once.
+                        The rest of a large message is read with one call when its length is known
+        :return: The message bytes including the length header, or None if the other side closed the connection
+        """
         with self.csta_wait_lock:
             bkp = self.socket.gettimeout()
             if timeout:
@@ -136,49 +286,294 @@ class TCPClient(object):
             elif timeout is None:
                 self.socket.setblocking(True)
             try:
-                # header = ""
-                # while not header:
-                header = self.socket.recv(4)
-                if not header:
-                    debug("Csta socket was probably disconnected from the other side")
-                    return None
-                datalength = int(''.join(["%02X" % x for x in header]), base=16) - 4
-                data = b''
-                while len(data) < datalength:
-                    data += self.socket.recv(datalength - len(data))
-                    sleep(0.001)
-                debug(
-                    "Received on port {} message of length {}:\n\n".format(self.port, datalength) + (header + data).decode(
-                        "utf8",
-                        "backslashreplace").replace("\r\n", "\n"))
+                # All complete messages of every read are buffered, the next one is returned immediately
+                while not self.csta_buffer:
+                    if not self.csta_framer.recv_from(self.socket, max(bufsize, self.csta_framer.needed())):
+                        debug("Csta socket was probably disconnected from the other side")
+                        return None
+                    self.csta_buffer.extend(self.captured(self.csta_framer.frames()))
+                data = self.csta_buffer.popleft()
+                wire(data, "Received on port {} message of length {}:\n\n", self.port, len(data) - 4)
             except socket.timeout:
-                debug('Data received before timeout: "{}"'.format(data.decode()))
+                debug('Data received before timeout: "{}"'.format(
+                    bytes(self.csta_framer.buffer[self.csta_framer.start:self.csta_framer.end]).decode(
+                        "utf8", "backslashreplace")))
                 raise
             finally:
                 self.socket.settimeout(bkp)
-            return header + data
+            return data
+
+    def read_sip(self, bufsize=4096):
+        """
+        Read once from a socket that is ready, eg in a reactor, and frame the data
+        :return: The complete SIP messages received so far, None if the other side closed the connection
+        """
+        return self.read_stream(self.sip_framer, bufsize)
+
+    def read_csta(self, bufsize=4096):
+        """
+        Read once from a socket that is ready, eg in a reactor, and frame the data
+        :return: The complete CSTA messages received so far, None if the other side closed the connection
+        """
+        return self.read_stream(self.csta_framer, max(bufsize, self.csta_framer.needed()))
+
+    def read_stream(self, framer, bufsize):
+        """
+        :raises BlockingIOError, ssl.SSLWantReadError: If a non blocking socket has no data yet, eg when only TLS
+                session tickets or part of a record have arrived
+        """
+        if not framer.recv_from(self.socket, bufsize):
+            return None
+        # Decrypted data may be waiting in the TLS layer where the selector cannot see it
+        while isinstance(self.socket, ssl.SSLSocket) and self.socket.pending():
+            framer.recv_from(self.socket, self.socket.pending())
+        return self.captured(framer.frames())
+
+    def captured(self, frames):
+        """
+        Capture received messages if a pcapng capture is running, see common.pcap
+        :return: frames
+        """
+        if pcap.writer is not None:
+            for frame in frames:
+                pcap.capture(frame, (self.rip, self.rport), (self.ip, self.port))
+        return frames
+
+    def use_socket(self, sock):
+        """ Use a connected socket instead of connecting, eg one accepted by a server """
+        if getattr(self, "socket", None) is not None and self.socket is not sock:
+            self.socket.close()
+        self.socket = sock
+        self.sockfile = sock.makefile(mode='rb')
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(sock, selectors.EVENT_READ, data=None)
 
     def shutdown(self):
         self.socket.shutdown(socket.SHUT_RDWR)
 
 
 class UDPClient(TCPClient):
-    def __init__(self, ip, port):
+    """
+    A SIP link over UDP. Every datagram is one message.
+
+    Links to different remote addresses can share one socket through a UDPTransport.
+    Received datagrams are given to the link of their source address.
+    """
+
+    def __init__(self, ip, port, transport=None):
+        if transport is None:
+            transport = UDPTransport(ip, port)
+        self.transport = transport
+        self.socket = transport.socket
         self.ip = ip
-        self.port = port
+        self.port = transport.port
         self.rip, self.rport = None, None
-        if ":" in self.ip:
-            # ipv6 case
-            self.socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM, 0)
-        else:
-            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket.bind((self.ip, self.port))
-        self.socket.settimeout(5.0)
-        self.sockfile = self.socket.makefile(mode='rb')
+        # The resolved remote address, as in the source address of received datagrams
+        self.address = None
+        self.closed = False
+        self.sip_buffer = deque()
+        self.dispatcher = None
         self.send_lock = Lock()
         self.wait_lock = Lock()
         self.csta_wait_lock = Lock()
 
+    def connect(self, dest_ip, dest_port):
+        self.rip = dest_ip
+        self.rport = dest_port
+        self.transport.add_link(self)
+
+    def send(self, data, encoding="utf8"):
+        if type(data) != type(b''):
+            data = bytes(data, encoding)
+        with self.send_lock:
+            self.transport.send(data, self.address)
+        wire(data, "Sent from port {} to {}:{}:\n\n", self.port, self.rip, self.rport)
+
+    def waitForSipData(self, timeout=None, client=None, bufsize=None):
+        """
+        Wait for the next SIP message from the remote address of this link
+        :param timeout: Seconds to wait for data. None waits forever
+        :param client: The link to wait on. Defaults to self
+        :param bufsize: Not used, a datagram is always read whole
+        :return: The message bytes, or None if the link was shut down
+        """
+        if not client:
+            client = self
+        with client.wait_lock:
+            debug("Waiting on port %s for %s:%s", client.port, client.rip, client.rport)
+            try:
+                if not client.transport.wait_for(client, timeout):
+                    return None
+            except socket.timeout:
+                debug("No data received from {}:{} before timeout".format(client.rip, client.rport))
+                raise
+            data = client.sip_buffer.popleft()
+        wire(data, "Received on port {} from {}:{}:\n\n", client.port, client.rip, client.rport)
+        return data
+
+    def shutdown(self):
+        self.transport.remove_link(self)
+
+
+class UDPTransport(object):
+    """
+    A UDP socket shared by the links to many remote addresses
+
+    Datagrams are read in batches, all the datagrams waiting in the socket per wakeup (up to batch), and each
+    one is buffered in the link of its source address. Only one thread reads from the socket at a time, for
+    all the links, while the threads waiting on other links sleep until a datagram arrives for them.
+
+    Datagrams from an address without a link go to the first link that was connected. With accept=True a new
+    link is created for them instead and added to new_links, eg for a server.
+    """
+    MAX_DATAGRAM = 65535
+
+    def __init__(self, ip, port, accept=False, batch=64, sock=None):
+        """
+        :param ip: The local address
+        :param port: The local port. 0 for any available port
+        :param accept: Create a link for every new source address
+        :param batch: The maximum number of datagrams read at once
+        :param sock: An already bound UDP socket to use instead of creating one
+        """
+        if sock is None:
+            if ":" in ip:
+                # ipv6 case
+                sock = socket.socket(socket.AF_INET6, socket.SOCK_DGRAM)
+            else:
+                sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+            sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+            sock.bind((ip, port))
+        sock.setblocking(False)
+        self.socket = sock
+        self.ip = ip
+        self.port = sock.getsockname()[1]
+        self.accept = accept
+        self.batch = batch
+        # resolved remote address to link
+        self.links = {}
+        self.default_link = None
+        self.new_links = deque()
+        self.condition = Condition()
+        self.receiving = False
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.socket, selectors.EVENT_READ, data=None)
+        self.recv_buffer = bytearray(self.MAX_DATAGRAM)
+
+    def resolve(self, ip, port):
+        """ :return: The address in the form it has as the source address of received datagrams """
+        return socket.getaddrinfo(ip, port, self.socket.family, socket.SOCK_DGRAM)[0][4][:2]
+
+    def add_link(self, link):
+        with self.condition:
+            link.address = self.resolve(link.rip, link.rport)
+            self.links[link.address] = link
+            if self.default_link is None:
+                self.default_link = link
+
+    def link(self, rip, rport):
+        """ :return: The link to a remote address. A new one is created if there is none yet """
+        with self.condition:
+            link = self.links.get(self.resolve(rip, rport))
+            if link is None:
+                link = UDPClient(self.ip, self.port, transport=self)
+                link.connect(rip, rport)
+            return link
+
+    def remove_link(self, link):
+        with self.condition:
+            link.closed = True
+            if self.links.get(link.address) is link:
+                del self.links[link.address]
+            if self.default_link is link:
+                self.default_link = next(iter(self.links.values()), None)
+            self.condition.notify_all()
+        # Wake up the thread that may be waiting on the socket for this link
+        self.socket.sendto(b"", self.socket.getsockname())
+
+    def send(self, data, address):
+        while True:
+            try:
+                sent = self.socket.sendto(data, address)
+                pcap.capture(data, (self.ip, self.port), address, "udp")
+                return sent
+            except BlockingIOError:
+                select.select([], [self.socket], [])
+
+    def receive(self, timeout=None):
+        """
+        Wait for datagrams and read all of them that are waiting, up to batch
+        :param timeout: Seconds to wait. None waits forever, 0 does not wait
+        :return: A list of (data, source address) tuples. Keep alives and empty datagrams are left out
+        """
+        if not self.sel.select(timeout):
+            return []
+        datagrams = []
+        with memoryview(self.recv_buffer) as view:
+            for i in range(self.batch):
+                try:
+                    size, address = self.socket.recvfrom_into(self.recv_buffer)
+                except BlockingIOError:
+                    break
+                except ConnectionResetError:
+                    # ICMP port unreachable for an earlier datagram (Windows)
+                    continue
+                data = bytes(view[:size])
+                if data.strip():
+                    datagrams.append((data, address[:2]))
+                    pcap.capture(data, address, (self.ip, self.port), "udp")
+        return datagrams
+
+    def dispatch(self, data, address):
+        """
+        Buffer a received datagram in the link of its source address
+        :return: The link or None if the datagram was dropped
+        """
+        link = self.links.get(address)
+        if link is None:
+            if self.accept:
+                link = self.link(*address)
+                self.new_links.append(link)
+            else:
+                link = self.default_link
+        if link is None:
+            warning("Dropped datagram from unknown address {}:{}".format(*address))
+            return None
+        link.sip_buffer.append(data)
+        return link
+
+    def wait_for(self, link, timeout=None):
+        """
+        Wait until a message for link is buffered, reading from the socket if no other thread does
+        :param link: A UDPClient of this transport
+        :param timeout: Seconds to wait. None waits forever
+        :return: True if a message is buffered, False if the link was shut down
+        :raises socket.timeout: If no message was received for link before timeout
+        """
+        deadline = None if timeout is None else time() + timeout
+        with self.condition:
+            while not link.sip_buffer:
+                if link.closed:
+                    return False
+                remaining = None if deadline is None else deadline - time()
+                if remaining is not None and remaining <= 0:
+                    raise socket.timeout("Timeout waiting for data in {}:{} from {}:{}".format(
+                        self.ip, self.port, link.rip, link.rport))
+                if self.receiving:
+                    self.condition.wait(remaining)
+                    continue
+                self.receiving = True
+                self.condition.release()
+                try:
+                    datagrams = self.receive(remaining)
+                finally:
+                    self.condition.acquire()
+                    self.receiving = False
+                for data, address in datagrams:
+                    self.dispatch(data, address)
+                self.condition.notify_all()
+            return True
+
 
 class TLSClient(TCPClient):
     def __init__(self, ip, port, certificate=None, subject_name="localhost"):
@@ -186,25 +581,20 @@ class TLSClient(TCPClient):
         self.port = port
         self.rip, self.rport = None, None
         self.server_name = subject_name
-        self.send_lock = Lock()
+        self.sip_buffer = deque()
+        self.dispatcher = None
+        self.sip_framer = SipFramer()
+        self.csta_buffer = deque()
+        self.csta_framer = CstaFramer()
+        self.init_send_queue()
         self.wait_lock = Lock()
         self.csta_wait_lock = Lock()
 
-        # PROTOCOL_TLS_CLIENT requires valid cert chain and hostname
-        if hasattr(ssl, "PROTOCOL_TLS_CLIENT"):
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLS_CLIENT)
-        elif hasattr(ssl, "PROTOCOL_TLSv1_1"):
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_1)
-        else:
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1)
+        self.certificate = certificate
+        self.context = get_tls_client_context(certificate)
 
-        if not certificate:
-            self.context.check_hostname = False
-            self.context.verify_mode = ssl.CERT_NONE
-            ssl.create_default_context()
-        else:
-            # certificate example: 'path/to/my_certificate.pem'
-            self.context.load_verify_locations(certificate)
+    def session_key(self):
+        return self.certificate, self.server_name, self.rip, self.rport
 
     def connect(self, dest_ip, dest_port):
         if ":" in self.ip:
@@ -212,10 +602,33 @@ class TLSClient(TCPClient):
             tcp_socket = socket.socket(socket.AF_INET6, socket.SOCK_STREAM, 0)
         else:
             tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        self.socket = self.context.wrap_socket(tcp_socket, server_hostname=self.server_name)
+        session = tls_sessions.get((self.certificate, self.server_name, dest_ip, dest_port))
+        self.socket = self.context.wrap_socket(tcp_socket, server_hostname=self.server_name, session=session,
+                                               do_handshake_on_connect=False)
         self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
 #        self.socket.bind((self.ip, self.port))
         #self.port = self.socket.getsockname()[1]
         self.socket.settimeout(5.0)
         self.sockfile = self.socket.makefile(mode='rb')
         super().connect(dest_ip, dest_port)
+        t0 = time()
+        self.socket.do_handshake()
+        record_handshake(time() - t0, self.socket.session_reused)
+        self.sel = selectors.DefaultSelector()
+        self.sel.register(self.socket, selectors.EVENT_READ, data=None)
+        self.save_session()
+
+    def save_session(self):
+        """ Keep the TLS session for the next connections to the same server """
+        session = self.socket.session
+        # A TLS 1.3 session can be resumed only after its ticket is received
+        if session is not None and (session.has_ticket or self.socket.version() != "TLSv1.3"):
+            tls_sessions[self.session_key()] = session
+
+    def shutdown(self):
+        # TLS 1.3 session tickets arrive after the handshake, so they may have been received by now
+        try:
+            self.save_session()
+        except (OSError, ValueError):
+            pass
+        super().shutdown()
@@ -7,7 +7,7 @@ from queue import Empty
 import socket, select
 from traceback import print_exc
 
-from common.tc_logging import debug
+from common.tc_logging import debug, wire
 import multiprocessing as mp
 from sip.SipParser import parseBytes as parseSip, buildMessage as buildSip
 
@@ -70,12 +70,17 @@ class Server(object):
 
     def consume_csta_data(self, timeout=None):
         header = self.sock.recv(4)
-        datalength = int(''.join(["%02X" % x for x in header]), base=16) - 4
-        data = b''
-        while len(data) < datalength:
-            data += self.sock.recv(datalength - len(data))
+        datalength = int.from_bytes(header, "big") - 4
+        data = bytearray(max(datalength, 0))
+        received = 0
+        with memoryview(data) as view:
+            while received < datalength:
+                count = self.sock.recv_into(view[received:])
+                if not count:
+                    break
+                received += count
         # print('message:\n{}\nsize{}\n'.format(data,datalength))
-        return header + data
+        return header + bytes(data[:received])
 
     def handle_sip_message(self, data, encoding="utf8"):
         self.update_sip_event_handling()
@@ -192,13 +197,10 @@ class TCPClient(object):
         #     data = self.out_queue.get_nowait()
         # except Empty:
         #     return
-        if type(data) == type(b''):
-            debug("Sending from port {}:\n\n".format(self.port) + data.decode("utf8", "backslashreplace").replace(
-                "\r\n", "\n"))
-            self.internal_client.sendall(data)
-        else:
-            debug("Sending from port {}:\n\n".format(self.port) + data.replace("\r\n", "\n"))
-            self.internal_client.sendall(bytes(data, encoding))
+        if type(data) != type(b''):
+            data = bytes(data, encoding)
+        self.internal_client.sendall(data)
+        wire(data, "Sending from port {}:\n\n", self.port)
 
     def waitForSipData(self, timeout=5):
         if not self.server:
@@ -226,7 +228,7 @@ class TCPClient(object):
             dbg = data[0]
         else:
             dbg = data
-        debug("Received on address {}:{}:\n\n".format(self.ip, self.port) + dbg.decode("utf8").replace("\r\n", "\n"))
+        wire(dbg, "Received on address {}:{}:\n\n", self.ip, self.port)
         return data
 
 
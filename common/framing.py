@@ -0,0 +1,214 @@
+"""\
+Purpose: Incremental framing of messages received over stream sockets
+"""
+import re
+from common.tc_logging import warning
+
+# A SIP request or status line at the start of a message
+START_LINE = re.compile(rb"[A-Za-z]+ \S+ SIP/\d\.\d\r\n|SIP/\d\.\d \d{3}[^\r\n]*\r\n")
+CONTENT_LENGTH = re.compile(rb"\r\n(?:content-length|l)[ \t]*:[ \t]*(\d+)", re.I)
+HEADER_END = b"\r\n\r\n"
+CRLF = b"\r\n"
+CSTA_HEADER_SIZE = 4
+
+
+class StreamFramer(object):
+    """
+    Receive buffer of a stream socket that is split into complete messages.
+
+    Data is received directly into a growable bytearray. Consumed messages are not removed one by one,
+    the unconsumed tail is moved to the front of the buffer only when more space is needed, so every
+    received byte is copied once into the buffer and once into the message it belongs to.
+    Subclasses implement next_frame() for their protocol.
+    """
+
+    def __init__(self, size=4096):
+        self.buffer = bytearray(size)
+        # Start of the first unconsumed byte and end of the received data in buffer
+        self.start = 0
+        self.end = 0
+
+    def __len__(self):
+        """ :return: The number of received bytes that are not part of a returned message yet """
+        return self.end - self.start
+
+    def reserve(self, size):
+        """ Make room for at least size more bytes at the end of the buffer """
+        if self.start == self.end:
+            self.start = self.end = 0
+        if len(self.buffer) - self.end >= size:
+            return
+        if self.start:
+            pending = self.end - self.start
+            self.buffer[:pending] = self.buffer[self.start:self.end]
+            self.start, self.end = 0, pending
+        missing = size - (len(self.buffer) - self.end)
+        if missing > 0:
+            self.buffer.extend(bytes(max(missing, len(self.buffer))))
+
+    def feed(self, data):
+        """
+        Add received data to the buffer
+        :param data: bytes like object
+        :return: The list of complete messages in the buffer
+        """
+        self.reserve(len(data))
+        self.buffer[self.end:self.end + len(data)] = data
+        self.end += len(data)
+        return self.frames()
+
+    def recv_from(self, sock, bufsize=4096):
+        """
+        Receive once from a socket directly into the buffer
+        :param sock: The socket to read from
+        :param bufsize: The maximum number of bytes to read
+        :return: The number of bytes read, 0 if the other side closed the connection
+        """
+        self.reserve(bufsize)
+        with memoryview(self.buffer) as view:
+            count = sock.recv_into(view[self.end:self.end + bufsize], bufsize)
+        self.received(count)
+        return count
+
+    def receive_buffer(self, size=4096):
+        """
+        The free space at the end of the buffer, to receive into without copying, eg by asyncio.BufferedProtocol.
+        Call received() with the number of bytes written before the buffer is used again.
+        :param size: The minimum free space
+        :return: A memoryview of the free space
+        """
+        self.reserve(size)
+        return memoryview(self.buffer)[self.end:]
+
+    def received(self, count):
+        """ Add count bytes written in the receive_buffer() to the received data """
+        self.end += count
+
+    def frames(self):
+        """ :return: The list of all complete messages in the buffer, as bytes """
+        frames = []
+        frame = self.next_frame()
+        while frame is not None:
+            frames.append(frame)
+            frame = self.next_frame()
+        return frames
+
+    def next_frame(self):
+        """ :return: The next complete message as bytes or None. Must be implemented by subclasses """
+        raise NotImplementedError
+
+    def take(self, length):
+        """ Consume and return the next length bytes of the buffer """
+        with memoryview(self.buffer) as view:
+            frame = bytes(view[self.start:self.start + length])
+        self.start += length
+        return frame
+
+
+class SipFramer(StreamFramer):
+    """
+    Splits a SIP byte stream into messages (RFC 3261 Section 18.3)
+
+    The state of the current message is kept between calls, so the header block is searched only once
+    for its end and its Content-Length, no matter how many segments the message arrives in.
+    CRLF keep alives between messages are skipped. Data that does not start with a SIP request or status
+    line is dropped up to the next line that does.
+    """
+
+    def __init__(self, size=4096):
+        super().__init__(size)
+        # Where to continue looking for the end of the headers, relative to start so that it stays valid when
+        # the buffer is compacted. 0 until a valid start line is found
+        self.scanned = 0
+        # Length of the current message, once its headers are complete
+        self.length = None
+
+    def next_frame(self):
+        if self.length is None and not self.read_headers():
+            return None
+        if self.end - self.start < self.length:
+            return None
+        frame = self.take(self.length)
+        self.scanned = 0
+        self.length = None
+        return frame
+
+    def read_headers(self):
+        """
+        Advance the header state of the current message with the data received so far
+        :return: True when the message length is known
+        """
+        buffer = self.buffer
+        if not self.scanned:
+            if not self.skip_to_start_line():
+                return False
+        header_end = buffer.find(HEADER_END, self.start + self.scanned, self.end)
+        if header_end < 0:
+            # Resume the search in the next call. The separator may already be partly received
+            self.scanned = max(self.scanned, self.end - self.start - len(HEADER_END) + 1)
+            return False
+        body_start = header_end + len(HEADER_END)
+        M = CONTENT_LENGTH.search(buffer, self.start, header_end)
+        if M:
+            content_length = int(M.group(1))
+        else:
+            warning("No Content-Length in SIP message from stream, assuming no body: " +
+                    repr(bytes(buffer[self.start:body_start])))
+            content_length = 0
+        self.length = body_start - self.start + content_length
+        return True
+
+    def skip_to_start_line(self):
+        """
+        Position start at a SIP start line, dropping keep alives and invalid data
+        :return: True if the buffer starts with a complete start line
+        """
+        buffer = self.buffer
+        while buffer.startswith(CRLF, self.start, self.end):
+            self.start += len(CRLF)
+        line_end = buffer.find(CRLF, self.start, self.end)
+        if line_end < 0:
+            return False
+        if START_LINE.match(buffer, self.start, line_end + len(CRLF)):
+            self.scanned = line_end - self.start
+            return True
+        M = START_LINE.search(buffer, self.start, self.end)
+        if M:
+            dropped = bytes(buffer[self.start:M.start()])
+            self.start = M.start()
+            self.scanned = buffer.find(CRLF, self.start, self.end) - self.start
+        else:
+            # Keep the last line, it may be the beginning of a start line
+            last_line = buffer.rfind(CRLF, self.start, self.end) + len(CRLF)
+            dropped = bytes(buffer[self.start:last_line])
+            self.start = last_line
+        warning("Dropped invalid data from SIP stream: " + repr(dropped))
+        return bool(M)
+
+
+class CstaFramer(StreamFramer):
+    """
+    Splits a CSTA byte stream into messages.
+    Every message starts with a 4 byte big endian length, which includes these 4 bytes.
+    """
+
+    def next_frame(self):
+        pending = self.end - self.start
+        if pending < CSTA_HEADER_SIZE:
+            return None
+        length = int.from_bytes(self.buffer[self.start:self.start + CSTA_HEADER_SIZE], "big")
+        if length < CSTA_HEADER_SIZE:
+            warning("Invalid CSTA message length {}, dropping received data: {}".format(
+                length, bytes(self.buffer[self.start:self.end])))
+            self.start = self.end
+            return None
+        if pending < length:
+            return None
+        return self.take(length)
+
+    def needed(self):
+        """ :return: The number of bytes still missing from the current message, or from its length """
+        pending = self.end - self.start
+        if pending < CSTA_HEADER_SIZE:
+            return CSTA_HEADER_SIZE - pending
+        return max(0, int.from_bytes(self.buffer[self.start:self.start + CSTA_HEADER_SIZE], "big") - pending)
@@ -0,0 +1,164 @@
+"""\
+Purpose: Capture the SIP and CSTA messages sent and received into a pcapng file
+
+Every message is written as one packet with synthetic IP and TCP or UDP headers built from the addresses of its
+link, so the file can be opened with Wireshark or given to tshark_tools.lib as any other capture.
+It is much cheaper than the text log of every message, which can be turned off by raising the log level.
+
+    import common.pcap as pcap
+    pcap.start("trace.pcapng")
+    ...
+    pcap.stop()
+"""
+import socket
+import struct
+import traceback
+from queue import SimpleQueue
+from threading import Thread, Lock
+from time import time
+
+from common.tc_logging import exception
+
+LINKTYPE_RAW = 101
+# Payload of one packet, so that the IP total length fits in 16 bits
+MAX_PAYLOAD = 65000
+
+writer = None
+writer_lock = Lock()
+
+
+def start(filename):
+    """
+    Capture all messages sent and received from now on into filename
+    :return: The PcapWriter
+    """
+    global writer
+    with writer_lock:
+        if writer is not None:
+            writer.stop()
+        writer = PcapWriter(filename)
+        writer.start()
+        return writer
+
+
+def stop():
+    """ Stop capturing and close the file """
+    global writer
+    with writer_lock:
+        if writer is not None:
+            writer.stop()
+            writer = None
+
+
+def capture(data, source, destination, transport="tcp"):
+    """
+    Capture a message, if a capture is running. Called by the links
+    :param data: The message bytes
+    :param source: (ip, port) of the sender
+    :param destination: (ip, port) of the receiver
+    :param transport: "tcp" or "udp"
+    """
+    if writer is not None:
+        writer.queue.put((time(), data, source, destination, transport))
+
+
+class PcapWriter(object):
+    """
+    Writes the captured messages into a pcapng file in a background thread.
+    The file is flushed every time there are no more messages waiting
+    """
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.queue = SimpleQueue()
+        self.thread = None
+        # Next TCP sequence number of each (source, destination), so that Wireshark reassembles the streams
+        self.sequence = {}
+        self.addresses = {}
+
+    def start(self):
+        self.thread = Thread(target=self.loop, name="PcapWriter", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.queue.put(None)
+        self.thread.join()
+
+    def loop(self):
+        with open(self.filename, "wb", buffering=1 << 20) as f:
+            f.write(self.section_header() + self.interface_description())
+            while True:
+                item = self.queue.get()
+                if item is None:
+                    break
+                try:
+                    f.write(self.packets(*item))
+                except:
+                    exception(traceback.format_exc())
+                if self.queue.empty():
+                    f.flush()
+
+    @staticmethod
+    def section_header():
+        return struct.pack("<IIIHHqI", 0x0A0D0D0A, 28, 0x1A2B3C4D, 1, 0, -1, 28)
+
+    @staticmethod
+    def interface_description():
+        return struct.pack("<IIHHII", 1, 20, LINKTYPE_RAW, 0, 0, 20)
+
+    @staticmethod
+    def enhanced_packet(timestamp, packet):
+        microseconds = int(timestamp * 1000000)
+        padding = b"\0" * (-len(packet) % 4)
+        length = 32 + len(packet) + len(padding)
+        return b"".join((struct.pack("<IIIIIII", 6, length, 0, microseconds >> 32, microseconds & 0xFFFFFFFF,
+                                     len(packet), len(packet)),
+                         packet, padding, struct.pack("<I", length)))
+
+    def address(self, ip):
+        """ :return: The packed IPv4 or IPv6 address of ip, which can also be a host name """
+        if ip not in self.addresses:
+            try:
+                packed = socket.inet_pton(socket.AF_INET6 if ":" in ip else socket.AF_INET, ip)
+            except (OSError, TypeError):
+                try:
+                    packed = socket.inet_aton(socket.gethostbyname(ip))
+                except (OSError, TypeError, UnicodeError):
+                    packed = bytes(4)
+            self.addresses[ip] = packed
+        return self.addresses[ip]
+
+    def packets(self, timestamp, data, source, destination, transport):
+        """ :return: The Enhanced Packet Blocks of one message """
+        src, dst = self.address(source[0]), self.address(destination[0])
+        if len(src) != len(dst):
+            # IPv4 with IPv6, map the IPv4 one
+            src, dst = [a if len(a) == 16 else bytes(10) + b"\xff\xff" + a for a in (src, dst)]
+        sport, dport = source[1] or 0, destination[1] or 0
+        data = bytes(data)
+        blocks = []
+        for offset in range(0, max(len(data), 1), MAX_PAYLOAD):
+            payload = data[offset:offset + MAX_PAYLOAD]
+            if transport == "udp":
+                segment = struct.pack("!HHHH", sport, dport, 8 + len(payload), 0) + payload
+                protocol = 17
+            else:
+                flow, reverse = (source, destination), (destination, source)
+                seq = self.sequence.get(flow, 1)
+                self.sequence[flow] = (seq + len(payload)) & 0xFFFFFFFF
+                # PSH, ACK
+                segment = struct.pack("!HHIIBBHHH", sport, dport, seq, self.sequence.get(reverse, 1),
+                                      5 << 4, 0x18, 65535, 0, 0) + payload
+                protocol = 6
+            blocks.append(self.enhanced_packet(timestamp, self.ip_header(src, dst, protocol, len(segment)) + segment))
+        return b"".join(blocks)
+
+    @staticmethod
+    def ip_header(src, dst, protocol, length):
+        if len(src) == 16:
+            return struct.pack("!IHBB16s16s", 6 << 28, length, protocol, 64, src, dst)
+        header = struct.pack("!BBHHHBBH4s4s", 0x45, 0, 20 + length, 0, 0x4000, 64, protocol, 0, src, dst)
+        checksum = sum(struct.unpack("!10H", header))
+        checksum = (checksum & 0xFFFF) + (checksum >> 16)
+        checksum = ~((checksum & 0xFFFF) + (checksum >> 16)) & 0xFFFF
+        return header[:10] + struct.pack("!H", checksum) + header[12:]
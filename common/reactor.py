@@ -0,0 +1,186 @@
+"""\
+Purpose: One I/O thread for the sockets of all the links in the process
+"""
+import selectors
+import socket
+import ssl
+import traceback
+from collections import deque
+from functools import partial
+from threading import Thread, Lock
+
+from common.client import UDPClient
+from common.tc_logging import debug, warning, exception
+
+enabled = False
+shared = None
+shared_lock = Lock()
+
+
+def enable(enable_reactor=True):
+    """
+    Receive on the links of all SipEndpoints and CstaApplications connected from now on in one shared reactor
+    thread, instead of one wait thread per endpoint
+    """
+    global enabled
+    enabled = enable_reactor
+
+
+def is_enabled():
+    return enabled
+
+
+def get_reactor():
+    """ :return: The shared Reactor of the process, started on first use """
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = Reactor()
+            shared.start()
+        return shared
+
+
+class Reactor(object):
+    """
+    A thread that waits on the sockets of many links with one selector.
+
+    Received data is framed with the framers of each link and every complete message is given to the handler of
+    its link. Handlers run in the reactor thread so they must not block, eg they only buffer the message.
+    A handler is called with None when its connection is closed.
+    The sockets of stream links are non blocking while they are registered, so that a socket that is readable
+    without application data, eg after TLS session tickets, does not block the thread of all the links.
+    """
+
+    def __init__(self):
+        self.sel = selectors.DefaultSelector()
+        # Registrations are changed only in the reactor thread. Other threads queue them and wake the selector up
+        self.calls = deque()
+        self.wakeup_in, self.wakeup_out = socket.socketpair()
+        self.wakeup_in.setblocking(False)
+        self.sel.register(self.wakeup_in, selectors.EVENT_READ, data=None)
+        # UDPTransport to the handlers of its links
+        self.transports = {}
+        # Stream link to the timeout of its socket before it was made non blocking
+        self.timeouts = {}
+        self.thread = None
+        self.running = False
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.loop, name="Reactor", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        self.call(setattr, self, "running", False)
+        if self.thread:
+            self.thread.join()
+
+    def call(self, function, *args):
+        """ Run function in the reactor thread """
+        self.calls.append((function, args))
+        self.wakeup_out.send(b"\0")
+
+    def register(self, link, handler, protocol="sip"):
+        """
+        Receive on link in the reactor thread
+        :param link: A TCPClient, TLSClient or UDPClient
+        :param handler: Called with the bytes of every message received on link
+        :param protocol: "sip" or "csta"
+        """
+        self.call(self._register, link, handler, protocol)
+
+    def unregister(self, link):
+        self.call(self._unregister, link)
+
+    def loop(self):
+        while self.running:
+            events = self.sel.select()
+            while self.calls:
+                function, args = self.calls.popleft()
+                try:
+                    function(*args)
+                except:
+                    exception(traceback.format_exc())
+            for key, mask in events:
+                if key.data is None:
+                    try:
+                        self.wakeup_in.recv(4096)
+                    except BlockingIOError:
+                        pass
+                elif self.sel.get_map().get(key.fileobj) is key:
+                    # Not unregistered by one of the calls above
+                    key.data()
+
+    def _register(self, link, handler, protocol):
+        if isinstance(link, UDPClient):
+            transport = link.transport
+            if transport not in self.transports:
+                self.transports[transport] = {}
+                self.sel.register(transport.socket, selectors.EVENT_READ,
+                                  data=partial(self._read_datagrams, transport))
+            self.transports[transport][link] = handler
+            buffer = link.sip_buffer
+        else:
+            if protocol == "csta":
+                read, buffer = link.read_csta, link.csta_buffer
+            else:
+                read, buffer = link.read_sip, link.sip_buffer
+            self.timeouts[link] = link.socket.gettimeout()
+            link.socket.setblocking(False)
+            self.sel.register(link.socket, selectors.EVENT_READ, data=partial(self._read_stream, link, read, handler))
+        # Messages received before the registration
+        while buffer:
+            self.deliver(handler, buffer.popleft())
+
+    def _unregister(self, link):
+        if isinstance(link, UDPClient):
+            handlers = self.transports.get(link.transport, {})
+            handlers.pop(link, None)
+            if not handlers and link.transport in self.transports:
+                del self.transports[link.transport]
+                self.sel.unregister(link.transport.socket)
+        else:
+            try:
+                self.sel.unregister(link.socket)
+            except KeyError:
+                pass
+            if link in self.timeouts and link.socket.fileno() != -1:
+                link.socket.settimeout(self.timeouts.pop(link))
+            self.timeouts.pop(link, None)
+
+    def _read_stream(self, link, read, handler):
+        try:
+            messages = read()
+        except (BlockingIOError, ssl.SSLWantReadError):
+            # No application data yet
+            return
+        except OSError as e:
+            debug("Error reading from {}:{}: {}".format(link.rip, link.rport, e))
+            messages = None
+        if messages is None:
+            self._unregister(link)
+            self.deliver(handler, None)
+            return
+        for message in messages:
+            self.deliver(handler, message)
+
+    def _read_datagrams(self, transport):
+        handlers = self.transports[transport]
+        for data, address in transport.receive(0):
+            link = transport.dispatch(data, address)
+            handler = handlers.get(link)
+            if handler is None:
+                # The link is not served by the reactor, wake up its waiters
+                with transport.condition:
+                    transport.condition.notify_all()
+                continue
+            while link.sip_buffer:
+                self.deliver(handler, link.sip_buffer.popleft())
+
+    @staticmethod
+    def deliver(handler, message):
+        try:
+            handler(message)
+        except:
+            warning("Exception in reactor handler {}".format(handler))
+            exception(traceback.format_exc())
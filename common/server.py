@@ -2,6 +2,7 @@
 Purpose: Network connection facilities - mock servers
 Initial Version: Costas Skarakis 16/2/2020
 """
+import select
 import selectors
 import socket
 import threading
@@ -9,27 +10,215 @@ import time
 import traceback
 import types
 import ssl
+from collections import deque
 from copy import copy
 
 import common.client as my_clients
 from common import util
-from common.tc_logging import debug, warning
+from common.tc_logging import debug, warning, wire
 from sip.SipParser import parseBytes as parseSip, buildMessage
 from csta.CstaApplication import CstaApplication
 from csta.CstaParser import parseBytes
 from csta.CstaUser import CstaUser
+from sip.SipDialogs import dialog_key
 from sip.SipEndpoint import SipEndpoint
 
 # With help from https://github.com/realpython/materials/blob/master/python-sockets-tutorial/multiconn-server.py
 from sip.messages import message
 
 
+class LinkPool(object):
+    """
+    The live stream links of a server by remote address.
+
+    New requests to an address reuse the connection accepted from it or opened to it before. A new connection is
+    opened only if there is none or the existing one is closed. Connections opened by the pool are closed after
+    idle_timeout seconds without use. Each address has its own lock, so connecting to one address does not delay
+    the others.
+    """
+
+    def __init__(self, connect, idle_timeout=300.0):
+        """
+        :param connect: Called with (ip, port) to open a new link
+        :param idle_timeout: Seconds a link opened by the pool is kept without use
+        """
+        self.connect = connect
+        self.idle_timeout = idle_timeout
+        self.links = {}
+        self.last_used = {}
+        # The links opened by the pool, the only ones closed when idle
+        self.outbound = set()
+        self.locks = {}
+        self.lock = threading.Lock()
+
+    @staticmethod
+    def key(ip, port):
+        try:
+            return socket.getaddrinfo(ip, port, type=socket.SOCK_STREAM)[0][4][:2]
+        except socket.gaierror:
+            return ip, port
+
+    def add(self, link, outbound=False):
+        key = self.key(link.rip, link.rport)
+        with self.lock:
+            self.links[key] = link
+            self.last_used[key] = time.time()
+            if outbound:
+                self.outbound.add(key)
+
+    def remove(self, link):
+        key = self.key(link.rip, link.rport)
+        with self.lock:
+            if self.links.get(key) is link:
+                del self.links[key]
+                self.last_used.pop(key, None)
+                self.outbound.discard(key)
+
+    def get(self, ip, port):
+        """ :return: A live link to (ip, port). A new one is opened if needed """
+        key = self.key(ip, port)
+        with self.lock:
+            address_lock = self.locks.setdefault(key, threading.Lock())
+        with address_lock:
+            with self.lock:
+                # Refreshed under the same lock as idle_links, so a link is not closed while it is handed out
+                link = self.links.get(key)
+                if link is not None:
+                    self.last_used[key] = time.time()
+            if link is not None and not self.is_alive(link):
+                debug("Connection to {}:{} is closed. Reconnecting".format(ip, port))
+                self.remove(link)
+                link = None
+            if link is None:
+                link = self.connect(ip, port)
+                self.add(link, outbound=True)
+            return link
+
+    @staticmethod
+    def is_alive(link):
+        """ Health check. A link is alive if its socket is open and the other side has not closed it """
+        sock = link.socket
+        if sock.fileno() < 0:
+            return False
+        try:
+            readable = select.select([sock], [], [], 0)[0]
+            if readable and not isinstance(sock, ssl.SSLSocket):
+                return sock.recv(1, socket.MSG_PEEK | getattr(socket, "MSG_DONTWAIT", 0)) != b""
+        except BlockingIOError:
+            pass
+        except (OSError, ValueError):
+            return False
+        return True
+
+    def idle_links(self):
+        """ Remove the links opened by the pool that have not been used for idle_timeout seconds
+        :return: The removed links, to be closed by the caller
+        """
+        deadline = time.time() - self.idle_timeout
+        with self.lock:
+            idle = [key for key in self.outbound if self.last_used[key] < deadline]
+            links = [self.links.pop(key) for key in idle]
+            for key in idle:
+                self.outbound.discard(key)
+                del self.last_used[key]
+        return links
+
+
+class DialogLinks(object):
+    """
+    The links of a server by dialog and by remote address.
+
+    Used like the list of (dialog, link) it replaces, but a dialog or link already known is not added again, so it
+    does not grow with every received message. The dialogs are removed when the server endpoint removes them.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        # Dialog key to the first (dialog, link) of the dialog
+        self.dialogs = {}
+        # "ip:port" to the first link to the address
+        self.addresses = {}
+        # Link to the dialog keys of the link
+        self.link_dialogs = {}
+
+    def __iter__(self):
+        with self.lock:
+            entries = list(self.dialogs.values())
+            entries += [(None, link) for link in self.link_dialogs if not self.link_dialogs[link]]
+        return iter(entries)
+
+    def __len__(self):
+        return len(self.link_dialogs)
+
+    def __repr__(self):
+        return repr(list(self))
+
+    def append(self, entry):
+        """ :param entry: (dialog, link) or (None, link) """
+        dialog, link = entry
+        with self.lock:
+            keys = self.link_dialogs.setdefault(link, set())
+            self.addresses.setdefault("{}:{}".format(link.rip, link.rport), link)
+            if dialog:
+                key = dialog_key(dialog)
+                if key not in self.dialogs:
+                    self.dialogs[key] = entry
+                    keys.add(key)
+
+    def get_dialog_link(self, dialog, get_complete_dialog):
+        """
+        :param get_complete_dialog: Function that returns the complete dialog of an early one
+        :return: The link of dialog, or of the early dialog that became dialog. None if unknown
+        """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        with self.lock:
+            entry = self.dialogs.get((call_id, from_tag, to_tag))
+            early_entry = self.dialogs.get((call_id, from_tag, ""))
+        if entry is not None:
+            return entry[1]
+        if early_entry is not None and get_complete_dialog(early_entry[0]) == dialog:
+            return early_entry[1]
+        return None
+
+    def get_address_link(self, address):
+        """ :param address: "ip:port" """
+        return self.addresses.get(address)
+
+    def remove_link(self, sock):
+        """ Forget the links of a closed socket """
+        with self.lock:
+            for link in [link for link in self.link_dialogs if link.socket == sock]:
+                for key in self.link_dialogs.pop(link):
+                    self.dialogs.pop(key, None)
+                address = "{}:{}".format(link.rip, link.rport)
+                if self.addresses.get(address) is link:
+                    del self.addresses[address]
+
+    def remove_dialog(self, dialog):
+        """ Forget a dialog, in both directions and without the to_tag """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        with self.lock:
+            for key in (call_id, from_tag, to_tag), (call_id, to_tag, from_tag), (call_id, from_tag, ""), \
+                    (call_id, to_tag, ""):
+                entry = self.dialogs.pop(key, None)
+                if entry is not None:
+                    self.link_dialogs.get(entry[1], set()).discard(key)
+
+    def statistics(self):
+        with self.lock:
+            return {"Links": len(self.link_dialogs), "Dialog Links": len(self.dialogs)}
+
+
 class SipServer:
     """
     A simple server to send and receive SIP Messages
     """
 
-    def __init__(self, ip, port, protocol="tcp", certificate=None):
+    def __init__(self, ip, port, protocol="tcp", certificate=None, key=None):
+        """
+        :param certificate: For TLS, the certificate chain of the server, eg 'path/to/certchain.pem'
+        :param key: For TLS, the private key of the server. If None it must be included in certificate
+        """
         self.ip = ip
         self.port = port
         self.protocol = protocol
@@ -41,13 +230,11 @@ class SipServer:
         elif protocol in ("udp", "UDP"):
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         elif protocol in ("tls", "TLS"):
-            tcp_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-            # for MTLS this might be needed
-            self.context = ssl.SSLContext(ssl.PROTOCOL_TLSv1_1)
-            self.context.load_verify_locations(certificate)
-            self.socket = self.context.wrap_socket(tcp_socket, server_hostname='localhost')
-
-            # context.load_cert_chain('/path/to/certchain.pem', '/path/to/private.key')
+            # Accepted connections are wrapped, see accept_wrapper
+            self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            self.context = my_clients.tls_server_context(certificate, key)
+        # The shared socket of all UDP links, see serve_forever
+        self.transport = None
         self.server_thread = None
         self.sip_endpoint = SipEndpoint("PythonSipServer")
         self.handlers = {}
@@ -57,8 +244,16 @@ class SipServer:
         self.buffers = {}
         self.registered_addresses = {}
         self.active_calls = []
-        self.links = []
+        self.links = DialogLinks()
+        # Links by remote address, used by send_new
+        self.pool = LinkPool(self.connect_link)
+        # Connections opened by send_new in other threads, registered by the server loop, see connect_link
+        self.new_connections = deque()
+        self.wakeup_reader, self.wakeup_writer = socket.socketpair()
+        self.wakeup_reader.setblocking(False)
         self.register_links = {}
+        # Link to the (SipEndpoint.for_link view, lock) used to send on it. Links are sent on concurrently
+        self.link_endpoints = {}
         self.wait_for_message = self.sip_endpoint.wait_for_message
         self.wait_for_messages = self.sip_endpoint.wait_for_messages
         self.set_dialog = self.sip_endpoint.set_dialog
@@ -66,65 +261,154 @@ class SipServer:
         self.set_transaction = self.sip_endpoint.set_transaction
         self.on("NOTIFY", self.notify_ok)
         self.on("OPTIONS", self.options_ok)
+        # Guards link_endpoints only
         self.lock = threading.Lock()
+        # Links of removed dialogs are not needed anymore
+        self.sip_endpoint.dialogs.listeners.append(self.remove_dialog)
 
     def get_dialog_link(self, dialog):
-        for known_dialog, link in self.links:
-            if known_dialog and (
-                    known_dialog == dialog or self.sip_endpoint.get_complete_dialog(known_dialog) == dialog):
-                return link
-        debug("No link found for dialog {}.\nAvailable dialogs and corresponding links:\n{}".format(dialog, self.links))
+        link = self.links.get_dialog_link(dialog, self.sip_endpoint.get_complete_dialog)
+        if link is None:
+            debug("No link found for dialog {}.\nAvailable dialogs and corresponding links:\n{}".format(dialog,
+                                                                                                      self.links))
+        return link
 
     def get_address_link(self, address):
-        for known_dialog, link in self.links:
-            if "{}:{}".format(link.rip, link.rport) == address:
-                return link
-        debug(
-            "No link found for address {}.\nAvailable dialogs and corresponding links:\n{}".format(address, self.links))
+        link = self.links.get_address_link(address)
+        if link is None:
+            debug("No link found for address {}.\nAvailable dialogs and corresponding links:\n{}".format(address,
+                                                                                                       self.links))
+        return link
 
     def remove_address_link(self, sock):
-        rm_links = []
-        for link in self.links:
-            if link[1].socket == sock:
-                rm_links.append(link)
-        for link in rm_links:
-            self.links.remove(link)
+        self.links.remove_link(sock)
+        with self.lock:
+            for link in [link for link in self.link_endpoints if link.socket == sock]:
+                del self.link_endpoints[link]
+
+    def link_endpoint(self, link):
+        """ :return: The SipEndpoint that sends on link and the lock that serializes the sends on it """
+        with self.lock:
+            entry = self.link_endpoints.get(link)
+            if entry is None:
+                entry = self.link_endpoints[link] = (self.sip_endpoint.for_link(link), threading.Lock())
+            return entry
 
     def remove_dialog(self, dialog):
-        rm_links = []
-        for link in self.links:
-            if link[0] == dialog:
-                rm_links.append(link)
-        for link in rm_links:
-            self.links.remove(link)
+        self.links.remove_dialog(dialog)
+
+    def get_statistics(self):
+        """ :return: The live counts of the links, connections, dialogs and buffered messages of the server """
+        statistics = self.sip_endpoint.get_statistics()
+        statistics.update(self.links.statistics())
+        statistics["Connections"] = len(self.connections)
+        statistics["Handler Buffered Messages"] = sum(len(buffer) for buffer in self.buffers.values())
+        return statistics
 
     def send(self, dialog, *args, **kwargs):
-        with self.lock:
-            self.sip_endpoint.use_link(self.get_dialog_link(dialog))
-            return self.sip_endpoint.send(dialog=dialog, *args, **kwargs)
+        endpoint, lock = self.link_endpoint(self.get_dialog_link(dialog))
+        with lock:
+            return endpoint.send(dialog=dialog, *args, **kwargs)
 
     def send_new(self, address, *args, **kwargs):
-        with self.lock:
+        rip, rport = address.split(":")
+        if self.transport:
+            link = self.transport.link(rip, int(rport))
+        else:
+            link = self.pool.get(rip, int(rport))
+        self.links.append((None, link))
+        endpoint, lock = self.link_endpoint(link)
+        with lock:
+            return endpoint.send_new(*args, **kwargs)
+
+    def connect_link(self, rip, rport):
+        """
+        Open a new connection for send_new. It is read by the server loop like the accepted ones, so it is non
+        blocking like them and the loop registers it, see register_new_connections
+        """
+        if self.protocol in ("tls", "TLS"):
+            link = my_clients.TLSClient(ip=self.ip, port=0)
+        else:
             link = my_clients.TCPClient(ip=self.ip, port=0)
-            rip, rport = address.split(":")
-            link.connect(rip, int(rport))
-            self.sip_endpoint.use_link(link)
-            return self.sip_endpoint.send_new(*args, **kwargs)
+        link.connect(rip, rport)
+        link.socket.setblocking(False)
+        data = types.SimpleNamespace(addr=(rip, rport), inb=b"", outb=b"", link=link, handshake=None)
+        self.new_connections.append((link.socket, data))
+        self.wakeup_writer.send(b"\0")
+        return link
+
+    def register_new_connections(self):
+        """ Start reading the connections opened by connect_link, in the server loop that selects on them """
+        try:
+            while self.wakeup_reader.recv(4096):
+                pass
+        except BlockingIOError:
+            pass
+        while self.new_connections:
+            sock, data = self.new_connections.popleft()
+            self.connections.append(sock)
+            self.sel.register(sock, selectors.EVENT_READ, data=data)
+
+    def close_idle_links(self):
+        """ Close the connections opened by send_new that have not been used for a while """
+        for link in self.pool.idle_links():
+            debug("Closing idle connection to {}:{}".format(link.rip, link.rport))
+            self.close_connection(link.socket)
+
+    def close_connection(self, sock):
+        self.sel.unregister(sock)
+        self.connections.remove(sock)
+        self.remove_address_link(sock)
+        sock.close()
 
     def reply_to(self, inmessage, *args, **kwargs):
-        with self.lock:
-            self.sip_endpoint.use_link(self.get_dialog_link(inmessage.get_dialog()))
-            return self.sip_endpoint.send_in_ctx_of(inmessage, *args, **kwargs)
+        endpoint, lock = self.link_endpoint(self.get_dialog_link(inmessage.get_dialog()))
+        with lock:
+            return endpoint.send_in_ctx_of(inmessage, *args, **kwargs)
 
     def accept_wrapper(self, sock):
-        conn, addr = sock.accept()  # Should be ready to read
-        print("accepted connection from", addr)
-        conn.setblocking(False)
-        data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"")
-        events = selectors.EVENT_READ  # | selectors.EVENT_WRITE
-        self.connections.append(conn)
-        self.sel.register(conn, events, data=data)
-        self.make_client(conn, addr)
+        """ Accept all the connections waiting """
+        while True:
+            try:
+                conn, addr = sock.accept()  # Should be ready to read
+            except BlockingIOError:
+                return
+            debug("accepted connection from {}:{}".format(*addr[:2]))
+            conn.setblocking(False)
+            data = types.SimpleNamespace(addr=addr, inb=b"", outb=b"", link=None, handshake=None)
+            events = selectors.EVENT_READ  # | selectors.EVENT_WRITE
+            if self.protocol in ("tls", "TLS"):
+                # The handshake is done by the selector loop, so that slow clients don't block the rest
+                conn = self.context.wrap_socket(conn, server_side=True, do_handshake_on_connect=False)
+                data.handshake = time.time()
+            self.connections.append(conn)
+            self.sel.register(conn, events, data=data)
+            if data.handshake is None:
+                data.link = self.make_client(conn, addr)
+
+    def continue_handshake(self, key):
+        """ Advance the TLS handshake of an accepted connection as far as the data received so far allows """
+        conn, data = key.fileobj, key.data
+        try:
+            conn.do_handshake()
+        except ssl.SSLWantReadError:
+            self.sel.modify(conn, selectors.EVENT_READ, data=data)
+            return
+        except ssl.SSLWantWriteError:
+            self.sel.modify(conn, selectors.EVENT_WRITE, data=data)
+            return
+        except OSError as e:
+            debug("TLS handshake with {}:{} failed: {}".format(data.addr[0], data.addr[1], e))
+            self.sel.unregister(conn)
+            self.connections.remove(conn)
+            conn.close()
+            return
+        my_clients.record_handshake(time.time() - data.handshake, conn.session_reused)
+        data.handshake = None
+        self.sel.modify(conn, selectors.EVENT_READ, data=data)
+        data.link = self.make_client(conn, data.addr)
+        # Messages sent with the end of the handshake are already read from the socket
+        self.service_connection(self.sel.get_key(conn), selectors.EVENT_READ)
 
     def make_client(self, sock, addr):
         local_ip, local_port = sock.getsockname()
@@ -132,38 +416,47 @@ class SipServer:
         if self.protocol in ("tcp", "TCP"):
             client = my_clients.TCPClient(local_ip, local_port)
         elif self.protocol in ("udp", "UDP"):
-            client = my_clients.UDPClient(local_ip, local_port)
+            client = self.transport.link(*addr)
         elif self.protocol in ("tls", "TLS"):
             client = my_clients.TLSClient(local_ip, local_port, None)
         client.rip = addr[0]
         client.rport = addr[1]
+        if not self.transport:
+            client.use_socket(sock)
+            #        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
         self.sip_endpoint.use_link(client)
-        self.sip_endpoint.link.socket = sock
-        #        self.socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
-        self.sip_endpoint.link.sockfile = sock.makefile(mode='rb')
         self.links.append((None, client))
+        if not self.transport:
+            self.pool.add(client)
         # self.links.append(("{}:{}".format(*addr), client))
         return client
 
     def serve_forever(self):
         self.socket.bind((self.ip, self.port))
         if not self.protocol.upper() == "UDP":
-            self.socket.listen()
+            self.socket.listen(socket.SOMAXCONN)
         else:
-            self.make_client(self.socket, (self.ip, self.port))
+            # Datagrams are given to a link per source address, like connections accepted in TCP
+            self.transport = my_clients.UDPTransport(self.ip, self.port, accept=True, sock=self.socket)
         self.port = self.socket.getsockname()[1]
         print("listening on", (self.ip, self.port))
         self.socket.setblocking(False)
         self.sel.register(self.socket, selectors.EVENT_READ, data=None)
+        self.sel.register(self.wakeup_reader, selectors.EVENT_READ, data=None)
         self.continue_serving = True
         while self.continue_serving:
             try:
-                events = self.sel.select(timeout=60)
+                events = self.sel.select(timeout=1)
                 for key, mask in events:
-                    if key.data is None and self.protocol.upper() != "UDP":
+                    if key.fileobj is self.wakeup_reader:
+                        self.register_new_connections()
+                    elif key.data is None and self.transport:
+                        self.service_datagrams()
+                    elif key.data is None:
                         self.accept_wrapper(key.fileobj)
                     else:
                         self.service_connection(key, mask)
+                self.close_idle_links()
             except socket.timeout:
                 print("timeout")
                 traceback.print_exc()
@@ -180,6 +473,7 @@ class SipServer:
                 self.sel.unregister(key.fileobj)
 
         self.sel.unregister(self.socket)
+        self.sel.unregister(self.wakeup_reader)
         # self.socket.shutdown(socket.SHUT_RDWR)
         self.socket.close()
         self.sel.close()
@@ -256,28 +550,29 @@ class SipServer:
     def service_connection(self, key, mask):
         sock = key.fileobj
         data = key.data
-        address = "{}:{}".format(*data.addr)
+        if data.handshake is not None:
+            self.continue_handshake(key)
+            return
         if mask & selectors.EVENT_READ:
+            link = data.link
+            # Read only what is waiting, a partial message is completed by the next reads
             try:
-                link = self.get_address_link(address)
-                inbytes = self.sip_endpoint.link.waitForSipData(timeout=5.0, client=link)
-                if inbytes is None:
-                    self.sip_endpoint.link.socket.close()
-                    self.sel.unregister(self.sip_endpoint.link.socket)
-                    return
-                inmessage = parseSip(inbytes)
-                in_dialog = inmessage.get_dialog()
-                if not in_dialog["to_tag"] and {"Call-ID": in_dialog["Call-ID"],
-                                                "from_tag": in_dialog["from_tag"]} in self.sip_endpoint.dialogs:
-                    self.sip_endpoint.dialogs.append(in_dialog)
-                self.links.append((in_dialog, link))
-                if inmessage.get_status_or_method() in self.handlers:
-                    self.events[inmessage.get_status_or_method()].set()
-                    self.buffers[inmessage.get_status_or_method()].append(inmessage)
-                else:
-                    self.sip_endpoint.message_buffer.append(inmessage)
-            except UnicodeDecodeError:
-                debug("Ignoring malformed data")
+                messages = link.read_sip()
+            except (BlockingIOError, ssl.SSLWantReadError):
+                return
+            except OSError as e:
+                debug("Error reading from {}:{}: {}".format(data.addr[0], data.addr[1], e))
+                messages = None
+            if messages is None:
+                self.pool.remove(link)
+                self.close_connection(sock)
+                return
+            for inbytes in messages:
+                wire(inbytes, "Received on port {}:\n\n", link.port)
+                try:
+                    self.handle_incoming(inbytes, link)
+                except UnicodeDecodeError:
+                    debug("Ignoring malformed data")
         # if mask & selectors.EVENT_WRITE:
         #     # print("ready to write")
         #     if data.outb:self.events['MonitorStart']
@@ -285,6 +580,30 @@ class SipServer:
         #         sent = sock.send(data.outb)  # Should be ready to write
         #         data.outb = data.outb[sent:]
 
+    def service_datagrams(self):
+        """ Handle all the datagrams waiting in the UDP socket """
+        for inbytes, address in self.transport.receive(0):
+            link = self.transport.links.get(address)
+            if link is None:
+                link = self.make_client(self.socket, address)
+            try:
+                self.handle_incoming(inbytes, link)
+            except (UnicodeDecodeError, ValueError):
+                debug("Ignoring malformed data from {}:{}".format(*address))
+
+    def handle_incoming(self, inbytes, link):
+        """ Buffer a received message for its handler or for the wait_for_message functions """
+        inmessage = parseSip(inbytes, lazy=True)
+        if not self.sip_endpoint.transactions.received(inmessage, link):
+            return
+        in_dialog = inmessage.get_dialog()
+        self.links.append((in_dialog, link))
+        if inmessage.get_status_or_method() in self.handlers:
+            self.events[inmessage.get_status_or_method()].set()
+            self.buffers[inmessage.get_status_or_method()].append(inmessage)
+        else:
+            self.sip_endpoint.message_buffer.add(inmessage)
+
     def is_registered(self, user):
         return user.split("@")[0] in self.registered_addresses
 
@@ -307,7 +626,7 @@ class SipServer:
         notify_response = buildMessage(message["200_OK_Notify"])
         notify_response.make_response_to(inmessage)
         notify_response["Contact"] = inmessage["Contact"]
-        self.reply_to(inmessage, notify_response.contents())
+        self.reply_to(inmessage, notify_response)
 
 
 class CstaServer(SipServer):
@@ -397,23 +716,28 @@ class CstaServer(SipServer):
         # sock = key.fileobj
         # data = key.data
         if mask & selectors.EVENT_READ:
-            try:
-                inbytes = self.csta_endpoint.link.waitForCstaData(timeout=5.0)
-                if inbytes is None:
-                    self.csta_endpoint.link.socket.close()
-                    self.sel.unregister(self.csta_endpoint.link.socket)
-                    return
-                inmessage = parseBytes(inbytes)
-                if inmessage.event in self.handlers:
-                    self.events[inmessage.event].set()
-                    self.buffers[inmessage.event].append(inmessage)
-                elif inmessage.event == "SystemStatusResponse":
-                    # TODO: Ignoring incoming SystemStatusResponse for now
-                    return
-                else:
-                    self.csta_endpoint.message_buffer.append(inmessage)
-            except UnicodeDecodeError:
-                debug("Ignoring malformed data")
+            link = self.csta_endpoint.link
+            # Handle every message of the read, the socket will not be readable again for the ones already buffered
+            while True:
+                try:
+                    inbytes = link.waitForCstaData(timeout=5.0)
+                    if inbytes is None:
+                        link.socket.close()
+                        self.sel.unregister(link.socket)
+                        return
+                    inmessage = parseBytes(inbytes)
+                    if inmessage.event in self.handlers:
+                        self.events[inmessage.event].set()
+                        self.buffers[inmessage.event].append(inmessage)
+                    elif inmessage.event == "SystemStatusResponse":
+                        # TODO: Ignoring incoming SystemStatusResponse for now
+                        pass
+                    else:
+                        self.csta_endpoint.message_buffer.append(inmessage)
+                except UnicodeDecodeError:
+                    debug("Ignoring malformed data")
+                if not link.csta_buffer:
+                    break
         # if mask & selectors.EVENT_WRITE:
         #     # print("ready to write")
         #     if data.outb:self.events['MonitorStart']
@@ -2,8 +2,10 @@
 Purpose: Testcase Logging
 Initial Version: Costas Skarakis 11/11/2018
 """
+import atexit
 import logging.config
 import logging.handlers
+import queue
 
 LOG_CONFG = {
     'version': 1,
@@ -36,7 +38,65 @@ LOG_CONFG = {
     }
 }
 
+
+class DeferredQueueHandler(logging.handlers.QueueHandler):
+    """
+    Hands records to the log writer thread unformatted.
+    Records never leave the process, so formatting, eg of WireData, can be left to the writer thread
+    """
+
+    def prepare(self, record):
+        return record
+
+
+class WireData(object):
+    """ A message sent or received. Decoded and formatted only when the log record is written """
+    __slots__ = ("header", "args", "data")
+
+    def __init__(self, data, header, *args):
+        self.data = data
+        self.header = header
+        self.args = args
+
+    def __str__(self):
+        data = self.data
+        if not isinstance(data, str):
+            data = bytes(data).decode("utf8", "backslashreplace")
+        return self.header.format(*self.args) + data.replace("\r\n", "\n")
+
+
+def start_log_writer(handler_names=("logfile",)):
+    """
+    Move the given handlers of the root logger to a background thread, so that the threads logging don't wait for
+    the file I/O
+    :return: The logging.handlers.QueueListener that runs the handlers
+    """
+    root = logging.getLogger()
+    handlers = [h for h in root.handlers if h.get_name() in handler_names]
+    records = queue.SimpleQueue()
+    for handler in handlers:
+        root.removeHandler(handler)
+    root.addHandler(DeferredQueueHandler(records))
+    listener = logging.handlers.QueueListener(records, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
 logging.config.dictConfig(LOG_CONFG)
+writer = start_log_writer()
 logger = logging.getLogger(__name__)
 debug, info, warning, error, critical, exception = \
     logger.debug, logger.info, logger.warning, logger.error, logger.critical, logger.exception
+
+
+def wire(data, header, *args):
+    """
+    Log a message sent or received at DEBUG level. Nothing is done if DEBUG is not enabled, otherwise the data is
+    decoded and formatted by the log writer thread
+    :param data: The message as bytes or str. Must not be modified afterwards
+    :param header: A format string for the line before the message, eg "Sent from port {}:\n\n"
+    :param args: The arguments of header
+    """
+    if logger.isEnabledFor(logging.DEBUG):
+        logger.debug("%s", WireData(data, header, *args))
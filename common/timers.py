@@ -0,0 +1,153 @@
+"""\
+Purpose: One timer thread for the re-registrations, refreshes and statistics ticks of all the endpoints in the process
+"""
+import heapq
+import traceback
+from concurrent.futures import ThreadPoolExecutor
+from itertools import count
+from random import random
+from threading import Thread, Lock, Condition
+from time import monotonic
+
+from common.tc_logging import exception
+
+shared = None
+shared_lock = Lock()
+
+
+def get_timers():
+    """ :return: The shared TimerService of the process, started on first use """
+    global shared
+    with shared_lock:
+        if shared is None:
+            shared = TimerService()
+            shared.start()
+        return shared
+
+
+def call_later(delay, function, args=(), kwargs=None, jitter=0.0):
+    """ Schedule function in the shared TimerService, see TimerService.call_later """
+    return get_timers().call_later(delay, function, args, kwargs, jitter)
+
+
+def jittered(delay, jitter):
+    """
+    :param delay: Seconds
+    :param jitter: Fraction of delay, eg 0.1
+    :return: delay shortened by a random part of jitter * delay, so that timers started together do not fire together.
+             Never longer than delay, so that a refresh is not sent after the expiration it refreshes
+    """
+    return delay * (1 - jitter * random())
+
+
+class TimerHandle(object):
+    """ A scheduled call. Like threading.Timer it can be cancelled until it fires """
+
+    def __init__(self, when, function, args, kwargs):
+        self.when = when
+        self.function = function
+        self.args = args
+        self.kwargs = kwargs
+        self.cancelled = False
+        self.service = None
+
+    def cancel(self):
+        service = self.service
+        if service is not None:
+            service.cancel(self)
+        else:
+            # It has fired, or it was never scheduled
+            self.cancelled = True
+
+    def run(self):
+        if self.cancelled:
+            return
+        try:
+            self.function(*self.args, **self.kwargs)
+        except:
+            exception(traceback.format_exc())
+
+
+class TimerService(object):
+    """
+    A thread that fires the timers of many endpoints from one heap, instead of one sleeping threading.Timer each.
+
+    The timer thread only pops the expired timers. Their functions run in a pool of worker threads, since a
+    re-registration blocks until its 200 OK. Cancelled timers stay in the heap until they expire or until they
+    are more than half of it.
+    """
+
+    def __init__(self, workers=32):
+        self.heap = []
+        self.counter = count()
+        self.condition = Condition()
+        self.cancelled_count = 0
+        self.workers = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="Timer")
+        self.thread = None
+        self.running = False
+
+    def __len__(self):
+        """ :return: The number of timers that have not fired and are not cancelled """
+        with self.condition:
+            return len(self.heap) - self.cancelled_count
+
+    def start(self):
+        self.running = True
+        self.thread = Thread(target=self.loop, name="Timers", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        with self.condition:
+            self.running = False
+            self.condition.notify()
+        if self.thread:
+            self.thread.join()
+        self.workers.shutdown(wait=False)
+
+    def call_later(self, delay, function, args=(), kwargs=None, jitter=0.0):
+        """
+        Call function(*args, **kwargs) after delay seconds in a worker thread
+        :param delay: Seconds
+        :param jitter: Fraction of delay to fire earlier at random, see jittered
+        :return: The TimerHandle, to cancel it
+        """
+        handle = TimerHandle(monotonic() + jittered(delay, jitter), function, args, kwargs or {})
+        handle.service = self
+        with self.condition:
+            heapq.heappush(self.heap, (handle.when, next(self.counter), handle))
+            # Wake the timer thread up only if the new timer is the first to fire
+            if self.heap[0][2] is handle:
+                self.condition.notify()
+        return handle
+
+    def cancel(self, handle):
+        """ Cancel a handle. The flag is set under the condition, so that the count agrees with the loop """
+        with self.condition:
+            if handle.cancelled:
+                return
+            handle.cancelled = True
+            if handle.service is not self:
+                # It has just been popped from the heap
+                return
+            self.cancelled_count += 1
+            if self.cancelled_count > len(self.heap) // 2:
+                for entry in self.heap:
+                    if entry[2].cancelled:
+                        entry[2].service = None
+                self.heap = [entry for entry in self.heap if not entry[2].cancelled]
+                heapq.heapify(self.heap)
+                self.cancelled_count = 0
+
+    def loop(self):
+        while True:
+            with self.condition:
+                while self.running and (not self.heap or self.heap[0][0] > monotonic()):
+                    self.condition.wait(self.heap[0][0] - monotonic() if self.heap else None)
+                if not self.running:
+                    return
+                handle = heapq.heappop(self.heap)[2]
+                handle.service = None
+                if handle.cancelled:
+                    self.cancelled_count -= 1
+                    continue
+            self.workers.submit(handle.run)
@@ -4,17 +4,27 @@ Initial Version: Costas Skarakis 11/11/2018
 """
 import random
 import string
+from collections import deque
 from concurrent.futures import ThreadPoolExecutor
 from itertools import cycle
-from threading import Timer, Thread
+from threading import Thread, Lock, Event
+from weakref import WeakSet
 from time import time, sleep
 import re
 import io
 import xml.etree.ElementTree as ET
 import logging.handlers
 from common.tc_logging import logger
+from common.client import get_handshake_statistics
+from common.timers import call_later
+from sip.SipDialogs import get_dialog_statistics
+from sip.SipMessageBuffer import get_buffer_statistics
+from sip.SipTransactions import get_transaction_statistics
 import traceback
 
+# All the endpoint pools, for Load.statistics
+endpoint_pools = WeakSet()
+
 
 def nowHex():
     """ Current time in sec represented in hex - 4 digits """
@@ -59,7 +69,8 @@ def loop(sequence):
 
 def pool(sequence, condition=bool):
     """
-    Cyclically yields the next member of a sequence unless the specified condition is False
+    Cyclically yields the next member of a sequence unless the specified condition is False.
+    It polls while no member is eligible and does not make members busy, see EndpointPool for exclusive use
 
     :param sequence: input sequence, eg a list
     :param condition: a function to be run on the next member eg:
@@ -79,7 +90,7 @@ def pool(sequence, condition=bool):
 
 
 def next_available_sip(sip_pool):
-    """Find the next available sip endpoint from a pool of endpoints"""
+    """Find the next available sip endpoint from a pool of endpoints. See EndpointPool.acquire which does not spin"""
     busy = True
     a = None
     while busy:
@@ -100,6 +111,160 @@ def make_available_sip(*sip_endpoints):
             sip_endpoint.colour("yellow")
 
 
+def set_busy(member, busy):
+    """ Mark an endpoint, or a tuple of endpoints, busy or available """
+    for endpoint in member if isinstance(member, tuple) else (member,):
+        endpoint.make_busy(busy)
+
+
+class EndpointPool(object):
+    """
+    The endpoints of a load test. A flow acquires an endpoint for its exclusive use and releases it when it is done.
+
+    The free endpoints are kept in a free list, so acquire and release are O(1) and atomic: two flows never get
+    the same endpoint. When none is free, acquire sleeps until one is released, instead of cycling through the
+    busy ones. Members can also be tuples of endpoints, eg fixed A-side/B-side pairs that are acquired together.
+
+    With fair=True the members are acquired in the order they were released and a released member is handed
+    over to the thread waiting the longest. Otherwise the last released member is reused first and any thread
+    can take it, which keeps fewer endpoints active at low load.
+    The time spent waiting is measured, see statistics, to tell when the pool is what limits the calls per second.
+    """
+
+    def __init__(self, members, condition=None, fair=True, name="Pool", recheck=0.1):
+        """
+        :param members: The endpoints, or tuples of endpoints
+        :param condition: A function of a member, False if it cannot be acquired yet eg lambda x: x.registered
+        :param fair: Hand members over in order, see above
+        :param name: The prefix of the statistics names
+        :param recheck: Seconds between checks of the condition of the free members while all of them fail it.
+                        Not used without a condition
+        """
+        assert members, "Refused to make empty pool"
+        self.free = deque(members)
+        self.condition = condition
+        self.fair = fair
+        self.name = name
+        self.recheck = recheck
+        self.lock = Lock()
+        # [Event, member handed over] of each waiting thread, in arrival order
+        self.waiters = deque()
+        self.acquisitions = 0
+        self.waits = 0
+        self.timeouts = 0
+        self.wait_time = 0.0
+        self.max_wait_time = 0.0
+        endpoint_pools.add(self)
+
+    def __len__(self):
+        """ :return: The number of free members """
+        return len(self.free)
+
+    def acquire(self, timeout=None):
+        """
+        Take a free member and make it busy
+
+        :param timeout: Seconds to wait for a free member. None waits forever
+        :return: The member
+        :raises NoMoreAvailableExecutors: If no member is free before timeout. Load counts the flow as skipped
+        """
+        t0 = time()
+        with self.lock:
+            member = None if self.fair and self.waiters else self._take()
+            if member is not None:
+                self.acquisitions += 1
+            else:
+                waiter = [Event(), None]
+                self.waiters.append(waiter)
+        if member is None:
+            member = self._wait(waiter, t0, timeout)
+            wait_time = time() - t0
+            with self.lock:
+                self.acquisitions += 1
+                self.waits += 1
+                self.wait_time += wait_time
+                self.max_wait_time = max(self.max_wait_time, wait_time)
+        set_busy(member, True)
+        return member
+
+    def release(self, member):
+        """ Make a member available again. It is handed over to a waiting thread if there is one """
+        set_busy(member, False)
+        with self.lock:
+            if self.fair and self.waiters and self._eligible(member):
+                waiter = self.waiters.popleft()
+                waiter[1] = member
+                waiter[0].set()
+                return
+            self.free.append(member)
+            if self.waiters:
+                self.waiters[0][0].set()
+
+    def statistics(self):
+        """ :return: The counts and wait times of the pool, with names prefixed by its name """
+        with self.lock:
+            return {"{} Free".format(self.name): len(self.free),
+                    "{} Waiting".format(self.name): len(self.waiters),
+                    "{} Acquisitions".format(self.name): self.acquisitions,
+                    "{} Waits".format(self.name): self.waits,
+                    "{} Timeouts".format(self.name): self.timeouts,
+                    "{} Average Wait Time".format(self.name):
+                        self.wait_time / self.waits if self.waits else 0.0,
+                    "{} Max Wait Time".format(self.name): self.max_wait_time}
+
+    def _eligible(self, member):
+        return self.condition is None or self.condition(member)
+
+    def _take(self):
+        """ Called with self.lock held. :return: The next free member that satisfies the condition, or None """
+        for i in range(len(self.free)):
+            member = self.free.popleft() if self.fair else self.free.pop()
+            if self._eligible(member):
+                return member
+            # Eg not registered yet. Check it again after the others
+            if self.fair:
+                self.free.append(member)
+            else:
+                self.free.appendleft(member)
+        return None
+
+    def _wait(self, waiter, t0, timeout):
+        """ Sleep until a member is handed over to waiter or can be taken, or until timeout """
+        event = waiter[0]
+        while True:
+            remaining = None if timeout is None else t0 + timeout - time()
+            if remaining is not None and remaining <= 0:
+                break
+            if self.condition is None:
+                # Only a release makes a member available
+                event.wait(remaining)
+            else:
+                # The condition of a free member can become True without a release, eg when it registers
+                event.wait(self.recheck if remaining is None else min(remaining, self.recheck))
+            with self.lock:
+                event.clear()
+                if waiter[1] is not None:
+                    break
+                if not self.fair or self.waiters[0] is waiter:
+                    member = self._take()
+                    if member is not None:
+                        self.waiters.remove(waiter)
+                        waiter[1] = member
+                        # Members released since this thread was woken up are for the next one
+                        if self.free and self.waiters:
+                            self.waiters[0][0].set()
+                        break
+        with self.lock:
+            if waiter[1] is None:
+                self.waiters.remove(waiter)
+                self.timeouts += 1
+                # Without polling, a release that woke this thread up as it timed out must wake the next one
+                if self.free and self.waiters:
+                    self.waiters[0][0].set()
+                raise NoMoreAvailableExecutors("No free member in {} after {} seconds".format(self.name, timeout))
+            return waiter[1]
+
+
 def serverThread(target, *args, **kwargs):
     """ Start a thread """
     ex = ThreadPoolExecutor()
@@ -109,12 +274,12 @@ def serverThread(target, *args, **kwargs):
 
 def wait_for_sip_data(sockfile):
     content_length = -1
-    data = b""
-    data += sockfile.readline()
+    # Collect the lines and join them once, instead of concatenating the message bytes line by line
+    lines = [sockfile.readline()]
 
     while True:
         line = sockfile.readline()
-        data += line
+        lines.append(line)
         if not line.strip():
             break
         if not line.endswith(b"\r\n"):
@@ -123,22 +288,23 @@ def wait_for_sip_data(sockfile):
             header, value = [x.strip() for x in line.split(b":", 1)]
         except ValueError:
             logger.warning("Incorrect header line (no ':') in SIP message: " + repr(line) +
-                           "\n" + "Data received up to that:" + repr(data) +
+                           "\n" + "Data received up to that:" + repr(b"".join(lines)) +
                            "\n" + "Will attempt to get the rest of the message from the network")
             continue
-        if header == b"Content-Length" or header == b"content-length":
+        if header.lower() in (b"content-length", b"l"):
             content_length = int(value)
 
+    data = b"".join(lines)
     if not data.strip():
         raise EOFError
 
-    body = ""
     if content_length > 0:
         body = sockfile.read(content_length)
         if len(body) < content_length:
             raise IncompleteData("Message body not yet complete: " + repr(data))
         else:
-            data += body
+            lines.append(body)
+            data = b"".join(lines)
 
     if content_length == -1:
         if line == b"\r\n":
@@ -442,9 +608,21 @@ class Load(object):
 
     def statistics(self):
         self.calls["Active"] = len(self.active)
+        tls_statistics = get_handshake_statistics()
+        if tls_statistics["TLS Handshakes"]:
+            self.calls.update(tls_statistics)
+        dialog_statistics = get_dialog_statistics()
+        if dialog_statistics["Dialogs"]:
+            self.calls.update(dialog_statistics)
+            self.calls.update(get_buffer_statistics())
+        transaction_statistics = get_transaction_statistics()
+        if any(transaction_statistics.values()):
+            self.calls.update(transaction_statistics)
+        for endpoint_pool in list(endpoint_pools):
+            self.calls.update(endpoint_pool.statistics())
         self.log.info("{}:{}".format(time(), self.calls))
         if not self.stopCondition and (self.duration < 0 or time() - self.startTime < self.duration) or self.active:
-            Timer(1, self.statistics).start()
+            call_later(1, self.statistics)
         else:
             print("STOPPING")
 
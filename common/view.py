@@ -47,9 +47,9 @@ class LoadWindow:
                 message += sub_frame.error_message.get()
             message += "\n========== INCOMING SIP MESSAGE BUFFER  ==========\n"
             message += str(sub.message_buffer)
-            message += "\n========== LAST_MESSAGES_PER_DIALOG ==========\n%s\n" % str(sub.last_messages_per_dialog)
+            message += "\n========== LAST_MESSAGES_PER_DIALOG ==========\n%s\n" % str(sub.dialogs.last_messages)
             message += "\n========== DIALOGS ==========\n%s\n" % str(sub.dialogs)
-            message += "\n========== REQUESTS ==========\n%s\n" % str(sub.requests)
+            message += "\n========== REQUESTS ==========\n%s\n" % str(sub.dialogs.requests_sent)
             message += "\n========== ADDRESS: %s:%s==========\n" % (str(sub.ip), str(sub.port))
             text = tkinter.Text(frame)
             text.insert("end", message)
@@ -0,0 +1,90 @@
+"""\
+Purpose: Wake up only the thread waiting for a received message instead of all threads sharing a buffer
+"""
+from threading import Lock, Event
+
+
+class Waiter(object):
+    """
+    A thread (or coroutine) waiting for a message that matches its predicate.
+    The event is set when a matching message is buffered
+    """
+
+    def __init__(self, predicate, event):
+        self.predicate = predicate
+        self.event = event
+        # The messages this waiter was woken up for and has not taken from the buffer
+        self.pending = []
+
+    def wait(self, timeout):
+        """
+        Wait until a matching message is buffered
+        :param timeout: Timeout in seconds
+        """
+        self.event.wait(timeout)
+        self.event.clear()
+
+    def took(self, message):
+        """ Called when the waiter takes a message from the buffer """
+        for i, m in enumerate(self.pending):
+            if m is message:
+                del self.pending[i]
+                break
+
+
+class Waiters(object):
+    """
+    The threads waiting for the messages of a buffer.
+
+    Every buffered message wakes up the first waiter that matches it and is not woken up already, or the first that
+    matches it if all are, so the threads sharing a buffer don't all wake up and rescan it for every message.
+    A waiter checks the buffer after it registers and before it waits, so a message buffered in between is not missed.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.waiters = []
+
+    def __len__(self):
+        return len(self.waiters)
+
+    def register(self, predicate, event=None):
+        """
+        :param predicate: Function of a message, True if the waiter expects it
+        :param event: The event to set. A threading.Event if None, an asyncio.Event can be given for coroutines
+        :return: The Waiter
+        """
+        waiter = Waiter(predicate, event or Event())
+        with self.lock:
+            self.waiters.append(waiter)
+        return waiter
+
+    def unregister(self, waiter):
+        """ Stop waiting. The messages the waiter was woken up for and did not take wake up the other waiters """
+        with self.lock:
+            self.waiters.remove(waiter)
+        for message in waiter.pending:
+            self.notify(message)
+        waiter.pending = []
+
+    def notify(self, message, skip=None):
+        """
+        Wake up the waiter of a buffered message
+        :param message: The message buffered
+        :param skip: A waiter not to wake up, the one that buffers a message it did not expect
+        :return: True if a waiter was woken up
+        """
+        with self.lock:
+            chosen = None
+            for waiter in self.waiters:
+                if waiter is not skip and waiter.predicate(message):
+                    if not waiter.pending:
+                        chosen = waiter
+                        break
+                    if chosen is None:
+                        chosen = waiter
+            if chosen is None:
+                return False
+            chosen.pending.append(message)
+            chosen.event.set()
+            return True
@@ -5,11 +5,13 @@ Initial Version: Costas Skarakis 7/20/2020
 import os
 import traceback
 from _socket import timeout as sock_timeout
-from threading import Lock, Thread, Event
+from threading import Lock, Thread
 from time import time, sleep
 
 from common.client import TCPClient
+import common.reactor as reactor
 from common.tc_logging import debug, warning, exception
+from common.waiters import Waiters
 from csta.CstaEndpoint import get_xml
 from csta.CstaUser import CstaUser
 from csta.CstaParser import parseBytes, buildMessageFromFile, buildMessage
@@ -61,6 +63,23 @@ def get_buffered_message(buffer, message, call_id=None, monitor_x_ref_id=None, c
                 return buffered_message
 
 
+def message_matches(buffered_message, message, call_id=None, monitor_x_ref_id=None, calling_device=None):
+    """
+    :param buffered_message: A received CstaMessage
+    :return: True if get_buffered_message can return buffered_message for the rest of the parameters
+    """
+    key = str(buffered_message["monitorCrossRefID"]) + str(buffered_message.event)
+    if message.endswith("Event") and key == str(monitor_x_ref_id) + str(message):
+        return True
+    if ((message.endswith("Event") and call_id is None) or message.endswith("Response")) and \
+            key.endswith(str(message)):
+        if calling_device is None:
+            return True
+        calling_devices = str(buffered_message).split("callingDevice")
+        return len(calling_devices) > 1 and calling_device in calling_devices[1]
+    return False
+
+
 class CstaApplication:
     def __init__(self, server=False):
         self.ip = None
@@ -72,27 +91,37 @@ class CstaApplication:
         self.server = server
         self.message_buffer = {}
         self.buffer_mod_time = None
-        self.buffer_trigger_count = 0
         self.lock = Lock()
-        self.buffer_event = Event()
+        self.waiters = Waiters()
         self.shutdown_flag = False
         self.waitForCstaMessage = self.wait_for_csta_message  # compatibility alias
         self.wait_thread = None
+        # The shared reactor that receives for this application instead of the wait thread, see common.reactor
+        self.reactor = None
 
     def shutdown(self):
         """
         Try to stop threads and cleanup connections
         """
         self.shutdown_flag = True
-        self.link.shutdown()
-        self.wait_thread.join()
+        if self.reactor:
+            self.reactor.unregister(self.link)
+            self.link.shutdown()
+        else:
+            self.link.shutdown()
+            self.wait_thread.join()
 
     def start_wait_thread(self):
         """
-        Starts a separate thread that will consume incoming csta traffic and place it into buffers
+        Starts a separate thread that will consume incoming csta traffic and place it into buffers.
+        If the shared reactor is enabled it will receive for this application instead, see common.reactor
         """
-        self.wait_thread = Thread(target=self.wait_loop, daemon=True)
-        self.wait_thread.start()
+        if reactor.is_enabled():
+            self.reactor = reactor.get_reactor()
+            self.reactor.register(self.link, self.buffer_incoming, protocol="csta")
+        else:
+            self.wait_thread = Thread(target=self.wait_loop, daemon=True)
+            self.wait_thread.start()
 
     def wait_loop(self):
         """
@@ -109,19 +138,30 @@ class CstaApplication:
                 warning("Disconnected. Will retry in 1 second")
                 sleep(1)
             else:
-                inmessage = parseBytes(inbytes)
-                try:
-                    net_object = self
-                    for dn in self.users:
-                        user = self.users[dn]
-                        if (inmessage.is_event() and user.monitorCrossRefID == inmessage["monitorCrossRefID"]) or \
-                                (inmessage.is_response() and inmessage.eventid in user.out_transactions):
-                            net_object = user
-                            break
-                    with net_object.lock:
-                        self.buffer_message(net_object, inmessage)
-                except:
-                    exception(traceback.format_exc())
+                self.buffer_incoming(inbytes)
+
+    def buffer_incoming(self, inbytes):
+        """
+        Buffer a message received on the link for its user. Called by the wait thread or the reactor
+        :param inbytes: The message bytes. None from the reactor when the connection is closed
+        """
+        if inbytes is None:
+            if not self.shutdown_flag:
+                warning("Disconnected")
+            return
+        inmessage = parseBytes(inbytes)
+        try:
+            net_object = self
+            for dn in self.users:
+                user = self.users[dn]
+                if (inmessage.is_event() and user.monitorCrossRefID == inmessage["monitorCrossRefID"]) or \
+                        (inmessage.is_response() and inmessage.eventid in user.out_transactions):
+                    net_object = user
+                    break
+            with net_object.lock:
+                self.buffer_message(net_object, inmessage)
+        except:
+            exception(traceback.format_exc())
 
     def connect(self, local_address, destination_address, protocol="tcp"):
         """ Connect to CSTA Server """
@@ -292,10 +332,38 @@ class CstaApplication:
             user_xrefid = this_user.monitorCrossRefID
             net_object = this_user
             callID = this_user.parameters["callID"]
+        # Registered before the buffer is checked, so that a message buffered in between wakes us up
+        waiter = net_object.waiters.register(
+            lambda m: message_matches(m, message, callID, user_xrefid, calling_device))
+        try:
+            inmessage = self.wait_in_buffer(waiter, net_object, for_user, message, callID, user_xrefid,
+                                            calling_device, ignore_messages, timeout)
+        finally:
+            net_object.waiters.unregister(waiter)
+        if this_user is not None:
+            # Evaluate the invoke id
+            this_user.update_incoming_transactions(inmessage)
+            this_user.update_call_id(inmessage)
+
+        return inmessage
+
+    def wait_in_buffer(self, waiter, net_object, for_user, message, callID, user_xrefid, calling_device,
+                       ignore_messages, timeout):
+        """
+        The loop of wait_for_csta_message
+        :param waiter: The Waiter registered for the message
+        :return: the CstaMessage received
+        """
+        this_user = self.users[for_user] if for_user is not None else None
+        # Messages taken and buffered again because they came sooner than expected
+        rejected = []
         # checked_buffer = None
         t0_tout = time()
         with net_object.lock:
-            inmessage = get_buffered_message(net_object.message_buffer, message, callID, user_xrefid, calling_device)
+            taken = get_buffered_message(net_object.message_buffer, message, callID, user_xrefid, calling_device)
+        if taken is not None:
+            waiter.took(taken)
+        inmessage = taken
         while not inmessage:
             # if not checked_buffer == net_object.buffer_mod_time:
             #     checked_buffer = net_object.buffer_mod_time
@@ -305,13 +373,20 @@ class CstaApplication:
             #            if not inmessage:
             rem_timeout = timeout - (time() - t0_tout)
             if rem_timeout > 0:
-                net_object.buffer_event.wait(rem_timeout)
-                net_object.buffer_event.clear()
+                # If a message was taken, there may be more in the buffer that did not wake us up
+                if taken is None:
+                    waiter.wait(rem_timeout)
                 with net_object.lock:
-                    inmessage = get_buffered_message(net_object.message_buffer, message, callID, user_xrefid,
-                                                     calling_device)
-                    if inmessage is None:
-                        continue
+                    taken = get_buffered_message(net_object.message_buffer, message, callID, user_xrefid,
+                                                 calling_device)
+                    if any(taken is m for m in rejected):
+                        # Nothing else in the buffer, put it back and wait
+                        self.buffer_message(net_object, taken, skip=waiter)
+                        taken = None
+                if taken is None:
+                    continue
+                waiter.took(taken)
+                inmessage = taken
             else:
                 exception("%s (CSTA) No %s. Buffer lengths: %s. " % (for_user,
                                                                      message,
@@ -396,7 +471,8 @@ class CstaApplication:
                     with net_object.lock:
                     # with self.lock:
                         # trying global lock to buffer messages
-                        self.buffer_message(net_object, inmessage, ntfy_subs=False)
+                        self.buffer_message(net_object, inmessage, skip=waiter)
+                    rejected.append(inmessage)
                     # warning(
                     #     "BUFFERED MESSAGE '{}' with callID '{}' for '{}' because I am '{}' waiting for '{}' in '{}' '{}'".format(
                     #         inmessage_type,
@@ -428,18 +504,13 @@ class CstaApplication:
                                                                             None),
                                                                         this_user.out_transactions,
                                                                         inmessage))
-        if this_user is not None:
-            # Evaluate the invoke id
-            this_user.update_incoming_transactions(inmessage)
-            this_user.update_call_id(inmessage)
-
         return inmessage
 
-    def buffer_message(self, user, message, ntfy_subs=True):
+    def buffer_message(self, user, message, skip=None):
         """
-        Add csta message to csta user's or csta application's buffer.
+        Add csta message to csta user's or csta application's buffer and wake up the thread waiting for it.
         :param message: the message to buffer
-        :param ntfy_subs: notify the user whose buffer was changed
+        :param skip: the Waiter buffering again a message it did not expect. It is not woken up
         :param user: the user who's buffer to use
         :return: None
         """
@@ -452,11 +523,7 @@ class CstaApplication:
         else:
             user.message_buffer[key] = [message]
         user.buffer_mod_time = time()
-        if ntfy_subs:
-            self.buffer_trigger_count += 1
-        if self.buffer_trigger_count:
-            user.buffer_event.set()
-            self.buffer_trigger_count -= 1
+        user.waiters.notify(message, skip)
 
     def update_call_parameters(self, directory_number, inresponse):
         """ Update our parameters based on the given incoming CSTA message """
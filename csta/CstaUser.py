@@ -3,8 +3,9 @@ Purpose: Simulate a CSTA User
 Initial Version: Costas Skarakis 8/7/2020 (Aug 7)
 """
 from common.tc_logging import warning, exception
+from common.waiters import Waiters
 from csta.CstaMessage import is_response, is_event, is_request
-from threading import Lock, Event
+from threading import Lock
 
 
 class CstaUser:
@@ -20,7 +21,7 @@ class CstaUser:
         self.out_transactions = {}
         self.deviceID = number
         self.message_buffer = {}
-        self.buffer_event = Event()
+        self.waiters = Waiters()
         self.buffer_mod_time = None
         self.lock = Lock()
         self.parameters = {"monitorCrossRefID": self.monitorCrossRefID,
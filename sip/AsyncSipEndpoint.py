@@ -0,0 +1,167 @@
+"""\
+Purpose: Simulate a SIP phone/line appearance/user on an asyncio event loop
+"""
+import asyncio
+from time import time
+
+from _socket import timeout as sock_timeout
+from common.tc_logging import exception
+from common.async_client import AsyncClient
+import common.util as util
+from common.timers import jittered
+from sip.SipEndpoint import SipEndpoint
+from sip.SipTransactions import response_matches
+from sip.messages import message
+
+
+class AsyncSipEndpoint(SipEndpoint):
+    """\
+    A SipEndpoint that runs on an asyncio event loop instead of threads
+
+    Messages are received by the event loop and buffered as in SipEndpoint, so one thread can run the flows of
+    thousands of endpoints concurrently. send_new, send, send_in_ctx_of, reply, wait_for_message, register and
+    unregister are coroutines, everything else works as in SipEndpoint. Must be used from a single event loop.
+    """
+
+    async def connect(self, local_address, destination_address, protocol="tcp", certificate=None,
+                      subject_name="localhost"):
+        """ Connect to the SIP Server """
+        local_ip, local_port = local_address
+        dest_ip, dest_port = destination_address
+
+        self.parameters["dest_ip"] = dest_ip
+        self.parameters["dest_port"] = dest_port
+        self.parameters["transport"] = protocol
+        self.link = AsyncClient(local_ip, local_port, protocol, certificate, subject_name)
+        loop = asyncio.get_running_loop()
+        # Retransmit and sweep the dialogs from the event loop, the AsyncClient is not thread safe
+        self.transactions.call_later = lambda delay, function, args=(): loop.call_later(delay, function, *args)
+        self.call_later = self.transactions.call_later
+        await self.link.connect(dest_ip, dest_port, self.buffer_incoming)
+        self.set_address((local_ip, self.link.port))
+
+    def shutdown(self):
+        """ Close the connection """
+        self.shutdown_flag = True
+        if self.re_register_timer:
+            self.re_register_timer.cancel()
+        with self.lock:
+            if self.reap_timer:
+                self.reap_timer.cancel()
+        if self.link.dispatcher is not None:
+            self.link.dispatcher.remove_endpoint(self)
+        self.link.shutdown()
+
+    async def send_new(self, target_sip_ep=None, message_string="", expected_response=None, ignore_messages=[]):
+        """ Start a new dialog and send a message """
+        m = super().send_new(target_sip_ep, message_string)
+        if expected_response:
+            await self.wait_for_message(message_type=expected_response, dialog=self.current_dialog,
+                                        ignore_messages=ignore_messages)
+        return m
+
+    async def send_in_ctx_of(self, reference_message, this_message_string="", expected_response=None,
+                             ignore_messages=[]):
+        """ Send a message within the same dialog and transaction as 'reference_message' """
+        self.set_transaction(reference_message.get_transaction())
+        return await self.send(message_string=this_message_string,
+                               expected_response=expected_response,
+                               ignore_messages=ignore_messages,
+                               dialog=reference_message.get_dialog())
+
+    async def send(self, message_string="", expected_response=None, ignore_messages=[], dialog=None):
+        """ Send a message within a dialog """
+        m = SipEndpoint.reply(self, message_string, dialog)
+        if expected_response:
+            await self.wait_for_message(message_type=expected_response, ignore_messages=ignore_messages,
+                                        dialog=dialog)
+        return m
+
+    async def reply(self, message_string, dialog=None):
+        """ Send a response to a previously received message """
+        return SipEndpoint.reply(self, message_string, dialog)
+
+    async def wait_for_message(self, message_type, dialog=None, ignore_messages=(), timeout=5.0):
+        """
+        Wait for a specific type of SIP message. See SipEndpoint.wait_for_message
+        :return: A SipMessage constructed from the incoming message
+        """
+        explicit_dialog, dialog, last_sent_message, transaction = self.wait_context(dialog)
+
+        taken_types = self.challenge_types(message_type, last_sent_message)
+        waiter = self.register_waiter(taken_types, explicit_dialog, asyncio.Event())
+        rejected = []
+        try:
+            t0_tout = time()
+            taken = self.get_buffered_message(taken_types, explicit_dialog, waiter)
+            inmessage = self.handle_da(last_sent_message, taken)
+
+            while not inmessage:
+                rem_timeout = timeout - (time() - t0_tout)
+                if rem_timeout > 0:
+                    if taken is None:
+                        try:
+                            await asyncio.wait_for(waiter.event.wait(), rem_timeout)
+                        except asyncio.TimeoutError:
+                            pass
+                        waiter.event.clear()
+                    taken = self.get_buffered_message(taken_types, explicit_dialog, waiter, rejected)
+                    inmessage = self.handle_da(last_sent_message, taken)
+                    if inmessage is None:
+                        continue
+                else:
+                    exception("%s No %s. Buffer length: %d." % (self.number,
+                                                                message_type,
+                                                                len(self.message_buffer)))
+                    raise sock_timeout
+
+                if last_sent_message:
+                    # Its branch changes when it is sent again with authorization, see handle_da
+                    transaction = last_sent_message.get_transaction()
+                inmessage = self.check_received(inmessage, message_type, ignore_messages, dialog, transaction, waiter)
+                if inmessage is None:
+                    rejected.append(taken)
+        finally:
+            self.message_buffer.waiters.unregister(waiter)
+
+        return self.accept_received(inmessage, message_type, transaction)
+
+    def handle_da(self, request, response):
+        """"
+        Add DA to the request and send it again if the response is its 401.
+        The response to the new request will come through the buffer, so None is returned in that case
+        """
+        if response is None:
+            return None
+        if "da_pass" not in self.parameters or "da_user" not in self.parameters:
+            self.set_digest_credentials(self.number, self.number, "")
+        if response.type == "Response" and response.status == "401 Unauthorized" and \
+                request is not None and response_matches(response, request.get_transaction()):
+            request.addAuthorization(response["WWW-Authenticate"], self.parameters["da_user"],
+                                     self.parameters["da_pass"])
+            # A new transaction, RFC 3261 8.1.3.5. A late retransmission of the 401 must not match it
+            request.via_branch = util.randomBranch()
+            self.transmit(request)
+            return None
+        return response
+
+    async def register(self, expiration_in_seconds=360, re_register_time=180):
+        """ Convenience function to register an AsyncSipEndpoint """
+        if not expiration_in_seconds:
+            return await self.unregister()
+        if re_register_time and self.registered:
+            self.re_register_timer = asyncio.get_running_loop().call_later(
+                jittered(re_register_time, self.re_register_jitter),
+                lambda: asyncio.ensure_future(self.register(expiration_in_seconds, re_register_time)))
+        self.parameters["expires"] = expiration_in_seconds
+        await self.send_new(message_string=message["Register_1"], expected_response="200 OK")
+        self.reset_dialog_and_transaction()
+        self.registered = True
+
+    async def unregister(self):
+        """ Convenience function to un-register an AsyncSipEndpoint"""
+        if self.re_register_timer:
+            self.re_register_timer.cancel()
+        self.parameters["expires"] = 0
+        await self.send_new(message_string=message["Register_1"], expected_response="200 OK")
+        self.registered = False
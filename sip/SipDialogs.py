@@ -0,0 +1,255 @@
+"""\
+Purpose: Dialog tracking of a SipEndpoint with constant time lookups
+"""
+from heapq import heappop, heappush
+from itertools import count
+from time import time
+from weakref import WeakSet
+
+# Requests that establish a dialog when they get a 2xx response
+DIALOG_CREATING = ("INVITE", "SUBSCRIBE", "REFER")
+
+# All the dialog tables, for get_dialog_statistics
+tables = WeakSet()
+
+
+def dialog_key(dialog):
+    return dialog["Call-ID"], dialog["from_tag"], dialog["to_tag"]
+
+
+def get_dialog_statistics():
+    """ :return: The number of dialogs tracked by all the SipEndpoints of the process """
+    statistics = {"Dialogs": 0, "Early Dialogs": 0, "Terminated Dialogs": 0}
+    for table in list(tables):
+        for name, count in table.statistics().items():
+            statistics[name] += count
+    return statistics
+
+
+class DialogTable(object):
+    """
+    The dialogs of a SipEndpoint, the requests sent in each and the last message of each.
+
+    Dialogs are the dictionaries of SipMessage.get_dialog(), indexed by (Call-ID, from_tag, to_tag). Early dialogs,
+    without a to_tag yet, are also indexed by (Call-ID, from_tag) to find them when the to_tag arrives.
+    It is used like the list of dialogs it replaces: "dialog in table", append, iteration and len.
+
+    Terminated dialogs are removed by reap() after they linger for a while, so that retransmissions and late
+    messages are still recognized, and so are the early dialogs that never get a to_tag.
+    Not thread safe, SipEndpoint uses it under its lock.
+    """
+
+    def __init__(self):
+        self.dialogs = {}
+        # (Call-ID, from_tag) to the first dialog with these that has a to_tag
+        self.complete = {}
+        self.requests_sent = {}
+        self.last_messages = {}
+        # Key to the method of the first request saved in the dialog, the one that created it
+        self.first_requests = {}
+        # (Call-ID, from_tag) to the key of the first dialog with these that has a saved message
+        self.early_messages = {}
+        # Call-ID to the keys of its dialogs
+        self.call_ids = {}
+        # Key to creation time of the dialogs without a to_tag, in creation order
+        self.early = {}
+        # Key to removal time of the terminated dialogs
+        self.terminated = {}
+        # Heap of (removal time, order, key) of the terminated dialogs. The entries of the keys that were removed,
+        # moved by set_to_tag or confirmed again are skipped by reap
+        self.removals = []
+        self.removal_order = count()
+        # Keys of the dialogs established by a 2xx to a dialog creating request
+        self.confirmed = set()
+        # Functions called with every dialog removed by reap, eg by the SipEndpoints sharing the table
+        self.listeners = []
+        tables.add(self)
+
+    def __contains__(self, dialog):
+        return dialog_key(dialog) in self.dialogs
+
+    def __iter__(self):
+        return iter(self.dialogs.values())
+
+    def __len__(self):
+        return len(self.dialogs)
+
+    def __repr__(self):
+        return repr(list(self.dialogs.values()))
+
+    def append(self, dialog):
+        """ Add a new dialog """
+        key = dialog_key(dialog)
+        self.call_ids.setdefault(key[0], set()).add(key)
+        self.dialogs[key] = dialog
+        self.requests_sent[key] = []
+        if dialog["to_tag"]:
+            self.complete.setdefault(key[:2], dialog)
+        else:
+            self.early[key] = time()
+
+    def remove(self, dialog):
+        """ Forget a dialog and its messages """
+        key = dialog_key(dialog)
+        if self.dialogs.pop(key, None) is not None:
+            self.call_ids[key[0]].discard(key)
+            if not self.call_ids[key[0]]:
+                del self.call_ids[key[0]]
+        self.requests_sent.pop(key, None)
+        self.last_messages.pop(key, None)
+        self.first_requests.pop(key, None)
+        self.early.pop(key, None)
+        self.terminated.pop(key, None)
+        self.confirmed.discard(key)
+        if self.complete.get(key[:2]) is dialog:
+            del self.complete[key[:2]]
+        if self.early_messages.get(key[:2]) == key:
+            del self.early_messages[key[:2]]
+
+    def has_call_id(self, call_id):
+        """ :return: True if a dialog of call_id is tracked """
+        return call_id in self.call_ids
+
+    def requests(self, dialog):
+        """
+        :return: The list of the request methods sent in dialog
+        :raises ValueError: If dialog is unknown
+        """
+        try:
+            return self.requests_sent[dialog_key(dialog)]
+        except KeyError:
+            raise ValueError("{} is not a known dialog".format(dialog))
+
+    def complete_dialog(self, in_dialog):
+        """ :return: The known dialog with a to_tag that has the Call-ID and from_tag of in_dialog, or None """
+        return self.complete.get((in_dialog["Call-ID"], in_dialog["from_tag"]))
+
+    def set_to_tag(self, in_dialog):
+        """
+        Complete the known early dialog of in_dialog with the to_tag of in_dialog
+        :return: The updated dialog, or None if there is no such early dialog
+        """
+        call_id, from_tag, to_tag = dialog_key(in_dialog)
+        dialog = self.dialogs.get((call_id, from_tag, "")) or self.dialogs.get((call_id, from_tag, None))
+        if dialog is None or not to_tag:
+            return None
+        early_key = dialog_key(dialog)
+        dialog["to_tag"] = to_tag
+        key = dialog_key(dialog)
+        del self.dialogs[early_key]
+        self.call_ids[call_id].discard(early_key)
+        self.call_ids[call_id].add(key)
+        self.early.pop(early_key, None)
+        if early_key in self.terminated:
+            self.mark_terminated(key, self.terminated.pop(early_key))
+        self.dialogs[key] = dialog
+        self.requests_sent[key] = self.requests_sent.pop(early_key)
+        if early_key in self.first_requests:
+            self.first_requests.setdefault(key, self.first_requests.pop(early_key))
+        self.complete.setdefault((call_id, from_tag), dialog)
+        return dialog
+
+    def save_message(self, message):
+        """ Keep message as the last one of its dialog """
+        key = dialog_key(message.get_dialog())
+        self.last_messages[key] = message
+        self.early_messages.setdefault(key[:2], key)
+        if message.type == "Request":
+            self.first_requests.setdefault(key, message.method)
+
+    def last_message(self, dialog):
+        """
+        :return: The last message saved in dialog, or if there is none in an early or forked dialog with the same
+                 Call-ID and from_tag. None if there is none
+        """
+        key = dialog_key(dialog)
+        message = self.last_messages.get(key)
+        if message is None:
+            message = self.last_messages.get(self.early_messages.get(key[:2]))
+        return message
+
+    def first_request(self, dialog):
+        """
+        :return: The method of the request that created dialog, or the dialog of the other direction, eg SUBSCRIBE
+                 for the dialog of a NOTIFY received before the 2xx to the SUBSCRIBE. None if it is unknown
+        """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        for key in (call_id, to_tag, from_tag), (call_id, to_tag, ""), (call_id, from_tag, to_tag), \
+                (call_id, from_tag, ""):
+            if key in self.first_requests:
+                return self.first_requests[key]
+        return None
+
+    def confirm(self, dialog):
+        """
+        Mark a dialog as established by a 2xx to a dialog creating request. If it was terminated, eg by an error
+        response to an earlier attempt, it is not removed anymore
+        """
+        call_id, from_tag, to_tag = key = dialog_key(dialog)
+        if key in self.dialogs:
+            self.confirmed.add(key)
+        self.terminated.pop(key, None)
+        self.terminated.pop((call_id, to_tag, from_tag), None)
+
+    def is_confirmed(self, dialog):
+        """ :return: True if the dialog, in either direction, was established by a 2xx to a dialog creating request """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        return (call_id, from_tag, to_tag) in self.confirmed or (call_id, to_tag, from_tag) in self.confirmed
+
+    def terminate(self, dialog, linger):
+        """
+        Mark a dialog, in both directions, to be removed by reap
+        :param dialog: The dialog or an early dialog without the to_tag
+        :param linger: Seconds to keep the dialog after termination
+        """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        remove_time = time() + linger
+        for key in (call_id, from_tag, to_tag), (call_id, to_tag, from_tag), (call_id, from_tag, ""):
+            if key in self.dialogs and key not in self.terminated:
+                self.mark_terminated(key, remove_time)
+
+    def terminate_call(self, dialog, linger):
+        """
+        Mark all the dialogs of a call to be removed by reap: the ones of the Call-ID of dialog that share a tag
+        with it, eg the dialogs created by forked responses besides the one that was ended by a BYE
+        :param dialog: The dialog that ended
+        :param linger: Seconds to keep the dialogs after termination
+        """
+        call_id, from_tag, to_tag = dialog_key(dialog)
+        tags = {tag for tag in (from_tag, to_tag) if tag}
+        remove_time = time() + linger
+        for key in self.call_ids.get(call_id, ()):
+            if (key[1] in tags or key[2] in tags) and key not in self.terminated:
+                self.mark_terminated(key, remove_time)
+
+    def mark_terminated(self, key, remove_time):
+        """ Keep the dialog of key to be removed by reap at remove_time """
+        self.terminated[key] = remove_time
+        heappush(self.removals, (remove_time, next(self.removal_order), key))
+
+    def reap(self, early_ttl):
+        """
+        Remove the terminated dialogs that have lingered enough and the early dialogs older than early_ttl
+        :param early_ttl: Seconds an early dialog is kept without a to_tag
+        :return: The removed dialogs
+        """
+        now = time()
+        removed = []
+        while self.removals and self.removals[0][0] <= now:
+            remove_time, _, key = heappop(self.removals)
+            if self.terminated.get(key) != remove_time:
+                continue
+            removed.append(self.dialogs[key])
+            self.remove(self.dialogs[key])
+        while self.early:
+            key, created = next(iter(self.early.items()))
+            if created + early_ttl > now:
+                break
+            removed.append(self.dialogs[key])
+            self.remove(self.dialogs[key])
+        return removed
+
+    def statistics(self):
+        return {"Dialogs": len(self.dialogs),
+                "Early Dialogs": len(self.early),
+                "Terminated Dialogs": len(self.terminated)}
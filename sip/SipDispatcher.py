@@ -0,0 +1,74 @@
+"""\
+Purpose: Route the messages received on a connection shared by many SipEndpoints to the endpoint they are for
+"""
+from threading import Lock
+
+from sip.SipMessage import get_user_from_message
+
+
+def get_user(sip_message, header=None):
+    """
+    :param sip_message: A SipMessage
+    :param header: The header with the URI. The Request-URI if None
+    :return: The user part of the URI or None
+    """
+    uri = get_user_from_message(sip_message, header)
+    if uri is None:
+        return None
+    return uri.split("@")[0]
+
+
+class SipDispatcher(object):
+    """
+    Connection level routing of incoming messages.
+
+    Every message is looked up first by Call-ID in the dialogs started or joined by the endpoints of the connection
+    and then by the user of its Request-URI (or To header) in their numbers. The message is put directly in the
+    buffer of the endpoint found, so endpoints sharing the connection don't share a buffer and don't scan each
+    other's messages.
+    """
+
+    def __init__(self):
+        # Updated by the endpoint threads, looked up by the thread receiving on the connection
+        self.lock = Lock()
+        self.call_ids = {}
+        self.users = {}
+
+    def add_endpoint(self, endpoint):
+        """ Route the requests to the number of endpoint and the messages of its known dialogs to it """
+        with self.lock:
+            self.users[endpoint.number] = endpoint
+            for call_id in list(endpoint.known_call_ids):
+                self.call_ids[call_id] = endpoint
+
+    def remove_endpoint(self, endpoint):
+        with self.lock:
+            if self.users.get(endpoint.number) is endpoint:
+                del self.users[endpoint.number]
+            for call_id in [c for c, e in self.call_ids.items() if e is endpoint]:
+                del self.call_ids[call_id]
+
+    def add_call_id(self, call_id, endpoint):
+        """ Route the messages of a dialog to endpoint """
+        with self.lock:
+            self.call_ids[call_id] = endpoint
+
+    def remove_call_id(self, call_id, endpoint=None):
+        """ Stop routing the messages of a dialog, if they are routed to endpoint when it is given """
+        with self.lock:
+            if endpoint is None or self.call_ids.get(call_id) is endpoint:
+                self.call_ids.pop(call_id, None)
+
+    def route(self, inmessage):
+        """
+        :param inmessage: A received SipMessage
+        :return: The endpoint the message is for or None if it is unknown
+        """
+        endpoint = self.call_ids.get(inmessage["Call-ID"])
+        if endpoint is not None:
+            return endpoint
+        if inmessage.type == "Request":
+            endpoint = self.users.get(get_user(inmessage))
+            if endpoint is not None:
+                return endpoint
+        return self.users.get(get_user(inmessage, "To"))
@@ -2,7 +2,7 @@
 Purpose: Simulate a SIP phone/line appearance/user
 Initial Version: Costas Skarakis
 """
-from threading import Timer, Event
+import common.timers as timers
 
 from _socket import timeout as sock_timeout
 import traceback
@@ -10,8 +10,14 @@ from common.tc_logging import exception, warning
 from sip.SipParser import parseBytes, buildMessage
 import common.util as util
 import common.client as client
+import common.reactor as reactor
 import sip.SipFlows as flow
+from sip.SipDispatcher import SipDispatcher
+from sip.SipDialogs import DialogTable, DIALOG_CREATING
+from sip.SipMessageBuffer import MessageBuffer
+from sip.SipTransactions import TransactionTable, response_matches
 from threading import Lock, Thread
+from collections import ChainMap
 from sip.SipMessage import SipMessage
 from time import time, sleep
 
@@ -42,10 +48,19 @@ class SipEndpoint(object):
                            "cseq": "0",
                            "method": None
                            }
-        self.last_messages_per_dialog = []
-        self.dialogs = []
-        self.known_call_ids = []
-        self.requests = []
+        self.dialogs = DialogTable()
+        self.dialogs.listeners.append(self.forget_dialog)
+        # Seconds a terminated dialog is kept to recognize retransmissions and late messages, 64*T1
+        self.dialog_linger = 32.0
+        # Seconds a dialog is kept without a to_tag, eg an INVITE that is never answered
+        self.early_dialog_ttl = 300.0
+        # Seconds between the sweeps of the terminated and early dialogs, which run also when the endpoint is idle
+        self.reap_interval = 32.0
+        self.reap_timer = None
+        # Runs the sweeps, see AsyncSipEndpoint.connect
+        self.call_later = timers.call_later
+        self.known_call_ids = set()
+        self.transactions = TransactionTable()
         self.current_dialog = {
             "Call-ID": None,
             "from_tag": None,
@@ -61,14 +76,18 @@ class SipEndpoint(object):
         self.waitForMessage = self.wait_for_message  # compatibility alias
         self.reply_to = self.send_in_ctx_of  # method alias
         self.secondary_lines = []
-        self.message_buffer = set()
-        self.buffer_event = Event()
+        self.message_buffer = MessageBuffer()
         # self.buffer_mod_count = [0]  # using a int in a list to be able to share and muate between objects in use_link()
         self.registered = False
         self.re_register_timer = None
+        # Fraction of re_register_time to re-register earlier at random, so that the endpoints registered
+        # together do not re-register together
+        self.re_register_jitter = 0.1
         self.busy = False
         self.lock = Lock()
         self.wait_thread = None
+        # The shared reactor that receives for this endpoint instead of the wait thread, see common.reactor
+        self.reactor = None
         self.shutdown_flag = False
 
     def shutdown(self):
@@ -76,8 +95,19 @@ class SipEndpoint(object):
         Try to stop threads and cleanup connections
         """
         self.shutdown_flag = True
-        self.link.shutdown()
-        self.wait_thread.join()
+        if self.re_register_timer:
+            self.re_register_timer.cancel()
+        with self.lock:
+            if self.reap_timer:
+                self.reap_timer.cancel()
+        if self.link.dispatcher is not None:
+            self.link.dispatcher.remove_endpoint(self)
+        if self.reactor:
+            self.reactor.unregister(self.link)
+            self.link.shutdown()
+        else:
+            self.link.shutdown()
+            self.wait_thread.join()
 
     def make_busy(self, busy=True):
         self.busy = busy
@@ -120,7 +150,12 @@ class SipEndpoint(object):
         """
         Starts a separate thread that will consume incoming csta traffic and place it into buffers
         """
-        if self.wait_thread is None:
+        if self.wait_thread is not None or self.reactor is not None:
+            return
+        if reactor.is_enabled():
+            self.reactor = reactor.get_reactor()
+            self.reactor.register(self.link, self.buffer_incoming)
+        else:
             self.wait_thread = Thread(target=self.wait_loop, daemon=True)
             self.wait_thread.start()
 
@@ -140,13 +175,38 @@ class SipEndpoint(object):
                 warning("Disconnected. Will retry in 1 second")
                 sleep(1)
             else:
-                inmessage = parseBytes(inbytes)
-                # TODO: Add "on message" functionality, eg 200OK on OPTIONS
-                try:
-                    self.message_buffer.add(inmessage)
-                    self.buffer_event.set()
-                except:
-                    exception(traceback.format_exc())
+                self.buffer_incoming(inbytes)
+
+    def buffer_incoming(self, inbytes):
+        """
+        Buffer a message received on the link. Called by the wait thread or the reactor
+        :param inbytes: The message bytes. None from the reactor when the connection is closed
+        """
+        if inbytes is None:
+            if not self.shutdown_flag:
+                warning("{} Disconnected".format(self.number))
+            return
+        inmessage = parseBytes(inbytes, lazy=True)
+        # TODO: Add "on message" functionality, eg 200OK on OPTIONS
+        try:
+            endpoint = self
+            if self.link.dispatcher is not None:
+                endpoint = self.link.dispatcher.route(inmessage) or self
+            if endpoint.transactions.received(inmessage, self.link):
+                endpoint.deliver(inmessage)
+        except:
+            exception(traceback.format_exc())
+
+    def deliver(self, inmessage):
+        """ Add a received message to the buffer and wake up the waiting thread """
+        self.message_buffer.add(inmessage)
+
+    def add_call_id(self, call_id):
+        """ Track a new dialog. Its messages are routed to this endpoint when sharing a connection """
+        with self.lock:
+            self.known_call_ids.add(call_id)
+        if self.link is not None and self.link.dispatcher is not None:
+            self.link.dispatcher.add_call_id(call_id, self)
 
     def update_to_tag(self, in_dialog):
         """
@@ -155,14 +215,10 @@ class SipEndpoint(object):
         :return: None
         """
         with self.lock:
-            for dialog in self.dialogs:
-                if dialog["Call-ID"] == in_dialog["Call-ID"] \
-                        and dialog["from_tag"] == in_dialog["from_tag"] \
-                        and not dialog["to_tag"]:
-                    dhash = dialog_hash(dialog)
-                    dialog["to_tag"] = in_dialog["to_tag"]
-                    dhash_complete = dialog_hash(dialog)
-                    self.tags[dhash_complete] = self.tags[dhash]
+            dhash = dialog_hash({"Call-ID": in_dialog["Call-ID"], "from_tag": in_dialog["from_tag"], "to_tag": ""})
+            dialog = self.dialogs.set_to_tag(in_dialog)
+            if dialog is not None:
+                self.tags[dialog_hash(dialog)] = self.tags[dhash]
 
     def get_complete_dialog(self, in_dialog):
         """
@@ -174,12 +230,7 @@ class SipEndpoint(object):
         if in_dialog["to_tag"]:
             return in_dialog
         with self.lock:
-            for dialog in self.dialogs:
-                if dialog["Call-ID"] == in_dialog["Call-ID"] \
-                        and dialog["from_tag"] == in_dialog["from_tag"] \
-                        and dialog["to_tag"]:
-                    return dialog
-            return in_dialog
+            return self.dialogs.complete_dialog(in_dialog) or in_dialog
 
     def set_address(self, address):
         """
@@ -194,21 +245,33 @@ class SipEndpoint(object):
         self.parameters["source_ip"] = local_ip
         self.parameters["source_port"] = local_port
 
-    def use_link(self, other):
+    def use_link(self, other, dispatch=False):
         """ Convenience function to use an existing network connection
         If parameter is SipEndpoint, we will use also share a common message buffer and dialog tracking
+
+        :param other: A SipEndpoint or a link
+        :param dispatch: Keep own buffers and dialogs. The connection routes every message directly to the
+                         endpoint it is for, see sip.SipDispatcher
         """
-        if isinstance(other, SipEndpoint):
+        if dispatch:
+            link = other.link if isinstance(other, SipEndpoint) else other
+            if link.dispatcher is None:
+                link.dispatcher = SipDispatcher()
+            if isinstance(other, SipEndpoint):
+                link.dispatcher.add_endpoint(other)
+            link.dispatcher.add_endpoint(self)
+        elif isinstance(other, SipEndpoint):
             link = other.link
             self.message_buffer = other.message_buffer
             self.dialogs = other.dialogs
-            self.requests = other.requests
-            self.last_messages_per_dialog = other.last_messages_per_dialog
-            self.buffer_event = other.buffer_event
+            self.transactions = other.transactions
+            if self.forget_dialog not in self.dialogs.listeners:
+                self.dialogs.listeners.append(self.forget_dialog)
             self.wait_thread = other.wait_thread
+            self.reactor = other.reactor
         else:
             link = other
-        protocol = ["TCP", "UDP"][link.socket.proto]
+        protocol = "UDP" if isinstance(link, client.UDPClient) else "TCP"
         local_ip = link.ip
         local_port = link.port
         dest_ip = link.rip
@@ -223,6 +286,31 @@ class SipEndpoint(object):
         self.parameters["transport"] = protocol
         # self.link.endpoints_connected += 1
 
+    def for_link(self, link):
+        """
+        A view of this endpoint that sends on another link, so that many links can be sent on concurrently, eg by
+        a SipServer. It shares the dialogs, message buffer and transactions of this endpoint. The link, the current
+        dialog and transaction and the parameters set while sending are its own. The other parameters are read
+        from this endpoint
+
+        :param link: The link to send on
+        :return: The new SipEndpoint
+        """
+        endpoint = SipEndpoint(self.number)
+        endpoint.parameters = ChainMap({}, self.parameters)
+        endpoint.lock = self.lock
+        endpoint.message_buffer = self.message_buffer
+        endpoint.dialogs = self.dialogs
+        endpoint.tags = self.tags
+        endpoint.known_call_ids = self.known_call_ids
+        endpoint.transactions = self.transactions
+        endpoint.dialog_linger = self.dialog_linger
+        endpoint.early_dialog_ttl = self.early_dialog_ttl
+        # The sweeps of the shared dialogs are run by this endpoint
+        endpoint.schedule_reap = self.schedule_reap
+        endpoint.use_link(link)
+        return endpoint
+
     def get_dialog(self):
         """ Will use this method to get thread-local dialogs """
         return {"Call-ID": self.parameters["callId"],
@@ -243,13 +331,15 @@ class SipEndpoint(object):
             if key not in dialog:
                 exception("Not a valid dialog. Missing key: " + key)
         dialog = self.get_complete_dialog(dialog)
-        if dialog not in self.dialogs:
-            self.dialogs.append(dialog)
-            self.known_call_ids.append(dialog["Call-ID"])
-            self.requests.append([])
-            # If we don't know this dialog it means we didn't started so it must be an incoming Request
-            with self.lock:
+        with self.lock:
+            new_dialog = dialog not in self.dialogs
+            if new_dialog:
+                self.dialogs.append(dialog)
+                # If we don't know this dialog it means we didn't started so it must be an incoming Request
                 self.tags[dialog_hash(dialog)] = "to_tag"
+        if new_dialog:
+            self.add_call_id(dialog["Call-ID"])
+            self.reap_dialogs()
         self.current_dialog = dialog
         self.parameters["callId"] = dialog["Call-ID"]
         self.parameters["fromTag"] = dialog["from_tag"]
@@ -320,9 +410,10 @@ class SipEndpoint(object):
         self.parameters["toTag"] = dialog["to_tag"]
         with self.lock:
             self.tags[dialog_hash(dialog)] = "from_tag"
-        self.dialogs.append(dialog)
-        self.known_call_ids.append(dialog["Call-ID"])
-        self.requests.append([])
+        with self.lock:
+            self.dialogs.append(dialog)
+        self.add_call_id(dialog["Call-ID"])
+        self.reap_dialogs()
         return dialog
 
     def get_last_message_in(self, dialog):
@@ -332,26 +423,16 @@ class SipEndpoint(object):
         if self.current_dialog == null_d or dialog == null_d:
             return None
         with self.lock:
-            # First check for complete dialogs
-            for message in self.last_messages_per_dialog:
-                if message.get_dialog() == dialog:
-                    return message
-            # Second check for incomplete dialogs
-            for message in self.last_messages_per_dialog:
-                d = message.get_dialog()
-                if d["Call-ID"] == dialog["Call-ID"] and d["from_tag"] == dialog["from_tag"]:
-                    return message
+            message = self.dialogs.last_message(dialog)
+        if message is not None:
+            return message
         raise Exception("No message found in dialog {}. Other dialogs active: ".format(dialog, self.dialogs))
 
     def save_message(self, message):
         """ Search for previously received message in the same dialog.
             If found, replace with given message, otherwise append message to message list """
         with self.lock:
-            for i in range(len(self.last_messages_per_dialog)):
-                if message.get_dialog() == self.last_messages_per_dialog[i].get_dialog():
-                    self.last_messages_per_dialog[i] = message
-                    return
-            self.last_messages_per_dialog.append(message)
+            self.dialogs.save_message(message)
 
     def prepare_message(self, message):
         """
@@ -377,16 +458,21 @@ class SipEndpoint(object):
             # which should not be none because what are we sending ACK or CANCEL to?
             transaction = last_message_in_dialog.get_transaction()
             cseq = transaction["cseq"]
+            # RFC 3261 9.1 and 17.1.1.3: CANCEL and the ACK of a non-2xx response belong to the INVITE transaction
+            if method == "CANCEL" or (last_message_in_dialog.type == "Response" and
+                                      not last_message_in_dialog.status.startswith("2")):
+                branch = transaction["via_branch"]
         elif last_message_in_dialog:
             transaction = last_message_in_dialog.get_transaction()
             cseq = str(int(transaction["cseq"]) + 1)
         else:
             with self.lock:
-                cseq = str(len(self.requests[self.dialogs.index(dialog)]))
+                requests = self.dialogs.requests(dialog)
+                cseq = str(len(requests))
                 if method != "REGISTER":
                     # Ignore REGISTER otherwise unregister breaks
                     # TODO: check if reRegistrations will work
-                    self.requests[self.dialogs.index(dialog)].append(method)
+                    requests.append(method)
         transaction = {"via_branch": branch, "cseq": cseq, "method": method}
         self.set_transaction(transaction)
         return transaction
@@ -421,7 +507,7 @@ class SipEndpoint(object):
         m.set_dialog_from(new_dialog)
         m.set_transaction_from(new_transaction)
 
-        self.link.send(m.contents())
+        self.transmit(m)
         self.save_message(m)
 
         if expected_response:
@@ -487,41 +573,56 @@ class SipEndpoint(object):
                     self.tags[dialog_hash(dialog)] == "to_tag":
                 self.switch_tags(dialog)
             m.set_dialog_from(dialog)
-        else:
+        m.set_transaction_from(self.get_transaction())
+        if m.type == "Response":
             self.free_resources(m)
         self.save_message(m)
 
-        m.set_transaction_from(self.get_transaction())
-        self.link.send(m.contents())
+        self.transmit(m)
         return m
 
-    def get_buffered_message(self, message_type, dialog):
+    def transmit(self, message):
+        """ Send a message on the link, through the transaction layer that retransmits it over UDP """
+        data = message.contents()
+        self.transactions.sent(message, data, self.link)
+        self.link.send(data)
+
+    def wanted_call_ids(self, dialog):
+        """
+        :param dialog: The dialog to expect a message in or None for any known dialog
+        :return: The Call-IDs of the messages that can be taken from the buffer, None for any
+        """
+        if self.current_dialog["Call-ID"] is None:
+            # If we have received no messages yet return the first message in the buffer
+            return None
+        if dialog is not None:
+            return dialog["Call-ID"],
+        # Iterated by the buffer, so it is read and changed only under self.lock, see get_buffered_message
+        return self.known_call_ids
+
+    def get_buffered_message(self, message_type, dialog, waiter=None, exclude=()):
         """
         Return the first buffered message found in the given dialog
 
         :param message_type: the requested message type
         :param dialog: The dialog in question
+        :param waiter: The Waiter of the calling thread, see common.waiters
+        :param exclude: Messages already taken and buffered again by the caller
         :return: the buffered SipMessage
         """
-        msg = None
-        # for message in self.message_buffer:
         with self.lock:
-            for message in self.message_buffer:
-                m_dialog = message.get_dialog()
-                m_type = message.get_status_or_method()
-                # If we have received no messages yet return the first message in the buffer
-                if message_type in m_type \
-                        and (self.current_dialog["Call-ID"] is None
-                             or (dialog is not None and m_dialog["Call-ID"] == dialog["Call-ID"])
-                             or (dialog is None and m_dialog["Call-ID"] in self.known_call_ids)):
-                    msg = message
-                    self.message_buffer.remove(message)
-                    break
-                # else:
-                #     self.message_buffer.append(message)
-        # if msg is None:
-        #     print(self.number, "Buffer returned None for", message_type, "in callid and from_tag", dialog["Call-ID"], dialog["from_tag"], "although it has", self.message_buffer)
-        return msg
+            message = self.message_buffer.take(message_type, self.wanted_call_ids(dialog), exclude)
+        if message is not None and waiter is not None:
+            waiter.took(message)
+        return message
+
+    def register_waiter(self, message_type, dialog, event=None):
+        """
+        Register the calling thread to be woken up only by the messages get_buffered_message can return
+        :return: The Waiter, to be unregistered from self.message_buffer.waiters
+        """
+        return self.message_buffer.waiters.register(
+            lambda m: self.message_buffer.matches(m, message_type, self.wanted_call_ids(dialog)), event)
 
     def wait_for_message(self, message_type, dialog=None, ignore_messages=(), timeout=5.0):
         """
@@ -540,6 +641,72 @@ class SipEndpoint(object):
         :return: A SipMessage constructed from the incoming message
         """
 
+        explicit_dialog, dialog, last_sent_message, transaction = self.wait_context(dialog)
+
+        # Registered before the buffer is checked, so that a message buffered in between wakes us up
+        # The challenge to the last request is taken too, and answered by handleDA
+        taken_types = self.challenge_types(message_type, last_sent_message)
+        waiter = self.register_waiter(taken_types, explicit_dialog)
+        # Messages taken and buffered again for another dialog or line
+        rejected = []
+        try:
+            t0_tout = time()
+            taken = self.get_buffered_message(taken_types, explicit_dialog, waiter)
+            inmessage = self.handleDA(last_sent_message, taken)
+
+            while not inmessage:
+                rem_timeout = timeout - (time() - t0_tout)
+                if rem_timeout > 0:
+                    # If a message was taken, there may be more in the buffer that did not wake us up
+                    if taken is None:
+                        waiter.wait(rem_timeout)
+                    taken = self.get_buffered_message(taken_types, explicit_dialog, waiter, rejected)
+                    inmessage = self.handleDA(last_sent_message, taken)
+                    if inmessage is None:
+                        continue
+                else:
+                    exception("%s No %s. Buffer length: %d." % (self.number,
+                                                                message_type,
+                                                                len(self.message_buffer)))
+                    raise sock_timeout
+
+                # if not inmessage:
+                #     # no (more) buffered messages. try the network
+                #     inbytes = self.link.waitForSipData(timeout=timeout, client=link)
+                #     inmessage = self.handleDA(last_sent_message, parseBytes(inbytes))
+
+                if last_sent_message:
+                    # Its branch changes when it is sent again with authorization, see handleDA
+                    transaction = last_sent_message.get_transaction()
+                inmessage = self.check_received(inmessage, message_type, ignore_messages, dialog, transaction, waiter)
+                if inmessage is None:
+                    rejected.append(taken)
+        finally:
+            self.message_buffer.waiters.unregister(waiter)
+
+        return self.accept_received(inmessage, message_type, transaction)
+
+    @staticmethod
+    def challenge_types(message_type, last_sent_message):
+        """
+        :param message_type: The expected message type, see wait_for_message
+        :param last_sent_message: The last message in the expected dialog
+        :return: message_type and the 401 response, which can come instead of the response to a request
+        """
+        if not message_type or last_sent_message is None or last_sent_message.type != "Request":
+            return message_type
+        message_types = (message_type,) if isinstance(message_type, str) else tuple(message_type)
+        if "401 Unauthorized" in message_types:
+            return message_type
+        return message_types + ("401 Unauthorized",)
+
+    def wait_context(self, dialog=None):
+        """
+        Find what an incoming message will be checked against
+
+        :param dialog: The dialog to expect the message in. If None will expect a message in current dialog
+        :return: The explicit dialog or None, the expected dialog, the last message in it and its transaction
+        """
         # if not dialog:
         #     dialog = {"Call-ID": self.parameters["callId"],
         #               "from_tag": self.parameters["fromTag"]}
@@ -560,83 +727,68 @@ class SipEndpoint(object):
         transaction = None
         if last_sent_message:
             transaction = last_sent_message.get_transaction()
+        return explicit_dialog, dialog, last_sent_message, transaction
 
-        t0_tout = time()
-        inmessage = self.get_buffered_message(message_type, explicit_dialog)
-        inmessage = self.handleDA(last_sent_message, inmessage)
-
-        while not inmessage:
-            rem_timeout = timeout - (time() - t0_tout)
-            if rem_timeout > 0:
-                self.buffer_event.wait(rem_timeout)
-                self.buffer_event.clear()
-                inmessage = self.get_buffered_message(message_type, explicit_dialog)
-                inmessage = self.handleDA(last_sent_message, inmessage)
-                if inmessage is None:
-                    continue
-            else:
-                exception("%s No %s. Buffer length: %d." % (self.number,
-                                                            message_type,
-                                                            len(self.message_buffer)))
-                raise sock_timeout
-
-            # if not inmessage:
-            #     # no (more) buffered messages. try the network
-            #     inbytes = self.link.waitForSipData(timeout=timeout, client=link)
-            #     inmessage = self.handleDA(last_sent_message, parseBytes(inbytes))
-
-            inmessage_type = inmessage.get_status_or_method()
-            inmessage_dialog = inmessage.get_dialog()
-            inmessage.cseq_method = inmessage.get_transaction()["method"]
-
-            # when sharing buffers we can get a message of other endpoints
-            # buffer message of correct type but unknown callid
-            # keep it if we are mentioned in the "To" header
-            if inmessage_type == message_type and \
-                    inmessage_dialog["Call-ID"] not in self.known_call_ids and \
-                    "sip:{}@{}".format(self.number, self.ip) not in inmessage["To"]:
+    def check_received(self, inmessage, message_type, ignore_messages, dialog, transaction, waiter=None):
+        """
+        Check a message taken from the buffer against the expected one
+
+        :param waiter: The Waiter of the calling thread. It is not woken up by the message if it is buffered again
+        :return: The message if it is the expected one. None if it was buffered again for another dialog or line
+                 or if it is ignored
+        :raises AssertionError: If the message is unexpected and belongs to no known dialog or line
+        """
+        inmessage_type = inmessage.get_status_or_method()
+        inmessage_dialog = inmessage.get_dialog()
+        inmessage.cseq_method = inmessage.get_transaction()["method"]
+
+        # when sharing buffers we can get a message of other endpoints
+        # buffer message of correct type but unknown callid
+        # keep it if we are mentioned in the "To" header
+        if inmessage_type == message_type and \
+                inmessage_dialog["Call-ID"] not in self.known_call_ids and \
+                "sip:{}@{}".format(self.number, self.ip) not in inmessage["To"]:
+            # print(self.number, "Aborting", inmessage_type, "with callid", inmessage_dialog["Call-ID"])
+            # print(self.number, "My callid is", dialog["Call-ID"])
+
+            self.message_buffer.add(inmessage, skip=waiter)
+            return None
+
+        if inmessage_type in ignore_messages:
+            return None
+
+        if message_type and \
+                ((isinstance(message_type, str) and message_type not in inmessage_type) or
+                 (type(message_type) in (list, tuple) and not any([m in inmessage_type for m in message_type])) or
+                 (inmessage.type == "Response" and not response_matches(inmessage, transaction))):
+            # we have received an unexpected message. buffer it if there is an active dialog for it
+            if self.get_complete_dialog(inmessage_dialog) or inmessage_type == "INVITE":
+                # message is part of another active dialog or a new call, so buffer it
                 # print(self.number, "Aborting", inmessage_type, "with callid", inmessage_dialog["Call-ID"])
-                # print(self.number, "My callid is", dialog["Call-ID"])
-
-                self.message_buffer.add(inmessage)
-                self.buffer_event.set()
-                inmessage = None
-                continue
-
-            if inmessage_type in ignore_messages:
-                inmessage = None
-                continue
-
-            if message_type and \
-                    ((isinstance(message_type, str) and message_type not in inmessage_type) or
-                     (type(message_type) in (list, tuple) and not any([m in inmessage_type for m in message_type])) or
-                     (inmessage.type == "Response" and inmessage.cseq_method != transaction["method"])):
-                # we have received an unexpected message. buffer it if there is an active dialog for it
-                if self.get_complete_dialog(inmessage_dialog) or inmessage_type == "INVITE":
-                    # message is part of another active dialog or a new call, so buffer it
-                    # print(self.number, "Aborting", inmessage_type, "with callid", inmessage_dialog["Call-ID"])
-                    self.message_buffer.add(inmessage)
-                    self.buffer_event.set()
-                    # print("Appended {} with {} to buffer. Will keep waiting for {} in {} ".format(inmessage_type,
-                    #                                                                        inmessage_dialog,
-                    #                                                                        message_type,
-                    #                                                                            dialog))
-                    inmessage = None
+                self.message_buffer.add(inmessage, skip=waiter)
+                # print("Appended {} with {} to buffer. Will keep waiting for {} in {} ".format(inmessage_type,
+                #                                                                        inmessage_dialog,
+                #                                                                        message_type,
+                #                                                                            dialog))
+                return None
+            else:
+                d = ["sip:{}@".format(line.number) in inmessage["To"] for line in self.secondary_lines]
+                if any(d):
+                    # message is meant for another line in this device
+                    self.secondary_lines[d.index(True)].deliver(inmessage)
+                    return None
                 else:
-                    d = ["sip:{}@".format(line.number) in inmessage["To"] for line in self.secondary_lines]
-                    if any(d):
-                        # message is meant for another line in this device
-                        self.secondary_lines[d.index(True)].message_buffer.add(inmessage)
-                        inmessage = None
-                    else:
-                        raise AssertionError('{}: Got "{}" in {} while expecting "{}" in {}. '
-                                             'Other active dialogs:{}.'.format(self.number,
-                                                                               inmessage_type,
-                                                                               inmessage_dialog,
-                                                                               message_type,
-                                                                               dialog,
-                                                                               self.dialogs))
+                    raise AssertionError('{}: Got "{}" in {} while expecting "{}" in {}. '
+                                         'Other active dialogs:{}.'.format(self.number,
+                                                                           inmessage_type,
+                                                                           inmessage_dialog,
+                                                                           message_type,
+                                                                           dialog,
+                                                                           self.dialogs))
+        return inmessage
 
+    def accept_received(self, inmessage, message_type, transaction):
+        """ Update the dialog and transaction state with the expected message that was received """
         self.save_message(inmessage)
         if inmessage.type == "Request":
             inmessage_transaction = inmessage.get_transaction()
@@ -648,8 +800,9 @@ class SipEndpoint(object):
                                                           message_type,
                                                           transaction["method"])
             self.update_to_tag(inmessage.get_dialog())
-            self.free_resources(inmessage)
         self.set_dialog(inmessage.get_dialog())
+        # After set_dialog, so that a 2xx from a fork confirms the dialog it creates
+        self.free_resources(inmessage)
         return inmessage
 
     def wait_for_messages(self, *list_of_message_types, in_order=False, ignore_messages=[]):
@@ -699,28 +852,33 @@ class SipEndpoint(object):
         })
 
     def handleDA(self, request, response):
-        """" Add DA to message and send again """
+        """"
+        Add DA to the request and send it again if the response is its 401.
+        The response to the new request will come through the buffer, so None is returned in that case
+        """
         if response is None:
-            return
+            return None
         # Usual case in lab, password same as username
         if "da_pass" not in self.parameters or "da_user" not in self.parameters:
             self.set_digest_credentials(self.number, self.number, "")
         user, pwd = self.parameters["da_user"], self.parameters["da_pass"]
-        if response.type == "Response" and response.status == "401 Unauthorized":
+        if response.type == "Response" and response.status == "401 Unauthorized" and \
+                request is not None and response_matches(response, request.get_transaction()):
             request.addAuthorization(response["WWW-Authenticate"], user, pwd)
-            self.link.send(request.contents())
-            inBytes = self.link.waitForSipData()
-            return parseBytes(inBytes)
-        else:
-            return response
+            # A new transaction, RFC 3261 8.1.3.5. A late retransmission of the 401 must not match it
+            request.via_branch = util.randomBranch()
+            self.transmit(request)
+            return None
+        return response
 
     def register(self, expiration_in_seconds=360, re_register_time=180):
         """ Convenience function to register a SipEndpoint """
         if not expiration_in_seconds:
             return self.unregister()
         if re_register_time and self.registered:
-            self.re_register_timer = Timer(re_register_time, self.register, (expiration_in_seconds, re_register_time))
-            self.re_register_timer.start()
+            self.re_register_timer = timers.call_later(re_register_time, self.register,
+                                                       (expiration_in_seconds, re_register_time),
+                                                       jitter=self.re_register_jitter)
         flow.register(self, expiration_in_seconds)
         self.reset_dialog_and_transaction()
         self.registered = True
@@ -733,19 +891,88 @@ class SipEndpoint(object):
         self.registered = False
 
     def free_resources(self, message):
-        """ Free memory allocated to a cleared call """
-
+        """
+        Terminate the dialog of a message that ends it. It is removed after self.dialog_linger seconds
+        :param message: A SipMessage sent or received
+        """
+        if message.type != "Response" or message.status.startswith("1"):
+            return
         status_or_method = message.get_status_or_method()
         cseq_method = message["CSeq"].split()[1]
-        call_ended_successfully = status_or_method.startswith("2") and cseq_method in ("BYE", "CANCEL")
-        call_rejected_with_error = status_or_method[0] in "3456"
-        if call_ended_successfully or call_rejected_with_error:
-            dialog = message.get_dialog()
-            with self.lock:
-                dialog_index = self.dialogs.index(dialog)
-                # self.dialogs.pop(dialog_index)
-                # self.requests.pop(dialog_index)
-                # self.tags.pop(dialog_hash(dialog))
-                # self.last_messages_per_dialog.pop(dialog_index)
-                # print("Cleared call number", dialog_index, "after message", status_or_method, "with cseq", cseq_method,
-                #       ". Sizes are", len(self.dialogs), len(self.requests), len(self.tags))
+        dialog = message.get_dialog()
+        with self.lock:
+            if status_or_method.startswith("2") and cseq_method in DIALOG_CREATING:
+                self.dialogs.confirm(dialog)
+                return
+            confirmed = self.dialogs.is_confirmed(dialog)
+            call_ended_successfully = status_or_method.startswith("2") and cseq_method in ("BYE", "CANCEL")
+            # A failed re-INVITE does not end the call, unless the dialog does not exist anymore. Nor does a
+            # challenge or a 491 Request Pending, the request is sent again
+            call_rejected_with_error = status_or_method[0] in "3456" and \
+                status_or_method[:3] not in ("401", "407", "491") and \
+                (not confirmed or status_or_method[:3] in ("481", "408"))
+            # Eg REGISTER or OPTIONS, which are not sent in a dialog, or a keep-alive NOTIFY that created its own.
+            # Not a NOTIFY of a SUBSCRIBE or a PRACK of an INVITE, whose dialog is not confirmed yet
+            transaction_completed = status_or_method.startswith("2") and not confirmed and \
+                (cseq_method not in ("NOTIFY", "PRACK", "UPDATE", "INFO") or
+                 self.dialogs.first_request(dialog) == cseq_method)
+            if call_ended_successfully:
+                self.dialogs.terminate_call(dialog, self.dialog_linger)
+            elif call_rejected_with_error or transaction_completed:
+                self.dialogs.terminate(dialog, self.dialog_linger)
+            else:
+                return
+        self.schedule_reap()
+
+    def reap_dialogs(self):
+        """
+        Remove the terminated dialogs that have lingered enough and the early dialogs older than
+        self.early_dialog_ttl, with their tags, routes and buffered messages
+        :return: The removed dialogs
+        """
+        with self.lock:
+            removed = self.dialogs.reap(self.early_dialog_ttl)
+            pending = self.dialogs.terminated or self.dialogs.early
+        for dialog in removed:
+            for listener in list(self.dialogs.listeners):
+                listener(dialog)
+        if pending:
+            self.schedule_reap()
+        return removed
+
+    def schedule_reap(self):
+        """ Run reap_dialogs in self.reap_interval seconds, unless it is scheduled already """
+        with self.lock:
+            if self.reap_timer is None and not self.shutdown_flag:
+                self.reap_timer = self.call_later(self.reap_interval, self.periodic_reap)
+
+    def periodic_reap(self):
+        """ Sweep the dialogs. Scheduled again by reap_dialogs while there are terminated or early dialogs """
+        with self.lock:
+            self.reap_timer = None
+        self.reap_dialogs()
+
+    def forget_dialog(self, dialog):
+        """ Called for every dialog removed from self.dialogs, also by the endpoints sharing them """
+        call_id = dialog["Call-ID"]
+        with self.lock:
+            for tags in (dialog["from_tag"], dialog["to_tag"]), (dialog["to_tag"], dialog["from_tag"]), \
+                    (dialog["from_tag"], ""):
+                self.tags.pop(dialog_hash({"Call-ID": call_id, "from_tag": tags[0], "to_tag": tags[1]}), None)
+            forgotten = call_id in self.known_call_ids and not self.dialogs.has_call_id(call_id)
+            if forgotten:
+                self.known_call_ids.discard(call_id)
+        if forgotten:
+            if self.link is not None and self.link.dispatcher is not None:
+                self.link.dispatcher.remove_call_id(call_id, self)
+            self.message_buffer.discard(call_id)
+
+    def get_statistics(self):
+        """ :return: The live counts of the dialog tracking and buffering of this endpoint """
+        with self.lock:
+            statistics = self.dialogs.statistics()
+            statistics["Known Call-IDs"] = len(self.known_call_ids)
+            statistics["Tags"] = len(self.tags)
+        statistics["Buffered Messages"] = len(self.message_buffer)
+        statistics["Transactions"] = len(self.transactions)
+        return statistics
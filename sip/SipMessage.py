@@ -4,9 +4,192 @@ Initial Version: Costas Skarakis 11/11/2018
 """
 
 import re
+import sys
 import hashlib
+from functools import lru_cache
 from common import util
 
+TAG = re.compile(r"tag=([^;]+)")
+BRANCH = re.compile(r"branch=([^;]+)")
+TAG_VALUE = re.compile("tag=[^;]+")
+BRANCH_VALUE = re.compile("branch=[^;]+")
+# RFC 3261 Section 7.3.3 and later RFCs
+COMPACT_FORMS = {"a": "accept-contact",
+                 "b": "referred-by",
+                 "c": "content-type",
+                 "d": "request-disposition",
+                 "e": "content-encoding",
+                 "f": "from",
+                 "i": "call-id",
+                 "j": "reject-contact",
+                 "k": "supported",
+                 "l": "content-length",
+                 "m": "contact",
+                 "o": "event",
+                 "r": "refer-to",
+                 "s": "subject",
+                 "t": "to",
+                 "u": "allow-events",
+                 "v": "via",
+                 "x": "session-expires",
+                 "y": "identity"}
+
+
+@lru_cache(maxsize=1024)
+def index_key(name):
+    """ The case insensitive key of a header name. Compact forms have the same key as the full header name """
+    key = name.strip().lower()
+    return COMPACT_FORMS.get(key, key)
+
+
+class SipHeaders(object):
+    """
+    Ordered collection of SIP headers with constant time, case insensitive access.
+
+    Header names keep their original letter case and order for serialization.
+    Repeated headers, eg Via, are kept as multiple values of the same header:
+        headers["Via"] is the top Via
+        headers.get_all("Via") is the list of all Via values
+        headers.add("Via", value) adds another Via
+    For compatibility, headers["Via#1"] is the second Via, headers["Via#2"] the third etc.
+
+    Names and values are stored in a single flat list, name at even and value at odd positions, and header
+    names are interned so that all messages share one copy of every name.
+    """
+    __slots__ = ("_fields", "_index", "version")
+
+    def __init__(self, headers=()):
+        # name, value, name, value... in message order
+        self._fields = []
+        # index key to the position of the value in _fields, or to the list of positions for repeated headers
+        self._index = {}
+        # Incremented on every change
+        self.version = 0
+        if isinstance(headers, dict):
+            headers = headers.items()
+        for name, value in headers:
+            self.add(name.split("#")[0], value)
+
+    def add(self, name, value):
+        """ Add a header value after the existing ones, even if the header already exists """
+        name = sys.intern(name)
+        position = len(self._fields) + 1
+        self.version += 1
+        self._fields.append(name)
+        self._fields.append(value)
+        key = index_key(name)
+        positions = self._index.get(key)
+        if positions is None:
+            self._index[key] = position
+        elif isinstance(positions, int):
+            self._index[key] = [positions, position]
+        else:
+            positions.append(position)
+
+    def _positions(self, key):
+        """ :return: The positions in _fields of all the values of a header in message order """
+        positions = self._index.get(key, ())
+        if isinstance(positions, int):
+            return (positions,)
+        return positions
+
+    def _lookup(self, name):
+        """
+        :param name: The header name, optionally with a #position suffix
+        :return: The position in _fields of the requested value, or None
+        """
+        index = 0
+        if "#" in name:
+            name, index = name.split("#", maxsplit=1)
+            index = int(index)
+        positions = self._positions(index_key(name))
+        if index < len(positions):
+            return positions[index]
+        return None
+
+    def __getitem__(self, name):
+        position = self._lookup(name)
+        if position is None:
+            raise KeyError("%s not in message headers" % name)
+        return self._fields[position]
+
+    def __setitem__(self, name, value):
+        position = self._lookup(name)
+        if position is not None:
+            self._fields[position] = value
+            self.version += 1
+        else:
+            self.add(name.split("#")[0], value)
+
+    def __delitem__(self, name):
+        """ Remove a header with all of its values, or only the value at its #position suffix, eg "Via#1" """
+        if "#" in name:
+            position = self._lookup(name)
+            if position is None:
+                raise KeyError("%s not in message headers" % name)
+            items = [item for i, item in enumerate(self.items()) if 2 * i + 1 != position]
+        else:
+            key = index_key(name)
+            if key not in self._index:
+                raise KeyError("%s not in message headers" % name)
+            items = [(n, v) for n, v in self.items() if index_key(n) != key]
+        version = self.version
+        self._fields = []
+        self._index = {}
+        for n, v in items:
+            self.add(n, v)
+        self.version = version + 1
+
+    def __contains__(self, name):
+        return self._lookup(name) is not None
+
+    def __iter__(self):
+        """ Iterate over the header names, once for every repeated header """
+        for positions in self._index.values():
+            first = positions if isinstance(positions, int) else positions[0]
+            yield self._fields[first - 1]
+
+    def __len__(self):
+        return len(self._index)
+
+    def __eq__(self, other):
+        if isinstance(other, dict):
+            other = SipHeaders(other)
+        if not isinstance(other, SipHeaders):
+            return NotImplemented
+        return self._fields == other._fields
+
+    def __repr__(self):
+        return "SipHeaders(%s)" % self.items()
+
+    def keys(self):
+        return list(self)
+
+    def items(self):
+        """ :return: A list of (name, value) tuples, including every value of repeated headers """
+        return list(zip(self._fields[0::2], self._fields[1::2]))
+
+    def get(self, name, default=None):
+        try:
+            return self[name]
+        except KeyError:
+            return default
+
+    def get_all(self, name):
+        """ :return: The list of values of a header. Empty if the header does not exist """
+        return [self._fields[position] for position in self._positions(index_key(name))]
+
+    def pop(self, name, *default):
+        """ Remove a header with all of its values and return the first one, or only the value at its #position """
+        if name not in self and default:
+            return default[0]
+        value = self[name]
+        del self[name]
+        return value
+
+    def copy(self):
+        return SipHeaders(self.items())
+
 
 def get_user_from_message(sip_message, header=None):
     pattern = r"<?sip:([^;>]*).*[>;]"
@@ -24,39 +207,101 @@ def get_user_from_message(sip_message, header=None):
 class SipMessage(object):
     """
     Representation of a SIP message
-    """
 
-    def __init__(self, header_dict, body):
-        self.header = header_dict
-        self.headers = self.header
+    A message can be created with only its routing headers parsed (see sip.SipParser.parseBytes lazy mode).
+    In that case the complete header block is kept as undecoded bytes in raw_header and is parsed on first access.
+    The body can also be given as bytes, it is decoded on first access.
+
+    Messages are kept in per dialog histories for the whole duration of a test, so they have no __dict__.
+    Every attribute of a message must be listed in __slots__.
+    """
+    __slots__ = ("_header", "_routing", "_raw_header", "_contents", "_contents_state", "_body", "_encoding",
+                 "status", "method", "type", "status_line", "request_line", "to_tag", "from_tag", "via_branch",
+                 "cseq_method")
+
+    def __init__(self, header_dict, body, raw_header=None, encoding="utf8"):
+        if not isinstance(header_dict, SipHeaders):
+            header_dict = SipHeaders(header_dict)
+        self._header = header_dict
+        # The headers parsed eagerly when the rest are in raw_header
+        self._routing = None
+        self._raw_header = raw_header
+        # Serialization cache, see __repr__
+        self._contents = None
+        self._contents_state = None
         self.status = None
         self.method = None
         self.type = None
         self.status_line = ""
         self.request_line = ""
-        self.body = body
-        if body:
-            self.header["Content-Length"] = str(len(body.strip()) + 4)
+        # Set by the endpoint when the message is received
+        self.cseq_method = None
+        # body may be bytes or a memoryview slice of the receive buffer until it is read
+        self._body = body
+        self._encoding = encoding
+        if raw_header is None:
+            self.set_content_length()
         else:
-            self.header["Content-Length"] = "0"
+            self._routing = header_dict
         self.to_tag = ""
         self.from_tag = ""
         self.via_branch = ""
-        if "To" in self.header:
-            M = re.search(r"tag=([^;]+)", self.header["To"])
+        if "To" in header_dict:
+            M = TAG.search(header_dict["To"])
             if M:
                 self.to_tag = M.group(1)
-        if "From" in self.header:
-            M = re.search(r"tag=([^;]+)", self.header["From"])
+        if "From" in header_dict:
+            M = TAG.search(header_dict["From"])
             if M:
                 self.from_tag = M.group(1)
-        if "Via" in self.header:
-            M = re.search(r"branch=([^;]+)", self.header["Via"])
+        if "Via" in header_dict:
+            M = BRANCH.search(header_dict["Via"])
             if M:
                 self.via_branch = M.group(1)
 
+    @property
+    def header(self):
+        if self._raw_header is not None:
+            self.parse_raw_header()
+        return self._header
+
+    @header.setter
+    def header(self, header_dict):
+        if not isinstance(header_dict, SipHeaders):
+            header_dict = SipHeaders(header_dict)
+        self._raw_header = None
+        self._routing = None
+        self._header = header_dict
+
+    headers = header
+
+    @property
+    def body(self):
+        if not isinstance(self._body, str):
+            self._body = str(self._body, self._encoding)
+        return self._body
+
+    @body.setter
+    def body(self, body):
+        self._body = body
+
+    def parse_raw_header(self):
+        """ Parse the header lines that were not parsed when the message was received """
+        from sip.SipParser import parseHeaderLines
+        raw_header = str(self._raw_header, self._encoding)
+        self._header = parseHeaderLines(raw_header.split("\r\n") if raw_header else [])
+        self._raw_header = None
+        self._routing = None
+        self.set_content_length()
+
+    def set_content_length(self):
+        if self.body:
+            self._header["Content-Length"] = str(len(self.body.strip()) + 4)
+        else:
+            self._header["Content-Length"] = "0"
+
     def __hash__(self):
-        return hash(repr(self))
+        return hash(self.identity())
 
     def __eq__(self, other):
         """
@@ -68,6 +313,8 @@ class SipMessage(object):
         if isinstance(other, str):
             other_contents = other
         elif isinstance(other, SipMessage):
+            if self.identity() != other.identity():
+                return False
             other_contents = repr(other)
         else:
             raise Exception("Can only compare SipMessage to str or SipMessage, "
@@ -75,53 +322,86 @@ class SipMessage(object):
 
         return repr(self) == other_contents
 
+    def identity(self):
+        """
+        A cheap key for this message, eg for use in sets and buffers.
+        It is made of the first line and the dialog and transaction elements, so equal messages have equal identities.
+        In lazy parsed messages it does not need the headers that were not parsed yet.
+
+        :return: A tuple that identifies this message
+        """
+        return (self.request_line if self.type == "Request" else self.status_line,
+                self.get("Call-ID"),
+                self.get("CSeq"),
+                self.from_tag,
+                self.to_tag,
+                self.via_branch)
+
+    def get(self, key, default=None):
+        try:
+            return self[key]
+        except KeyError:
+            return default
+
     def __getitem__(self, key):
-        for k in self.header:
-            # handle different letter case
-            if k.upper() == key.upper():
-                return self.header[k]
-        raise KeyError("%s not in message headers" % key)
+        if self._routing is not None and key in self._routing:
+            return self._routing[key]
+        return self.header[key]
 
     def __setitem__(self, key, value):
         self.header[key] = value
 
+    def contents_state(self):
+        """ Everything the serialized message depends on. If it has not changed, the cached contents are valid """
+        return (self._header, self._header.version,
+                self.from_tag, self.to_tag, self.via_branch,
+                self.type, self.request_line, self.status_line, self.body)
+
+    def update_header(self, key, value):
+        """ Set a header only if its value changes, to avoid invalidating the cached contents """
+        if self.header[key] != value:
+            self.header[key] = value
+
     def __repr__(self):
+        header = self.header
+        if self._contents is not None and self._contents_state == self.contents_state():
+            return self._contents
+
         if self.from_tag:
-            if "tag" in self.header["From"]:
-                self.header["From"] = re.sub("tag=[^;]+", "tag=%s", self.header["From"]) % self.from_tag
+            if "tag" in header["From"]:
+                self.update_header("From", TAG_VALUE.sub("tag=%s", header["From"]) % self.from_tag)
             else:
-                self.header["From"] = self.header["From"] + ";tag=" + self.from_tag
+                self.update_header("From", header["From"] + ";tag=" + self.from_tag)
 
         if self.to_tag:
-            if "tag" in self.header["To"]:
-                self.header["To"] = re.sub("tag=[^;]+", "tag=%s", self.header["To"]) % self.to_tag
+            if "tag" in header["To"]:
+                self.update_header("To", TAG_VALUE.sub("tag=%s", header["To"]) % self.to_tag)
             else:
-                self.header["To"] = self.header["To"] + ";tag=" + self.to_tag
+                self.update_header("To", header["To"] + ";tag=" + self.to_tag)
         else:
-            if "tag" in self.header["To"]:
-                self.header["To"] = self.header["To"].split(";tag=")[0]
+            if "tag" in header["To"]:
+                self.update_header("To", header["To"].split(";tag=")[0])
 
         if self.via_branch:
-            if "branch" in self.header["Via"]:
-                self.header["Via"] = re.sub("branch=[^;]+", "branch=%s", self.header["Via"]) % self.via_branch
+            if "branch" in header["Via"]:
+                self.update_header("Via", BRANCH_VALUE.sub("branch=%s", header["Via"]) % self.via_branch)
             else:
-                self.header["Via"] = self.header["Via"] + ";branch=" + self.via_branch
+                self.update_header("Via", header["Via"] + ";branch=" + self.via_branch)
 
         if self.type == "Request":
             first_line = self.request_line
         else:
             first_line = self.status_line
         result = first_line + "\r\n"
-        result += "\r\n".join(k.split("#")[0] + ": " + v for k, v in self.header.items())
+        result += "\r\n".join(k + ": " + v for k, v in header.items())
         result += "\r\n"
         result += "\r\n" + self.body
+        self._contents = result
+        self._contents_state = self.contents_state()
         return result
 
     def get_transaction(self):
-        try:
-            cseq, method = self.header["CSeq"].split()
-        except:
-            cseq, method = self.header["cseq"].split()
+        cseq, method = self["CSeq"].split()
         return {"via_branch": self.via_branch,
                 "cseq": cseq,
                 "method": method
@@ -270,4 +550,33 @@ class SipMessage(object):
 
 
 if __name__ == "__main__":
-    pass
+    # Measure the memory footprint of received messages
+    import gc
+    import tracemalloc
+    from sip.SipParser import parseBytes
+    invite = b"INVITE sip:2000@10.0.0.1:5060;transport=TCP SIP/2.0\r\n" \
+             b"Via: SIP/2.0/TCP 10.0.0.2:5555;branch=z9hG4bK%d\r\n" \
+             b"Max-Forwards: 70\r\n" \
+             b"From: <sip:1000@10.0.0.2>;tag=ft%d\r\n" \
+             b"To: <sip:2000@10.0.0.1>\r\n" \
+             b"Call-ID: cid%d\r\n" \
+             b"CSeq: 1 INVITE\r\n" \
+             b"Contact: <sip:1000@10.0.0.2:5555;transport=tcp>\r\n" \
+             b"Allow: INVITE, ACK, BYE, CANCEL\r\n" \
+             b"Supported: timer\r\n" \
+             b"User-Agent: test\r\n" \
+             b"Content-Type: application/sdp\r\n" \
+             b"Content-Length: 0\r\n\r\n"
+    count = 20000
+    data = [invite % (i, i, i) for i in range(count)]
+    for lazy in (False, True):
+        gc.collect()
+        tracemalloc.start()
+        messages = [parseBytes(d, lazy=lazy) for d in data]
+        for message in messages:
+            message.contents()
+        gc.collect()
+        print("%s parsing: %d bytes per message" % ("Lazy" if lazy else "Eager",
+                                                    tracemalloc.get_traced_memory()[0] / count))
+        del messages
+        tracemalloc.stop()
@@ -0,0 +1,143 @@
+"""\
+Purpose: Buffer of the received SIP messages of a SipEndpoint, queued per dialog and message type
+"""
+from collections import deque
+from itertools import count
+from threading import Lock
+from weakref import WeakSet
+
+from common.waiters import Waiters
+
+# All the message buffers, for get_buffer_statistics
+buffers = WeakSet()
+
+
+def get_buffer_statistics():
+    """ :return: The number of received messages waiting in the buffers of all the SipEndpoints of the process """
+    return {"Buffered Messages": sum(len(buffer) for buffer in list(buffers))}
+
+
+def type_matches(message_type, m_type):
+    """
+    :param message_type: The expected message type, a list or tuple of them, or None or "" for any
+    :param m_type: The status or method of a message
+    :return: True if m_type is expected
+    """
+    if not message_type:
+        return True
+    if isinstance(message_type, str):
+        return message_type in m_type
+    return any(m in m_type for m in message_type)
+
+
+def is_excluded(message, exclude):
+    return any(message is m for m in exclude)
+
+
+class MessageBuffer(object):
+    """
+    The received messages waiting to be taken by a SipEndpoint.
+
+    Messages are kept in FIFO queues keyed by Call-ID and, within a Call-ID, by status or method, so taking the
+    message of a dialog only looks at the queues of that dialog. Every message gets an arrival number and, when
+    more than one queue matches, the one that arrived first is taken.
+    Every message added wakes up the thread waiting for it, see common.waiters
+    """
+
+    def __init__(self):
+        # Messages are added by the receiving thread and taken by the endpoint threads
+        self.lock = Lock()
+        # Call-ID to {status or method: deque of (arrival number, message)}
+        self.queues = {}
+        # Arrival number to message, in arrival order, for taking a message of any dialog
+        self.arrivals = {}
+        self.counter = count()
+        self.waiters = Waiters()
+        buffers.add(self)
+
+    def __len__(self):
+        return len(self.arrivals)
+
+    def __iter__(self):
+        return iter(list(self.arrivals.values()))
+
+    def __repr__(self):
+        return repr(list(self.arrivals.values()))
+
+    @staticmethod
+    def matches(message, message_type, call_ids=None):
+        """ :return: True if take(message_type, call_ids) can return message """
+        return type_matches(message_type, message.get_status_or_method()) and \
+            (call_ids is None or message["Call-ID"] in call_ids)
+
+    def add(self, message, skip=None):
+        """
+        Queue a received message at the end of the queue of its dialog and type and wake up its waiter
+        :param message: The SipMessage
+        :param skip: The waiter buffering again a message it did not expect. It is not woken up
+        """
+        call_id = message["Call-ID"]
+        m_type = message.get_status_or_method()
+        with self.lock:
+            number = next(self.counter)
+            self.queues.setdefault(call_id, {}).setdefault(m_type, deque()).append((number, message))
+            self.arrivals[number] = message
+        self.waiters.notify(message, skip)
+
+    def take(self, message_type, call_ids=None, exclude=()):
+        """
+        Remove and return the first message of a type
+
+        :param message_type: The expected message type, see type_matches
+        :param call_ids: A collection of the Call-IDs to take the message from. Any Call-ID if None
+        :param exclude: Messages not to take, the ones the caller has already taken and buffered again
+        :return: The SipMessage or None if there is no such message
+        """
+        with self.lock:
+            if call_ids is None:
+                for number, message in self.arrivals.items():
+                    if not is_excluded(message, exclude) and \
+                            type_matches(message_type, message.get_status_or_method()):
+                        return self._pop(message["Call-ID"], message.get_status_or_method(), number)
+                return None
+            if len(call_ids) > len(self.queues):
+                call_ids = [call_id for call_id in self.queues if call_id in call_ids]
+            first = None
+            for call_id in call_ids:
+                for m_type, queue in self.queues.get(call_id, {}).items():
+                    if type_matches(message_type, m_type):
+                        for number, message in queue:
+                            if not is_excluded(message, exclude):
+                                if first is None or number < first[0]:
+                                    first = number, call_id, m_type
+                                break
+            if first is None:
+                return None
+            return self._pop(first[1], first[2], first[0])
+
+    def _pop(self, call_id, m_type, number):
+        types = self.queues[call_id]
+        queue = types[m_type]
+        if queue[0][0] == number:
+            message = queue.popleft()[1]
+        else:
+            message = self.arrivals[number]
+            queue.remove((number, message))
+        if not types[m_type]:
+            del types[m_type]
+            if not types:
+                del self.queues[call_id]
+        del self.arrivals[number]
+        return message
+
+    def discard(self, call_id):
+        """
+        Remove the messages of a Call-ID, eg retransmissions received after its dialogs are removed
+        :return: The number of messages removed
+        """
+        with self.lock:
+            types = self.queues.pop(call_id, {})
+            for queue in types.values():
+                for number, message in queue:
+                    del self.arrivals[number]
+            return sum(len(queue) for queue in types.values())
@@ -3,76 +3,227 @@ Purpose: Functions for parsing SIP messages and creating SipMessage objects
 Initial Version: Costas Skarakis 11/11/2018
 """
 import re
-from sip.SipMessage import SipMessage
+from functools import lru_cache
+from string import Formatter
+from sip.SipMessage import SipMessage, SipHeaders
 
 ENCODING = "utf8"
 MANDATORY_REQUEST_HEADERS = {"To", "From", "CSeq", "Call-ID", "Max-Forwards"}
-SPECIAL_CASE_HEADERS = {"Call-ID", "CSeq", "X-Siemens-OSS"}
+RESPONSE_LINE = re.compile(r"^SIP/\d\.?\d? (\d+ .*)$", re.I)
+REQUEST_LINE = re.compile(r"^(\w+) \S+ SIP/\d\.?\d?$", re.I)
+# Headers parsed eagerly by parseBytes in lazy mode
+LAZY_HEADERS = re.compile(rb"^(call-id|i|cseq|from|f|to|t|via|v|max-forwards)[ \t]*:[ \t]*(.*?)[ \t\r]*$", re.I | re.M)
+HEADER_END = re.compile(b"\r\n\r\n")
+LINE_END = re.compile(b"\r\n")
+# Messages built from incoming or captured traffic are also compiled, so keep the cache bounded
+TEMPLATE_CACHE_SIZE = 512
 
 
-def buildMessage(message, parameters={}):
-    # remove whitespace from start and end TODO test this change on existing testcases
-    message = re.sub("\n +", "\n", message)
-    tString = message.strip().format(**parameters)
-    # replace new lines
-    bString = bytes(tString.replace("\n", "\r\n").replace("\r\r\n", "\r\n") + 2 * "\r\n", encoding=ENCODING)
-    sipMessage = parseBytes(bString)
+class SipTemplate(object):
+    """
+    A SIP message template, compiled once and rendered many times.
+
+    The whitespace clean up of the raw template is done here, so rendering only has to fill in the values.
+    The first line, the header names in order of appearance and the placeholders are known after compilation,
+    so a SipMessage can be created directly from the template, without going through bytes and parseBytes.
+    """
+
+    def __init__(self, message):
+        # remove whitespace from start and end
+        self.text = re.sub("\n +", "\n", message).strip()
+        header, _, body = self.text.replace("\r\n", "\n").partition("\n\n")
+        lines = header.split("\n")
+        self.first_line = lines[0]
+        self.header_names = [line.split(":", maxsplit=1)[0].strip() for line in lines[1:]]
+        self.placeholders = set(field.split(".")[0].split("[")[0]
+                                for _, field, _, _ in Formatter().parse(self.text) if field)
+        # Header names with placeholders can only be known after formatting the whole template
+        self.direct = not any("{" in name for name in self.header_names)
+        if self.direct:
+            self.headers = [(name, line.split(":", maxsplit=1)[1].strip())
+                            for name, line in zip(self.header_names, lines[1:])]
+            self.body = body
+            if not RESPONSE_LINE.match(self.first_line):
+                checkMandatoryHeaders(SipHeaders(self.headers))
+
+    def render_string(self, parameters):
+        """
+        Fill in the template values
+
+        :param parameters: The values of the template placeholders
+        :return: The message string with CRLF line endings, as it would go on the wire
+        """
+        tString = self.text.format(**parameters)
+        return tString.replace("\n", "\r\n").replace("\r\r\n", "\r\n") + 2 * "\r\n"
+
+    def render(self, parameters):
+        """
+        Fill in the template values and create a SipMessage
+
+        :param parameters: The values of the template placeholders
+        :return: A SipMessage object
+        """
+        if not self.direct:
+            return parseBytes(bytes(self.render_string(parameters), encoding=ENCODING))
+        headers = SipHeaders((name, value.format_map(parameters).strip()) for name, value in self.headers)
+        body = ""
+        if self.body:
+            body = self.body.format_map(parameters).replace("\n", "\r\n").replace("\r\r\n", "\r\n") + 2 * "\r\n"
+        message = SipMessage(headers, body)
+        setFirstLine(message, self.first_line.format_map(parameters))
+        return message
+
+    def render_bytes(self, parameters):
+        """
+        Fill in the template values and create both the SipMessage and its wire format in the same pass
+
+        :param parameters: The values of the template placeholders
+        :return: A tuple of the SipMessage object and the message bytes
+        """
+        message = self.render(parameters)
+        # this also fills in the contents cache of the message
+        wire = message.contents()
+        return message, bytes(wire, encoding=ENCODING)
+
+
+@lru_cache(maxsize=TEMPLATE_CACHE_SIZE)
+def compileTemplate(message):
+    """
+    Get the compiled SipTemplate of a message string.
+    Templates are cached, so each one of the predefined messages is compiled only once
+
+    :param message: The template string, eg one of sip.messages.message
+    :return: A SipTemplate object
+    """
+    return SipTemplate(message)
+
+
+def buildMessage(message, parameters={}, wire=False):
+    """
+    Create a SipMessage from a message template
+
+    :param message: The template string, eg one of sip.messages.message
+    :param parameters: The values of the template placeholders
+    :param wire: Also return the message bytes, created in the same pass
+    :return: A SipMessage object, or a (SipMessage, bytes) tuple if wire is True
+    """
+    template = compileTemplate(message)
+    if wire:
+        return template.render_bytes(parameters)
+    sipMessage = template.render(parameters)
     return sipMessage
 
 
-def parseBytes(bString, sep="\r\n", encoding=ENCODING):
-    # header and body are separated by an empty line
-    header, body = bString.decode(encoding).split(sep + sep, maxsplit=1)
-    header_lines = header.split(sep)
-    request_or_response = header_lines[0]
-    headers = {}
-    count = 0
-    for line in header_lines[1:]:
-        k, v = line.split(":", maxsplit=1)
-        key = str(k).strip()
-        if key in headers:
-            count += 1
-            key = key + "#{}".format(count)
-        headers[key] = v.strip()
-
-    # print (headers.keys())
-    titled_headers = dict((h.title(), headers[h]) for h in headers)
-    case_switched_headers = {}
-    for h in titled_headers:
-        case_switched_headers[h] = titled_headers[h]
-        for special_h in SPECIAL_CASE_HEADERS:
-            if h.capitalize() == special_h.capitalize():
-                case_switched_headers.pop(h)
-                case_switched_headers[special_h] = titled_headers[h]
-                break
-    message = SipMessage(case_switched_headers, body)
-    # add more elements depending if it is a request or a responses
-    resP = re.match(r"^SIP/\d\.?\d? (\d+ .*)$", request_or_response, re.I)
+def checkMandatoryHeaders(headers):
+    """ Make sure all mandatory request headers are present """
+    missing_headers = set(h for h in MANDATORY_REQUEST_HEADERS if h not in headers)
+    if missing_headers:
+        raise Exception("Mandatory headers missing", missing_headers)
+
+
+def setFirstLine(message, request_or_response):
+    """
+    Set the message type and the request or status line elements
+
+    :param message: The SipMessage object
+    :param request_or_response: The first line of the message
+    """
+    resP = RESPONSE_LINE.match(request_or_response)
     if resP:
         message.type = "Response"
         message.status = resP.group(1)
         message.status_line = request_or_response
     else:
-        reqP = re.match(r"^(\w+) \S+ SIP/\d\.?\d?$", request_or_response, re.I)
+        reqP = REQUEST_LINE.match(request_or_response)
         if not reqP:
             raise Exception("Not a valid request or response.. or parse logic error", request_or_response)
-            # return None
-
-        # make sure all mandatory headers are present
-        capital_mandatory_headers = set(h.capitalize() for h in MANDATORY_REQUEST_HEADERS)
-        capital_message_headers = set(h.capitalize() for h in headers.keys())
-        missing_headers = capital_mandatory_headers.difference(capital_message_headers)
-        # missing_headers = MANDATORY_REQUEST_HEADERS.difference(set(headers.keys()))
-        if missing_headers:
-            raise Exception("Mandatory headers missing", missing_headers)
-            # return None
         message.type = "Request"
         message.request_line = request_or_response
         message.method = reqP.group(1)
+
+
+def parseHeaderLines(header_lines):
+    """
+    Parse header lines
+
+    :param header_lines: The header lines without the request or status line
+    :return: A SipHeaders object
+    """
+    headers = SipHeaders()
+    for line in header_lines:
+        k, v = line.split(":", maxsplit=1)
+        headers.add(k.strip(), v.strip())
+    return headers
+
+
+def parseBytes(bString, sep="\r\n", encoding=ENCODING, lazy=False):
+    """
+    Create a SipMessage from received bytes
+
+    The data is not decoded as a whole. The message body is kept as a zero-copy slice of bString and is decoded
+    on first access, so a bytes or memoryview receive buffer must not be modified while the message is in use.
+
+    :param bString: The message bytes. Can be bytes, bytearray or memoryview
+    :param sep: The line separator
+    :param encoding: The message encoding
+    :param lazy: Only parse the request or status line and the headers needed to route the message
+                 to a dialog and transaction (see LAZY_HEADERS). The rest are decoded and parsed on first access.
+    :return: A SipMessage object
+    """
+    view = memoryview(bString)
+    # header and body are separated by an empty line
+    separator = bytes(sep + sep, encoding)
+    if sep == "\r\n":
+        M = HEADER_END.search(view)
+    else:
+        M = re.compile(re.escape(separator)).search(view)
+    if not M:
+        raise ValueError("No end of headers in SIP message", bytes(bString))
+    header_end = M.start()
+    body = view[M.end():] or ""
+    if lazy and sep == "\r\n":
+        return parseLazy(view[:header_end], body, encoding)
+    header_lines = str(view[:header_end], encoding).split(sep)
+    request_or_response = header_lines[0]
+    headers = parseHeaderLines(header_lines[1:])
+    message = SipMessage(headers, body, encoding=encoding)
+    # add more elements depending if it is a request or a responses
+    setFirstLine(message, request_or_response)
+    if message.type == "Request":
+        checkMandatoryHeaders(headers)
     # TODO: Implement body parsing
     return message
 
 
+def parseLazy(header, body, encoding=ENCODING):
+    """
+    Create a SipMessage parsing only the first line and the LAZY_HEADERS
+
+    :param header: memoryview of the header block, including the request or status line
+    :param body: memoryview of the message body
+    :param encoding: The message encoding
+    :return: A SipMessage object
+    """
+    M = LINE_END.search(header)
+    if M:
+        request_or_response = str(header[:M.start()], encoding)
+        raw_header = header[M.end():]
+    else:
+        request_or_response = str(header, encoding)
+        raw_header = header[len(header):]
+    headers = SipHeaders()
+    for M in LAZY_HEADERS.finditer(raw_header):
+        name = str(M.group(1), encoding)
+        if name not in headers:
+            # Only the top Via
+            headers.add(name, str(M.group(2), encoding))
+    message = SipMessage(headers, body, raw_header=raw_header, encoding=encoding)
+    setFirstLine(message, request_or_response)
+    if message.type == "Request":
+        checkMandatoryHeaders(headers)
+    return message
+
+
 if __name__ == "__main__":
     m = b'SIP/2.0 403 Forbidden\r\nWarning: 399 10.2.0.22 "Originating Endpoint is not configured or registered on system. Check provisioning of 3021005533, , 10.2.31.5, 10.2.0.24."\r\nCall-ID: 5bc4d2b1lKza5n\r\nCSeq: 1 OPTIONS\r\nTo: <sip:10.2.0.24:5060>\r\nFrom: <sip:3021005533@10.2.31.5:50080>;tag=snl_5bc4d2b14Y\r\nContent-Length: 0\r\nVia: SIP/2.0/TCP 10.2.31.5:50080;branch=5bc4d2b1cswcPR1cq4nQ\r\n\r\n'
     n = b'SIP/2.0 400 Bad Request\r\nWarning: 399 10.2.0.22 "Request mandatory header is missing or incorrect. Mandatory Header CSEQ-Method mismatch."\r\nVia: SIP/2.0/TCP 10.2.31.5:5080;branch=5bc619b78AKFDlh5mRGL\r\nFrom: "3021005533" <sip:3021005533@10.2.0.22:5060>;tag=snl_5bc619b7OD;epid=SCD0n\r\nCSeq: 1 OPTIONS\r\nCall-ID: 5bc619b7TTYmPW\r\nTo: <sip:10.2.0.22:5060>;tag=snl_PT47YjDdJE\r\nContent-Length: 0\r\n\r\n'
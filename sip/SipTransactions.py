@@ -0,0 +1,346 @@
+"""\
+Purpose: RFC 3261 transaction layer. Retransmit requests and responses over UDP and absorb the retransmissions received
+"""
+from threading import Lock
+
+import common.timers as timers
+from common.client import UDPClient
+
+# RFC 3261 timer values in seconds
+T1 = 0.5
+T2 = 4.0
+T4 = 5.0
+# An INVITE answered only with provisional responses is forgotten after this many seconds
+PROCEEDING_TIMEOUT = 300.0
+
+statistics_lock = Lock()
+statistics = {"INVITE Client Retransmissions": 0,
+              "Non-INVITE Client Retransmissions": 0,
+              "INVITE Server Retransmissions": 0,
+              "Non-INVITE Server Retransmissions": 0,
+              "Absorbed Retransmissions": 0,
+              "Transaction Timeouts": 0}
+
+
+def count(name):
+    with statistics_lock:
+        statistics[name] += 1
+
+
+def get_transaction_statistics():
+    """
+    :return: The retransmissions sent per transaction type, the retransmissions received and absorbed and the
+             transactions that timed out, for all the endpoints of the process. Rising counts are the first sign
+             that the SUT is overloaded
+    """
+    with statistics_lock:
+        return dict(statistics)
+
+
+def is_reliable(link):
+    """ :return: False for UDP links, which need retransmissions """
+    return not isinstance(link, UDPClient) and getattr(link, "protocol", None) != "UDP"
+
+
+def response_matches(response, transaction):
+    """
+    RFC 3261 17.1.3: A response matches a client transaction by the Via branch and the CSeq method
+    :param response: A received SipMessage response
+    :param transaction: The transaction dictionary of the request, see SipMessage.get_transaction
+    """
+    response_transaction = response.get_transaction()
+    if response_transaction["method"] != transaction["method"]:
+        return False
+    # Messages without branch come from RFC 2543 elements. Match them by the method alone
+    return not response.via_branch or not transaction["via_branch"] or \
+        response.via_branch == transaction["via_branch"]
+
+
+def transaction_key(message):
+    """
+    :return: The (Via branch, CSeq number, CSeq method) of a request or response. The CSeq number tells apart the
+             requests of a UA that reuses a branch, so that a late response to one is not taken for the other
+    """
+    cseq, method = message["CSeq"].split()
+    return message.via_branch, cseq, method
+
+
+def response_identity(response):
+    """ :return: What a retransmission of response has in common with it """
+    status = response.status[:3]
+    rseq = response.get("RSeq") if status.startswith("1") else None
+    return status, response.to_tag, response["CSeq"], rseq
+
+
+class ClientTransaction(object):
+    """ A request sent, see TransactionTable """
+
+    def __init__(self, key, data, link):
+        self.key = key
+        self.invite = key[2] == "INVITE"
+        self.data = data
+        self.link = link
+        self.reliable = is_reliable(link)
+        # The response_identity of the responses received
+        self.responses = set()
+        self.proceeding = False
+        self.final = False
+        # The ACK sent for the final response, sent again for its retransmissions
+        self.ack = None
+        # The (Call-ID, CSeq number) of an INVITE
+        self.invite_key = None
+        self.interval = T1
+        self.retransmit_timer = None
+        self.timeout_timer = None
+
+
+class ServerTransaction(object):
+    """ A request received, see TransactionTable """
+
+    def __init__(self, key, link):
+        self.key = key
+        self.invite = key[2] == "INVITE"
+        self.link = link
+        self.reliable = is_reliable(link)
+        # The last response sent, sent again for the retransmissions of the request
+        self.response = None
+        self.final = False
+        self.acked = False
+        self.invite_key = None
+        self.interval = T1
+        self.retransmit_timer = None
+        self.timeout_timer = None
+
+
+class TransactionTable(object):
+    """
+    The client and server transactions of a SipEndpoint, keyed by Via branch, CSeq number and CSeq method.
+
+    Over UDP, requests are retransmitted until a response arrives, Timers A and E, and final responses to
+    INVITE until the ACK arrives, Timer G and the 2xx retransmissions of the UAS core. Transactions without
+    a final response or an ACK after 64*T1 time out, Timers B, F and H.
+    Retransmissions received are absorbed: the request is answered again with the last response, the response
+    with the ACK that was sent for it, and neither is delivered to the endpoint.
+    Every transaction is removed when it completes, or after the time its retransmissions can still arrive.
+
+    The endpoint calls sent() before sending every message and received() for every message received.
+    Timers run in common.timers, or in the event loop for an AsyncSipEndpoint, see call_later.
+    """
+
+    def __init__(self):
+        self.lock = Lock()
+        self.client = {}
+        self.server = {}
+        # INVITE transactions by (Call-ID, CSeq number), to match the ACK of a 2xx, which has its own branch
+        self.client_invites = {}
+        self.server_invites = {}
+        self.call_later = timers.call_later
+
+    def __len__(self):
+        return len(self.client) + len(self.server)
+
+    def sent(self, message, data, link):
+        """
+        Start or update the transaction of a message before it is sent
+        :param message: The SipMessage
+        :param data: The contents of message as they are sent
+        :param link: The link it is sent on
+        """
+        if not message.via_branch:
+            return
+        if message.type == "Request":
+            if message.method == "ACK":
+                self._ack_sent(message, data)
+            else:
+                self._request_sent(message, data, link)
+        else:
+            self._response_sent(message, data, link)
+
+    def received(self, message, link):
+        """
+        Update the transaction of a received message
+        :param message: The SipMessage
+        :param link: The link it was received on
+        :return: False if it is a retransmission that was absorbed and must not be delivered
+        """
+        if not message.via_branch:
+            return True
+        if message.type == "Request":
+            if message.method == "ACK":
+                return self._ack_received(message)
+            return self._request_received(message, link)
+        return self._response_received(message)
+
+    def _request_sent(self, message, data, link):
+        tx = ClientTransaction(transaction_key(message), data, link)
+        with self.lock:
+            # Eg the same request sent again by the caller
+            self._remove(self.client.get(tx.key))
+            self.client[tx.key] = tx
+            if tx.invite:
+                self._index_invite(tx, message, self.client_invites)
+            if not tx.reliable:
+                tx.retransmit_timer = self.call_later(T1, self._retransmit_request, (tx,))
+            tx.timeout_timer = self.call_later(64 * T1, self._timeout, (tx, self.client))
+
+    def _ack_sent(self, message, data):
+        with self.lock:
+            tx = self.client_invites.get((message["Call-ID"], message["CSeq"].split()[0]))
+            if tx is not None:
+                tx.ack = data
+
+    def _response_sent(self, message, data, link):
+        key = transaction_key(message)
+        with self.lock:
+            tx = self.server.get(key)
+            if tx is None:
+                # Answered after the request transaction was removed, see _request_received
+                tx = self.server[key] = ServerTransaction(key, link)
+                if tx.invite:
+                    self._index_invite(tx, message, self.server_invites)
+                tx.timeout_timer = self.call_later(64 * T1, self._expire, (tx,))
+            tx.response = data
+            tx.link = link
+            if message.status.startswith("1") or tx.final:
+                return
+            tx.final = True
+            self._cancel(tx)
+            if not tx.invite:
+                # Timer J
+                self._linger(tx, self.server, 0 if tx.reliable else 64 * T1)
+                return
+            if not tx.reliable:
+                tx.interval = T1
+                tx.retransmit_timer = self.call_later(T1, self._retransmit_response, (tx,))
+            tx.timeout_timer = self.call_later(64 * T1, self._timeout, (tx, self.server))
+
+    def _request_received(self, message, link):
+        key = transaction_key(message)
+        with self.lock:
+            tx = self.server.get(key)
+            if tx is None:
+                tx = self.server[key] = ServerTransaction(key, link)
+                if tx.invite:
+                    self._index_invite(tx, message, self.server_invites)
+                # The request is not retransmitted after 64*T1, Timers B and F
+                tx.timeout_timer = self.call_later(64 * T1, self._expire, (tx,))
+                return True
+            response = tx.response
+        count("Absorbed Retransmissions")
+        if response is not None:
+            count("INVITE Server Retransmissions" if tx.invite else "Non-INVITE Server Retransmissions")
+            tx.link.send(response)
+        return False
+
+    def _ack_received(self, message):
+        with self.lock:
+            tx = self.server_invites.get((message["Call-ID"], message["CSeq"].split()[0]))
+            if tx is None or not tx.final:
+                return True
+            if tx.acked:
+                count("Absorbed Retransmissions")
+                return False
+            tx.acked = True
+            self._cancel(tx)
+            # Timer I, and the ACKs of the 2xx retransmissions still on their way
+            self._linger(tx, self.server, 0 if tx.reliable else 64 * T1)
+        return True
+
+    def _response_received(self, message):
+        key = transaction_key(message)
+        identity = response_identity(message)
+        with self.lock:
+            tx = self.client.get(key)
+            if tx is None:
+                return True
+            if identity in tx.responses:
+                ack = tx.ack if not message.status.startswith("1") else None
+            else:
+                tx.responses.add(identity)
+                if message.status.startswith("1"):
+                    if tx.invite and not tx.proceeding:
+                        # Timer A stops. Timer B too, the INVITE is answered
+                        self._cancel(tx)
+                        tx.timeout_timer = self.call_later(PROCEEDING_TIMEOUT, self._expire_completed,
+                                                           (tx, self.client))
+                    else:
+                        # Timer E continues every T2
+                        tx.interval = T2
+                    tx.proceeding = True
+                elif not tx.final:
+                    tx.final = True
+                    self._cancel(tx)
+                    # Timers D and K, and the 2xx retransmissions of the UAS core
+                    self._linger(tx, self.client, 64 * T1 if tx.invite else 0 if tx.reliable else T4)
+                return True
+        count("Absorbed Retransmissions")
+        if ack is not None:
+            count("INVITE Client Retransmissions")
+            tx.link.send(ack)
+        return False
+
+    def _retransmit_request(self, tx):
+        with self.lock:
+            if self.client.get(tx.key) is not tx or tx.final or (tx.invite and tx.proceeding):
+                return
+            tx.interval = tx.interval * 2 if tx.invite else min(tx.interval * 2, T2)
+            tx.retransmit_timer = self.call_later(tx.interval, self._retransmit_request, (tx,))
+        count("INVITE Client Retransmissions" if tx.invite else "Non-INVITE Client Retransmissions")
+        tx.link.send(tx.data)
+
+    def _retransmit_response(self, tx):
+        with self.lock:
+            if self.server.get(tx.key) is not tx or tx.acked:
+                return
+            tx.interval = min(tx.interval * 2, T2)
+            tx.retransmit_timer = self.call_later(tx.interval, self._retransmit_response, (tx,))
+            response = tx.response
+        count("INVITE Server Retransmissions")
+        tx.link.send(response)
+
+    def _timeout(self, tx, transactions):
+        with self.lock:
+            if transactions.get(tx.key) is not tx:
+                return
+            self._remove(tx)
+        count("Transaction Timeouts")
+
+    def _expire(self, tx):
+        with self.lock:
+            if self.server.get(tx.key) is tx and not tx.final:
+                self._remove(tx)
+
+    def _linger(self, tx, transactions, delay):
+        if delay:
+            tx.timeout_timer = self.call_later(delay, self._expire_completed, (tx, transactions))
+        else:
+            self._remove(tx)
+
+    def _expire_completed(self, tx, transactions):
+        with self.lock:
+            if transactions.get(tx.key) is tx:
+                self._remove(tx)
+
+    @staticmethod
+    def _cancel(tx):
+        for timer in tx.retransmit_timer, tx.timeout_timer:
+            if timer is not None:
+                timer.cancel()
+        tx.retransmit_timer = tx.timeout_timer = None
+
+    def _remove(self, tx):
+        """ Called with self.lock held """
+        if tx is None:
+            return
+        self._cancel(tx)
+        transactions, invites = (self.client, self.client_invites) if isinstance(tx, ClientTransaction) \
+            else (self.server, self.server_invites)
+        if transactions.get(tx.key) is tx:
+            del transactions[tx.key]
+        if invites.get(tx.invite_key) is tx:
+            del invites[tx.invite_key]
+
+    @staticmethod
+    def _index_invite(tx, message, invites):
+        tx.invite_key = (message["Call-ID"], message["CSeq"].split()[0])
+        invites[tx.invite_key] = tx
@@ -35,7 +35,7 @@ def register_secondary(primary, line, expiration_in_seconds=360):
 
 def add_keyset_line(primary, line_dn):
     line = SipEndpoint(line_dn)
-    line.use_link(primary.link)
+    line.use_link(primary, dispatch=True)
     register_secondary(primary, line)
 
 
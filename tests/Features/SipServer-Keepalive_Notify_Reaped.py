@@ -0,0 +1,48 @@
+import sys
+
+from os import path
+sys.path.append(path.join("..", ".."))
+from common.server import SipServer
+from sip.messages import message
+from sip.SipEndpoint import SipEndpoint
+from time import sleep
+
+if __name__ == "__main__":
+    # An out of dialog NOTIFY, eg a keep-alive, answered by the default notify_ok handler of SipServer must not
+    # leave its dialog behind
+    params = {"local_ip": "127.0.0.1",
+              "transport": "tcp",
+              "number_of_notifies": 3}
+
+    server = SipServer(params["local_ip"], 0, params["transport"])
+    # Terminated dialogs are removed by the next reap instead of after lingering
+    server.sip_endpoint.dialog_linger = 0
+    server.set_parameter("toTag", "")
+    server.set_parameter("callId", None)
+    server.serve_in_background()
+    sleep(0.5)
+
+    A = SipEndpoint("302108810001")
+    A.connect((params["local_ip"], 0), (params["local_ip"], server.port), params["transport"])
+    A.parameters["toTag"] = ""
+    A.dialog_linger = 0
+
+    try:
+        for i in range(params["number_of_notifies"]):
+            A.send_new(message_string=message["Notify_terminated_1"], expected_response="200 OK")
+        # notify_ok sends the 200 OK before it returns
+        sleep(0.5)
+        for endpoint in server.sip_endpoint, A:
+            # The answered NOTIFY dialogs have a to_tag, so early_dialog_ttl does not free them, only their
+            # termination does
+            endpoint.reap_dialogs()
+            statistics = endpoint.get_statistics()
+            assert not len(endpoint.dialogs), "Dialogs left in {}: {}".format(endpoint.number, endpoint.dialogs)
+            assert not endpoint.dialogs.call_ids, "Call-IDs left in {}".format(endpoint.number)
+            assert not endpoint.tags, "Tags left in {}: {}".format(endpoint.number, endpoint.tags)
+            print(endpoint.number, statistics)
+        assert not server.links.dialogs, "Dialog links left: {}".format(server.links.dialogs)
+        print("Answered keep-alive NOTIFY dialogs reaped")
+    finally:
+        A.link.shutdown()
+        server.continue_serving = False
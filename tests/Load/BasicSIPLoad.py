@@ -1,24 +1,23 @@
-import logging.handlers
-import logging.config
 import os
 import sys
 from time import sleep
 
 sys.path.append(os.path.join("..", ".."))
 from common.tc_logging import LOG_CONFG
-from common.util import Load, next_available_sip, make_available_sip
+import common.pcap as pcap
+from common.util import Load, EndpointPool
 from sip.SipEndpoint import SipEndpoint
 from common.view import SipEndpointView, LoadWindow
 from sip.SipFlows import basic_call
-from itertools import cycle
 import yappi
 
 
-def flow(pool_a, pool_b):
-    a = next_available_sip(pool_a)
-    b = next_available_sip(pool_b)
-    basic_call(a, b, duration=8)
-    make_available_sip(a, b)
+def flow(pairs):
+    a, b = pairs.acquire()
+    try:
+        basic_call(a, b, duration=8)
+    finally:
+        pairs.release((a, b))
 
 
 def register(subs, expiration=3600):
@@ -37,23 +36,14 @@ def register(subs, expiration=3600):
 def connect(subs, sip_server_address, transport="tcp"):
     # local_address = ("172.25.255.137", 0)
     count = 0
-    try:
-        os.mkdir("log")
-    except:
-        pass
+    # All traffic goes in one capture instead of a text log per subscriber
+    pcap.start("BasicSIPLoad.pcapng")
 
     for a in subs:
         count += 1
         local_address = ("10.4.253.13", 65535 - count)
         try:
             a.connect(local_address, sip_server_address, transport)
-            a_logger = logging.getLogger(a.number)
-            a.link.logger = a_logger
-            a_logger.setLevel("INFO")
-            handler = logging.handlers.RotatingFileHandler(os.path.join("log", a.number + ".txt"), mode="w",
-                                                           maxBytes=10000, backupCount=5)
-            handler.setLevel("INFO")
-            a_logger.addHandler(handler)
         except OSError:
             a.busy = True
             if type(a) is SipEndpointView:
@@ -61,13 +51,14 @@ def connect(subs, sip_server_address, transport="tcp"):
 
 
 def main():
-    a_sides = cycle(a_subs)
-    b_sides = cycle(b_subs)
+    # Endpoints that failed to connect are busy and are never acquired
+    pairs = EndpointPool(list(zip(a_subs, b_subs)), condition=lambda pair: not any(ep.busy for ep in pair),
+                         name="Pairs")
     all_subs = a_subs + b_subs
     connect(all_subs, sipsm_address)
     try:
         register(all_subs)
-        test = Load(flow, a_sides, b_sides, interval=0.1, quantity=5, duration=200)
+        test = Load(flow, pairs, interval=0.1, quantity=5, duration=200)
         print("TEST STARTING")
         test.start()
         print("TEST STARTED")
@@ -75,6 +66,7 @@ def main():
     finally:
         # unregister
         register(all_subs, 0)
+        pcap.stop()
 
 
 if __name__ == "__main__":
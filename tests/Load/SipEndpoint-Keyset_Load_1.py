@@ -94,7 +94,7 @@ def unregister_secondary(primary, line):
 
 def add_keyset_line(primary, line_dn):
     line = SipEndpoint(line_dn)
-    line.use_link(primary.link)
+    line.use_link(primary, dispatch=True)
     register_secondary(primary, line)
     primary.secondary_lines.append(line)
     # Very ugly way to check if line is busy: TODO
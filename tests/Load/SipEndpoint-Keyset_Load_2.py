@@ -1,7 +1,6 @@
 import sys
 import traceback
 from copy import copy
-from threading import Timer
 
 from os import path
 sys.path.append(path.join("..", ".."))
@@ -9,6 +8,7 @@ sys.path.append(path.join("..", ".."))
 from common.tc_logging import debug, warning
 from sip.SipParser import parseBytes
 from common import util
+from common import timers
 from sip.messages import message
 from sip.SipEndpoint import SipEndpoint
 from time import sleep
@@ -30,8 +30,8 @@ def notify_after_subscribe(sip_ep, subscribe_dialog):
 
 
 def register_primary(sip_ep, secondary_numbers,expiration_in_seconds=360):
-    sip_ep.re_register_timer = Timer(expiration_in_seconds/2, register_primary, (sip_ep, secondary_numbers, expiration_in_seconds))
-    sip_ep.re_register_timer.start()
+    sip_ep.re_register_timer = timers.call_later(expiration_in_seconds/2, register_primary,
+                                                 (sip_ep, secondary_numbers, expiration_in_seconds), jitter=0.1)
     sip_ep.parameters["expires"] = expiration_in_seconds
     sip_ep.parameters["primary"] = sip_ep.number
     sip_ep.parameters["primary_port"] = sip_ep.port
@@ -44,7 +44,7 @@ def register_primary(sip_ep, secondary_numbers,expiration_in_seconds=360):
         # first registration
         for n in secondary_numbers:
             line = SipEndpoint(n)
-            line.use_link(sip_ep.link)
+            line.use_link(sip_ep, dispatch=True)
             sip_ep.secondary_lines.append(line)
 
     for line in sip_ep.secondary_lines:
@@ -214,7 +214,7 @@ def wait_for_call(B, c_index):
 
 
 def flow(users, secondary_numbers):
-    A = next(users)
+    A = users.acquire()
     dial_number = next(secondary_numbers)
     try:
 
@@ -236,6 +236,8 @@ def flow(users, secondary_numbers):
     except:
         debug("FAILED CALL on A side: {} to {} ".format(A.number, dial_number))
         debug(traceback.format_exc())
+    finally:
+        users.release(A)
 
 
 def tear_down(A, B):
@@ -261,7 +263,7 @@ if __name__ == "__main__":
     call_takers = [SipEndpoint(b) for b in call_taker_numbers]
     secondary_lines = range(number_of_secondary_lines)
 
-    user_pool = util.pool(users, lambda x: x.registered)
+    user_pool = util.EndpointPool(users, condition=lambda x: x.registered, name="Users")
     #call_taker_pool = util.pool(call_takers, lambda x: x.registered)
     secondary_line_pool = cycle(secondary_numbers)
 